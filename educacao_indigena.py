@@ -1,31 +1,587 @@
-import psycopg2
-from psycopg2 import extras
-import pandas as pd
-import uuid
+# Apenas módulos leves da biblioteca padrão são importados aqui; pandas, psycopg2, duckdb e pyarrow
+# são importados dentro das funções que os usam, para que `--help` e consultas rápidas iniciem rápido
+import argparse
+import contextlib
+import json
 import os
+import random
+import re
+import sys
+import tempfile
+import time
+import unicodedata
+import uuid
+
+# Backends de armazenamento
+# 'postgres' usa o servidor PostgreSQL configurado abaixo; 'duckdb' usa um banco embutido em arquivo,
+# útil para rodar o pipeline completo em uma máquina de desenvolvimento ou no CI sem servidor
+BACKEND = os.environ.get('EDUCACAO_BACKEND', 'postgres')
+DUCKDB_PATH = os.environ.get('EDUCACAO_DUCKDB_PATH', './educacao_indigena.duckdb')
+
+# Cursor do DuckDB com a mesma interface usada pelo resto do módulo (placeholders %s, fetchone, fetchall)
+class _CursorDuckDB:
+    def __init__(self, conexao):
+        self._conexao = conexao
+        self._resultado = None
+
+    def execute(self, query, params=None):
+        if params is None:
+            self._resultado = self._conexao.execute(query)
+        else:
+            self._resultado = self._conexao.execute(_BackendDuckDB.placeholders(query), params)
+
+    def executemany(self, query, data):
+        self._conexao.executemany(_BackendDuckDB.placeholders(query), data)
+
+    def fetchone(self):
+        return self._resultado.fetchone()
+
+    def fetchmany(self, tamanho):
+        return self._resultado.fetchmany(tamanho)
+
+    def fetchall(self):
+        return self._resultado.fetchall()
+
+    def close(self):
+        pass
+
+# Conexão DuckDB que imita a transação implícita do psycopg2 (commit/rollback abrem uma nova transação)
+class _ConexaoDuckDB:
+    def __init__(self, caminho):
+        import duckdb
+        self.duckdb = duckdb.connect(caminho)
+        self.duckdb.execute('BEGIN TRANSACTION')
+
+    def cursor(self):
+        return _CursorDuckDB(self.duckdb)
+
+    def commit(self):
+        self.duckdb.execute('COMMIT')
+        self.duckdb.execute('BEGIN TRANSACTION')
+
+    def rollback(self):
+        self.duckdb.execute('ROLLBACK')
+        self.duckdb.execute('BEGIN TRANSACTION')
 
-# Conectar ao banco de dados PostgreSQL
-# Configura a conexão com o banco de dados PostgreSQL usando as credenciais fornecidas
-conn = psycopg2.connect(
+    def close(self):
+        self.duckdb.execute('COMMIT')
+        self.duckdb.close()
+
+# Credenciais do banco de dados PostgreSQL
+# Compartilhadas entre a conexão principal (psycopg2) e a conexão em pipeline (psycopg 3)
+PARAMETROS_CONEXAO = dict(
     dbname="seu_banco_de_dados",
     user="seu_usuario",
     password="sua_senha",
     host="seu_host",
     port="5432"
 )
-cursor = conn.cursor()
+
+# Dialeto do PostgreSQL, no qual o SQL do módulo é escrito (placeholders do psycopg2 inclusive)
+# Cada diferença do DuckDB é um método sobrescrito em _BackendDuckDB; o resto do módulo usa o
+# backend ativo (variável global backend, criada em abrir_conexao) em vez de testar BACKEND
+class _BackendPostgres:
+    nome = 'postgres'
+    # Recursos que só existem no servidor: réplica de leitura, índices de trigramas (pg_trgm),
+    # contrato de planos (EXPLAIN com buffers) e inserções em pipeline (psycopg 3)
+    servidor = True
+    # O upsert pode atualizar colunas com chave estrangeira (ID_*)
+    atualiza_chave_estrangeira = True
+
+    def conectar(self):
+        import psycopg2
+        return psycopg2.connect(**PARAMETROS_CONEXAO)
+
+    # Comandos que criam o esquema
+    def esquema(self, schema_sql):
+        return [schema_sql]
+
+    # Tabela temporária descartada no fim da transação; definicao é '(colunas)' ou 'AS SELECT ...'
+    def tabela_temporaria(self, nome, definicao):
+        if definicao.lstrip().upper().startswith('AS '):
+            return f'CREATE TEMP TABLE {nome} ON COMMIT DROP {definicao}'
+        return f'CREATE TEMP TABLE {nome} {definicao} ON COMMIT DROP'
+
+    # Upsert das linhas de origem em tabela pela chave: UPDATE das que existem (com atualizar=True)
+    # e INSERT das que faltam; devolve os comandos
+    def upsert(self, tabela, origem, chave, colunas, atualizar):
+        mesma_chave = ' AND '.join(f'"{tabela}"."{coluna}" = o."{coluna}"' for coluna in chave)
+        demais = [
+            coluna for coluna in colunas
+            if coluna not in chave and (self.atualiza_chave_estrangeira or not coluna.startswith('ID_'))
+        ]
+        comandos = []
+        if atualizar and demais:
+            atribuicoes = ', '.join(f'"{coluna}" = o."{coluna}"' for coluna in demais)
+            comandos.append(f'UPDATE "{tabela}" SET {atribuicoes} FROM {origem} o WHERE {mesma_chave}')
+        comandos.append(f'''
+            INSERT INTO "{tabela}" ({", ".join(f'"{coluna}"' for coluna in colunas)})
+            SELECT {", ".join(f'o."{coluna}"' for coluna in colunas)} FROM {origem} o
+            WHERE NOT EXISTS (SELECT 1 FROM "{tabela}" WHERE {mesma_chave})
+        ''')
+        return comandos
+
+    # Insere data com a query INSERT ... VALUES (%s, ...) usando execute_batch
+    def executar_lote(self, conexao, cursor_lote, query, data):
+        import psycopg2.extras
+        psycopg2.extras.execute_batch(cursor_lote, query, data)
+
+    # Leitor nativo do censo; None quando o backend não tem um (a leitura fica com o pandas/pyarrow)
+    def ler_censo(self, conexao, caminho):
+        return None
+
+    # Executa uma consulta e devolve as linhas sob demanda, itersize por ida ao servidor, com um
+    # cursor nomeado (server-side), para que a memória do cliente não cresça com o resultado
+    def iterar(self, conexao, sql, params, itersize):
+        with conexao.cursor(name=f'consulta_{uuid.uuid4().hex}') as cursor_servidor:
+            cursor_servidor.itersize = itersize
+            cursor_servidor.execute(sql, params)
+            yield from cursor_servidor
+
+    # Pontuação e filtro da busca por nome na coluna normalizada (parâmetros %(termo)s e %(limiar)s)
+    # O limiar do operador <% é pg_trgm.word_similarity_threshold, ajustado em preparar_busca
+    def busca_nome(self, coluna):
+        return f'word_similarity(%(termo)s, {coluna})', f'%(termo)s <%% {coluna}'
+
+    # Prepara a sessão para a busca; devolve True se abriu o savepoint busca_nome, que quem chamou
+    # desfaz no fim: na conexão principal a transação pode ser de quem chamou, e assim nem o ajuste
+    # do limiar nem um erro da busca ficam nela
+    def preparar_busca(self, cursor_busca, limiar):
+        cursor_busca.execute('SAVEPOINT busca_nome')
+        cursor_busca.execute('SELECT set_config(\'pg_trgm.word_similarity_threshold\', %s, true)', (str(limiar),))
+        return True
+
+    # Atribuição do elemento posicao (1 = ANO_INICIAL_SERIE) de um array de Serie_Matricula no UPDATE
+    # O PostgreSQL completa com NULL um array atribuído além do fim
+    def atribuir_serie(self, coluna, posicao, valor):
+        return f'"{coluna}"[{posicao}] = {valor}'
+
+    # Condição do UPDATE: a linha tem algum ano depois da posição posicao
+    def serie_posterior(self, posicao):
+        return f'cardinality(array_remove("Serie_Matricula"."QT_MATRICULAS_TOTAL"[{posicao + 1}:], NULL)) > 0'
+
+    # Array novo de Serie_Matricula com valor na posição posicao e NULL nas anteriores
+    def nova_serie(self, posicao, valor):
+        return f'array_fill(NULL::INT, ARRAY[{posicao - 1}]) || CAST({valor} AS INT)'
+
+    # Condição: a série da coluna não tem nenhum ano com valor
+    def serie_vazia(self, coluna):
+        return f'cardinality(array_remove("{coluna}", NULL)) = 0'
+
+    # Grava o resultado de sql em Parquet particionado em destino (ver _copiar_para_parquet)
+    def copiar_para_parquet(self, conexao, sql, destino):
+        _copiar_csv_para_parquet(sql, destino)
+
+# Dialeto do DuckDB: banco embutido em arquivo, sem réplica nem pg_trgm
+class _BackendDuckDB(_BackendPostgres):
+    nome = 'duckdb'
+    servidor = False
+    # O DuckDB executa o UPDATE de uma coluna com chave estrangeira como DELETE + INSERT, o que
+    # viola as chaves das tabelas que apontam para a linha
+    atualiza_chave_estrangeira = False
+
+    # Sem caminho, usa DUCKDB_PATH do momento da conexão
+    def __init__(self, caminho=None):
+        self.caminho = caminho
+
+    def conectar(self):
+        return _ConexaoDuckDB(self.caminho or DUCKDB_PATH)
+
+    # Converte os placeholders do psycopg2 (%s, %(nome)s e o escape %%) para os do DuckDB (?, $nome e %)
+    # Como no psycopg2, só vale para consultas executadas com parâmetros; sem eles, a consulta vai intacta
+    @staticmethod
+    def placeholders(query):
+        return re.sub(
+            r'%\((\w+)\)s|%s|%%',
+            lambda m: f'${m.group(1)}' if m.group(1) else ('?' if m.group(0) == '%s' else '%'),
+            query
+        )
+
+    # Sem colunas IDENTITY, cada chave vira uma sequência
+    def esquema(self, schema_sql):
+        chaves = re.findall(r'"(ID_\w+)" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY', schema_sql)
+        schema_sql = re.sub(
+            r'"(ID_\w+)" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY',
+            lambda m: f'"{m.group(1)}" INTEGER PRIMARY KEY DEFAULT nextval(\'seq_{m.group(1).lower()}\')',
+            schema_sql
+        )
+        sequencias = [f'CREATE SEQUENCE IF NOT EXISTS seq_{chave.lower()}' for chave in chaves]
+        return sequencias + [stmt for stmt in schema_sql.split(';') if stmt.strip()]
+
+    # Sem ON COMMIT DROP: a tabela dura até o DROP TABLE de quem a criou, e OR REPLACE descarta a de
+    # uma execução interrompida antes dele
+    def tabela_temporaria(self, nome, definicao):
+        return f'CREATE OR REPLACE TEMP TABLE {nome} {definicao}'
+
+    # Registra os dados como DataFrame e faz um único INSERT ... SELECT vetorizado, já que
+    # executemany linha a linha é lento no DuckDB
+    def executar_lote(self, conexao, cursor_lote, query, data):
+        import pandas as pd
+        if not data:
+            return
+        match = re.match(r'\s*INSERT INTO\s+(\S+)\s*\((.*?)\)\s*VALUES', query, re.S)
+        if match is None:
+            cursor_lote.executemany(query, data)
+            return
+        tabela, colunas = match.group(1), match.group(2)
+        lote = pd.DataFrame(data, columns=[c.strip().strip('"') for c in colunas.split(',')])
+        conexao.duckdb.register('_lote', lote)
+        try:
+            conexao.duckdb.execute(f'INSERT INTO {tabela} ({colunas}) SELECT * FROM _lote')
+        finally:
+            conexao.duckdb.unregister('_lote')
+
+    # Leitores vetorizados nativos (read_csv/read_parquet)
+    def ler_censo(self, conexao, caminho):
+        if caminho.endswith('.parquet'):
+            return conexao.duckdb.execute('SELECT * FROM read_parquet(?)', [caminho]).df()
+        return conexao.duckdb.execute(
+            "SELECT * FROM read_csv(?, delim=';', header=true, encoding='latin-1')", [caminho]
+        ).df()
+
+    def iterar(self, conexao, sql, params, itersize):
+        cursor_consulta = conexao.cursor()
+        cursor_consulta.execute(sql, params)
+        while True:
+            linhas = cursor_consulta.fetchmany(itersize)
+            if not linhas:
+                return
+            yield from linhas
+
+    # Nomes que contêm o termo inteiro ficam à frente; entre eles, o mais parecido por Jaro-Winkler
+    def busca_nome(self, coluna):
+        score = f'(contains({coluna}, %(termo)s)::INT + jaro_winkler_similarity({coluna}, %(termo)s)) / 2'
+        return score, f'{score} >= %(limiar)s'
+
+    def preparar_busca(self, cursor_busca, limiar):
+        return False
+
+    # A lista é remontada em volta da posição
+    def atribuir_serie(self, coluna, posicao, valor):
+        return (f'"{coluna}" = list_concat(list_concat(list_resize(list_slice("{coluna}", 1, {posicao - 1}), {posicao - 1}), '
+                f'[CAST({valor} AS INT)]), list_slice("{coluna}", {posicao + 1}, len("{coluna}")))')
+
+    def serie_posterior(self, posicao):
+        return f'list_count(list_slice("Serie_Matricula"."QT_MATRICULAS_TOTAL", {posicao + 1}, len("Serie_Matricula"."QT_MATRICULAS_TOTAL"))) > 0'
+
+    def nova_serie(self, posicao, valor):
+        return f'list_concat(list_resize(CAST([] AS INT[]), {posicao - 1}), [CAST({valor} AS INT)])'
+
+    def serie_vazia(self, coluna):
+        return f'list_count("{coluna}") = 0'
+
+    # O próprio COPY grava Parquet particionado, sem passar pelo Python
+    def copiar_para_parquet(self, conexao, sql, destino):
+        colunas = [d[0] for d in conexao.duckdb.execute(f'SELECT * FROM ({sql}) LIMIT 0').description]
+        colunas_particao = [f'"{c}"' for c in ('ANO_REFERENCIA', 'SIGLA_UF') if c in colunas]
+        opcoes = "FORMAT PARQUET"
+        if colunas_particao:
+            opcoes += f", PARTITION_BY ({', '.join(colunas_particao)}), OVERWRITE_OR_IGNORE TRUE"
+            conexao.duckdb.execute(f"COPY ({sql}) TO '{destino}' ({opcoes})")
+        else:
+            os.makedirs(destino, exist_ok=True)
+            conexao.duckdb.execute(f"COPY ({sql}) TO '{os.path.join(destino, 'dados.parquet')}' ({opcoes})")
+
+BACKENDS = {'postgres': _BackendPostgres, 'duckdb': _BackendDuckDB}
+
+# Cria o backend pelo nome (padrão: BACKEND)
+def criar_backend(nome=None):
+    nome = nome or BACKEND
+    if nome not in BACKENDS:
+        raise ValueError(f"Backend desconhecido: {nome}. Use 'postgres' ou 'duckdb'.")
+    return BACKENDS[nome]()
+
+# Conectar ao banco de dados
+# Configura a conexão com o banco de dados do backend informado (padrão: BACKEND)
+def conectar(backend=None):
+    return criar_backend(backend).conectar()
+
+# A conexão é aberta sob demanda pela primeira função que precisa do banco (ver abrir_conexao),
+# junto com o backend que a criou
+backend = None
+conn = None
+cursor = None
+
+def abrir_conexao():
+    global backend, conn, cursor
+    if conn is None:
+        backend = criar_backend()
+        conn = backend.conectar()
+        cursor = conn.cursor()
+    return conn
+
+# Com saida=sys.stderr, a mensagem de encerramento não se mistura às linhas TSV escritas no stdout
+def fechar_conexao(saida=None):
+    global conn, cursor
+    if roteador_leitura is not None:
+        roteador_leitura.fechar()
+    if conn is not None:
+        cursor.close()
+        conn.close()
+        conn = None
+        cursor = None
+        print("Conexão fechada.", file=saida)
+
+# Usa uma conexão com novo_backend como conexão do módulo enquanto o bloco roda; ao sair, mesmo
+# com erro, fecha essa conexão e restaura a anterior, que continua aberta e com a sua transação
+@contextlib.contextmanager
+def _usando_backend(novo_backend):
+    global backend, conn, cursor
+    anterior = (backend, conn, cursor)
+    backend, conn, cursor = novo_backend, None, None
+    try:
+        conn = novo_backend.conectar()
+        cursor = conn.cursor()
+        yield
+    finally:
+        if conn is not None:
+            cursor.close()
+            conn.close()
+        backend, conn, cursor = anterior
+
+# Réplica de leitura
+# Com EDUCACAO_DSN_LEITURA definido (string de conexão libpq, ex.: "host=replica dbname=censo user=leitor"),
+# as consultas analíticas, o cubo e a busca leem de uma conexão somente leitura com esse DSN, enquanto
+# as cargas continuam escrevendo na conexão principal. Sem ele, ou no DuckDB, tudo usa a conexão principal
+DSN_LEITURA = os.environ.get('EDUCACAO_DSN_LEITURA')
+# Quantas gerações de carga (Geracao_Carga) a réplica pode estar atrás da principal
+ATRASO_MAXIMO_GERACOES = int(os.environ.get('EDUCACAO_ATRASO_MAXIMO_GERACOES', 0))
+# Por quantos segundos a geração da principal fica em cache antes de ser relida
+INTERVALO_GERACAO_PRINCIPAL = float(os.environ.get('EDUCACAO_INTERVALO_GERACAO', 30))
+
+# Maior ID_GERACAO visível pela conexão (0 se nenhuma carga foi registrada)
+def _geracao_carga(conexao):
+    with conexao.cursor() as cursor_geracao:
+        cursor_geracao.execute('SELECT COALESCE(MAX("ID_GERACAO"), 0) FROM "Geracao_Carga"')
+        return cursor_geracao.fetchone()[0]
+
+# Decide de onde as leituras vêm: da réplica em dsn ou da conexão principal (ver abrir)
+# Guarda a sua conexão com a réplica e a geração da principal em cache. O módulo usa o roteador
+# de DSN_LEITURA (ver _roteador_leitura); verificar_replica monta os seus, sem tocar nesse
+class _RoteadorLeitura:
+    def __init__(self, dsn, atraso_maximo, intervalo=INTERVALO_GERACAO_PRINCIPAL):
+        self.dsn = dsn
+        self.atraso_maximo = atraso_maximo
+        self.intervalo = intervalo
+        self.conexao = None
+        # (geração, instante em time.monotonic()) da última leitura de Geracao_Carga na principal
+        self.geracao_principal = None
+
+    # Geração de carga da principal, relida no máximo a cada intervalo segundos
+    # As cargas deste processo atualizam o valor ao gravar (ver registrar_geracao_principal); o
+    # intervalo cobre as cargas feitas por outros processos
+    def geracao_atual(self):
+        import psycopg2.extensions
+        if self.geracao_principal is not None and time.monotonic() - self.geracao_principal[1] < self.intervalo:
+            return self.geracao_principal[0]
+        ociosa = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        geracao = _geracao_carga(conn)
+        if ociosa:
+            conn.commit()
+        self.geracao_principal = (geracao, time.monotonic())
+        return geracao
+
+    # Chamada depois do commit de uma carga que registrou geração: guarda a nova geração da principal
+    def registrar_geracao_principal(self):
+        if not backend.servidor or not self.dsn:
+            return
+        self.geracao_principal = (_geracao_carga(conn), time.monotonic())
+        conn.commit()
+
+    # Devolve a conexão usada pelas leituras: a réplica, se configurada, acessível e com no máximo
+    # atraso_maximo gerações de carga atrás da principal; senão, a conexão principal
+    # Os avisos vão para o stderr, para não se misturarem às linhas TSV que os subcomandos de leitura escrevem
+    # Cada leitura na réplica deve terminar com commit, para não segurar o snapshot (ver
+    # _encerrar_leitura); a verificação na principal não interfere em uma transação já aberta nela
+    def abrir(self):
+        abrir_conexao()
+        if not backend.servidor or not self.dsn:
+            return conn
+        import psycopg2
+        try:
+            if self.conexao is None:
+                self.conexao = psycopg2.connect(self.dsn)
+                self.conexao.set_session(readonly=True)
+            geracao_replica = _geracao_carga(self.conexao)
+            self.conexao.commit()
+        except psycopg2.Error as e:
+            print(f"AVISO: réplica de leitura indisponível ({str(e).strip()}); lendo da conexão principal.", file=sys.stderr)
+            self.fechar()
+            return conn
+
+        geracao = self.geracao_atual()
+        if geracao - geracao_replica > self.atraso_maximo:
+            print(f"AVISO: réplica de leitura na geração de carga {geracao_replica}, "
+                  f"principal na {geracao}; lendo da conexão principal.", file=sys.stderr)
+            return conn
+        return self.conexao
+
+    def fechar(self):
+        if self.conexao is not None:
+            self.conexao.close()
+            self.conexao = None
+
+roteador_leitura = None
+
+# Roteador das leituras do módulo, recriado se DSN_LEITURA mudar (ex.: pelo --dsn-leitura da CLI)
+def _roteador_leitura():
+    global roteador_leitura
+    if roteador_leitura is None or roteador_leitura.dsn != DSN_LEITURA:
+        if roteador_leitura is not None:
+            roteador_leitura.fechar()
+        roteador_leitura = _RoteadorLeitura(DSN_LEITURA, ATRASO_MAXIMO_GERACOES)
+    return roteador_leitura
+
+def _registrar_geracao_principal():
+    _roteador_leitura().registrar_geracao_principal()
+
+# Conexão para uma leitura, escolhida por roteador (por padrão, o do módulo)
+def abrir_conexao_leitura(roteador=None):
+    return (roteador or _roteador_leitura()).abrir()
+
+# Termina a transação de leitura na réplica; na conexão principal a transação fica com quem chamou
+def _encerrar_leitura(conexao, sucesso=True):
+    if conexao is not conn and conexao is not None:
+        if sucesso:
+            conexao.commit()
+        else:
+            conexao.rollback()
+
+# Inserir dados em lote no backend ativo (ver executar_lote dos backends)
+def executar_lote(query, data):
+    backend.executar_lote(conn, cursor, query, data)
+
+# Mapa compacto de códigos inteiros (CO_ENTIDADE, CO_MUNICIPIO) para IDs do banco
+# Guarda as chaves ordenadas e os valores em dois arrays NumPy (16 bytes por entrada, contra ~100+
+# de um dict de ints) e faz a busca com searchsorted, inclusive em lote. Pode ser gravado em .npy
+# e reaberto com memory-map, de modo que execuções seguintes e processos paralelos compartilhem o
+# mapa sem reconstruí-lo
+class MapaIds:
+    # As chaves podem vir em qualquer ordem (são ordenadas aqui), mas não podem se repetir
+    def __init__(self, chaves=(), valores=()):
+        import numpy as np
+        chaves = np.asarray(chaves, dtype=np.int64)
+        valores = np.asarray(valores, dtype=np.int64)
+        if chaves.shape != valores.shape:
+            raise ValueError(f"MapaIds com {len(chaves)} chaves e {len(valores)} valores.")
+        ordem = np.argsort(chaves, kind='stable')
+        self.chaves, self.valores = chaves[ordem], valores[ordem]
+        self._validar()
+
+    # A busca com searchsorted só é correta com as chaves em ordem estritamente crescente
+    def _validar(self):
+        import numpy as np
+        if not np.all(self.chaves[:-1] < self.chaves[1:]):
+            raise ValueError("MapaIds com chaves fora de ordem ou repetidas.")
+
+    # Cria o mapa a partir de pares (chave, valor) em qualquer ordem; em chaves repetidas vale a última
+    @classmethod
+    def de_pares(cls, chaves, valores):
+        import numpy as np
+        chaves = np.asarray(chaves, dtype=np.int64)
+        valores = np.asarray(valores, dtype=np.int64)
+        chaves_unicas, indices = np.unique(chaves[::-1], return_index=True)
+        return cls(chaves_unicas, valores[::-1][indices])
+
+    # Abre um mapa gravado com salvar(); com mmap=True os arrays não são lidos para a memória
+    @classmethod
+    def carregar(cls, caminho, mmap=True):
+        import numpy as np
+        dados = np.load(caminho, mmap_mode='r' if mmap else None)
+        mapa = cls.__new__(cls)
+        mapa.chaves, mapa.valores = dados[0], dados[1]
+        mapa._validar()
+        return mapa
+
+    def salvar(self, caminho):
+        import numpy as np
+        os.makedirs(os.path.dirname(caminho) or '.', exist_ok=True)
+        np.save(caminho, np.vstack([self.chaves, self.valores]))
+
+    # Busca vetorizada: devolve um array com o ID de cada chave, ou `padrao` quando não encontrada
+    def buscar(self, chaves, padrao=-1):
+        import numpy as np
+        chaves = np.asarray(chaves, dtype=np.int64)
+        if len(self.chaves) == 0:
+            return np.full(chaves.shape, padrao, dtype=np.int64)
+        posicoes = np.minimum(np.searchsorted(self.chaves, chaves), len(self.chaves) - 1)
+        encontradas = self.chaves[posicoes] == chaves
+        return np.where(encontradas, self.valores[posicoes], padrao)
+
+    def get(self, chave, padrao=None):
+        valor = self.buscar([chave])[0]
+        return padrao if valor == -1 else int(valor)
+
+    def __getitem__(self, chave):
+        valor = self.get(chave)
+        if valor is None:
+            raise KeyError(chave)
+        return valor
+
+    def __contains__(self, chave):
+        return self.get(chave) is not None
+
+    def __len__(self):
+        return len(self.chaves)
+
+    def items(self):
+        return zip(self.chaves.tolist(), self.valores.tolist())
+
+# Envia uma lista de (query, params) ao banco sem esperar a resposta de cada comando, para ser
+# confirmada junto com a transação de quem chamou, que faz o commit de conn dentro do bloco:
+#     with _descarregar_insercoes(pendentes):
+#         conn.commit()
+# No PostgreSQL, com o psycopg 3 instalado, usa uma conexão própria em modo pipeline, cuja transação
+# só é confirmada ao sair do bloco sem erro; se algum comando ou o próprio bloco falhar, ela é
+# desfeita por inteiro. Sem ele, ou no DuckDB, agrupa por query e usa executar_lote na transação de conn
+@contextlib.contextmanager
+def _descarregar_insercoes(pendentes, parametros=None):
+    abrir_conexao()
+    psycopg = None
+    if pendentes and backend.servidor:
+        try:
+            import psycopg
+        except ImportError:
+            pass
+    if psycopg is None:
+        por_query = {}
+        for query, params in pendentes:
+            por_query.setdefault(query, []).append(params)
+        for query, dados in por_query.items():
+            executar_lote(query, dados)
+        pendentes.clear()
+        yield
+        return
+    with psycopg.connect(**(parametros or PARAMETROS_CONEXAO)) as conexao_pipeline:
+        with conexao_pipeline.pipeline(), conexao_pipeline.cursor() as cursor_pipeline:
+            for query, params in pendentes:
+                # psycopg 3 não adapta tipos NumPy; .item() os converte para tipos Python
+                cursor_pipeline.execute(query, tuple(p.item() if hasattr(p, 'item') else p for p in params))
+        pendentes.clear()
+        yield
 
 # Dicionários globais para armazenar IDs
 # Esses dicionários são usados para mapear nomes ou códigos para IDs gerados no banco de dados
+# Os mapas por código (escolas e municípios do censo) usam MapaIds, criados na carga
 regioes_dict = {}
 ufs_dict = {}
 municipios_dict = {}
-escolas_dict = {}
-
-# Função para criar o esquema
-# Cria as tabelas no banco de dados conforme o esquema definido
-def criar_esquema():
-    schema_sql = '''
+escolas_dict = None
+municipios_cod_dict = None
+
+# Pasta onde os mapas de IDs da carga são gravados como .npy
+MAPAS_DIR = os.environ.get('EDUCACAO_MAPAS_DIR', './mapas')
+
+# Normaliza um nome para busca e comparação: sem acentos, em maiúsculas e com espaços simples
+# Ex.: 'São Gabriel da  Cachoeira' -> 'SAO GABRIEL DA CACHOEIRA'
+def _normalizar_nome(nome):
+    if not isinstance(nome, str):
+        return None
+    sem_acentos = ''.join(c for c in unicodedata.normalize('NFKD', nome) if not unicodedata.combining(c))
+    return ' '.join(sem_acentos.upper().split())
+
+# Esquema do banco de dados (dialeto PostgreSQL)
+ESQUEMA_SQL = '''
     -- Define as tabelas do banco de dados, incluindo chaves primárias, estrangeiras e restrições
     -- 1. Tabela Regiao
     CREATE TABLE IF NOT EXISTS "Regiao" (
@@ -50,6 +606,7 @@ def criar_esquema():
     CREATE TABLE IF NOT EXISTS "Municipio" (
         "ID_MUNICIPIO" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
         "NOME_MUNICIPIO" VARCHAR(100) NOT NULL,
+        "NOME_NORMALIZADO" VARCHAR(100),
         "ID_UF" INT NOT NULL,
         "POPULACAO_TOTAL" INT,
         "POPULACAO_INDIGENA" INT,
@@ -60,11 +617,13 @@ def criar_esquema():
     CREATE TABLE IF NOT EXISTS "Escola" (
         "ID_ESCOLA" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
         "NOME_ESCOLA" VARCHAR(100) NOT NULL,
+        "NOME_NORMALIZADO" VARCHAR(100),
         "ID_MUNICIPIO" INT NOT NULL,
         "TIPO_DEPENDENCIA" VARCHAR(20) NOT NULL,
         "TIPO_LOCALIZACAO" VARCHAR(20) NOT NULL,
         "SITUACAO_FUNCIONAMENTO" VARCHAR(20) NOT NULL DEFAULT 'Ativa',
         "INDIGENA" BOOLEAN NOT NULL DEFAULT FALSE,
+        "CO_ENTIDADE" BIGINT,
         FOREIGN KEY ("ID_MUNICIPIO") REFERENCES "Municipio"("ID_MUNICIPIO")
     );
 
@@ -131,288 +690,1077 @@ def criar_esquema():
         CONSTRAINT "check_area" CHECK ("AREA" >= 0),
         CONSTRAINT "check_pop_total" CHECK ("POP_TOTAL" >= 0)
     );
+
+    -- 11. Tabela Geracao_Carga
+    -- Registra cada carga do censo, usada pela exportação incremental
+    CREATE TABLE IF NOT EXISTS "Geracao_Carga" (
+        "ID_GERACAO" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        "ANO_REFERENCIA" INT NOT NULL,
+        "DATA_CARGA" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- 12. Tabela Estado_Carga
+    -- Checkpoint das etapas da carga do censo e dos arquivos .npy com os mapas de IDs que não podem ser reconstruídos do banco
+    -- ARQUIVO (caminho absoluto) e ANO_REFERENCIA identificam o censo da carga, conferidos ao retomá-la
+    CREATE TABLE IF NOT EXISTS "Estado_Carga" (
+        "ETAPA" VARCHAR(30) PRIMARY KEY,
+        "CONCLUIDA_EM" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        "MAPA_IDS" TEXT,
+        "ARQUIVO" TEXT,
+        "ANO_REFERENCIA" INT
+    );
+
+    -- 13. Tabela Cubo_Matricula
+    -- Agregados de matrícula pré-calculados (GROUPING SETS) por região/UF/município, ano, nível,
+    -- dependência e localização. Dimensões nulas significam "todos" e GRUPO é o GROUPING() delas
+    CREATE TABLE IF NOT EXISTS "Cubo_Matricula" (
+        "GRUPO" SMALLINT NOT NULL,
+        "ANO_REFERENCIA" INT NOT NULL,
+        "NOME_REGIAO" VARCHAR(50),
+        "SIGLA_UF" CHAR(2),
+        "ID_MUNICIPIO" INT,
+        "NIVEL_ENSINO" VARCHAR(20),
+        "TIPO_DEPENDENCIA" VARCHAR(20),
+        "TIPO_LOCALIZACAO" VARCHAR(20),
+        "QT_ESCOLAS" INT NOT NULL,
+        "QT_ESCOLAS_INDIGENAS" INT NOT NULL,
+        "QT_MATRICULAS_TOTAL" BIGINT NOT NULL,
+        "QT_MATRICULAS_INDIGENAS" BIGINT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS "idx_cubo_matricula" ON "Cubo_Matricula" ("ANO_REFERENCIA", "GRUPO", "SIGLA_UF");
+
+    -- 14. Tabela Fator_Amostra
+    -- Fatores de expansão da última carga amostrada, por estrato (UF x escola indígena)
+    -- Vazia quando a carga foi feita com o censo completo
+    CREATE TABLE IF NOT EXISTS "Fator_Amostra" (
+        "SIGLA_UF" CHAR(2) NOT NULL,
+        "INDIGENA" BOOLEAN NOT NULL,
+        "QT_ESCOLAS_CENSO" INT NOT NULL,
+        "QT_ESCOLAS_AMOSTRA" INT NOT NULL,
+        "FATOR" DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY ("SIGLA_UF", "INDIGENA")
+    );
+
+    -- 15. Tabela Serie_Matricula
+    -- Série histórica de matrículas por escola (código INEP, estável entre censos) e nível de ensino
+    -- O elemento i dos arrays é o ano ANO_INICIAL_SERIE + i - 1 (NULL = escola fora do censo daquele ano)
+    -- ID_ESCOLA aponta para a escola do ano mais recente em que ela aparece
+    CREATE TABLE IF NOT EXISTS "Serie_Matricula" (
+        "CO_ENTIDADE" BIGINT NOT NULL,
+        "NIVEL_ENSINO" VARCHAR(20) NOT NULL,
+        "ID_ESCOLA" INT,
+        "QT_MATRICULAS_TOTAL" INT[] NOT NULL,
+        "QT_MATRICULAS_INDIGENAS" INT[] NOT NULL,
+        PRIMARY KEY ("CO_ENTIDADE", "NIVEL_ENSINO")
+    );
+    '''
+
+# Índices de trigramas (pg_trgm) sobre os nomes normalizados, usados por buscar_escolas/buscar_municipios
+# Só no PostgreSQL, e separados do esquema principal porque a extensão pode não estar instalada no servidor
+ESQUEMA_BUSCA_SQL = '''
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS "idx_municipio_nome_trgm" ON "Municipio" USING GIN ("NOME_NORMALIZADO" gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS "idx_escola_nome_trgm" ON "Escola" USING GIN ("NOME_NORMALIZADO" gin_trgm_ops);
     '''
+
+# Colunas acrescentadas depois da primeira versão do esquema, que o CREATE TABLE IF NOT EXISTS não
+# cria em um banco já existente: (tabela, coluna, tipo, coluna de origem, chave)
+# NOME_NORMALIZADO é preenchida com _normalizar_nome(coluna de origem); sem coluna de origem, as linhas
+# antigas ficam com NULL (o CO_ENTIDADE das escolas só é gravado pelas cargas seguintes)
+COLUNAS_MIGRADAS = [
+    ('Municipio', 'NOME_NORMALIZADO', 'VARCHAR(100)', 'NOME_MUNICIPIO', 'ID_MUNICIPIO'),
+    ('Escola', 'NOME_NORMALIZADO', 'VARCHAR(100)', 'NOME_ESCOLA', 'ID_ESCOLA'),
+    ('Escola', 'CO_ENTIDADE', 'BIGINT', None, 'ID_ESCOLA'),
+    ('Estado_Carga', 'ARQUIVO', 'TEXT', None, 'ETAPA'),
+    ('Estado_Carga', 'ANO_REFERENCIA', 'INT', None, 'ETAPA')
+]
+
+# Acrescenta as colunas de COLUNAS_MIGRADAS que faltam e preenche as linhas em que estão vazias
+def _migrar_esquema():
+    for tabela, coluna, tipo, origem, chave in COLUNAS_MIGRADAS:
+        cursor.execute(
+            'SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s',
+            (tabela, coluna)
+        )
+        if cursor.fetchone()[0] == 0:
+            print(f"Adicionando a coluna {coluna} em {tabela}")
+            cursor.execute(f'ALTER TABLE "{tabela}" ADD COLUMN "{coluna}" {tipo}')
+        if origem is None:
+            continue
+
+        cursor.execute(f'SELECT "{chave}", "{origem}" FROM "{tabela}" WHERE "{coluna}" IS NULL AND "{origem}" IS NOT NULL')
+        valores = [(id_linha, _normalizar_nome(nome)) for id_linha, nome in cursor.fetchall()]
+        if not valores:
+            continue
+        print(f"Preenchendo {coluna} em {len(valores)} linhas de {tabela}")
+        cursor.execute(backend.tabela_temporaria('migracao_valores', '("ID" INT, "VALOR" VARCHAR(100))'))
+        executar_lote('INSERT INTO migracao_valores ("ID", "VALOR") VALUES (%s, %s)', valores)
+        cursor.execute(
+            f'UPDATE "{tabela}" SET "{coluna}" = v."VALOR" FROM migracao_valores v WHERE "{tabela}"."{chave}" = v."ID"'
+        )
+        cursor.execute('DROP TABLE migracao_valores')
+
+# Função para criar o esquema
+# Cria as tabelas no banco de dados conforme o esquema definido
+def criar_esquema():
+    abrir_conexao()
     try:
-        cursor.execute(schema_sql)
+        for stmt in backend.esquema(ESQUEMA_SQL):
+            cursor.execute(stmt)
+        _migrar_esquema()
         conn.commit()
         print("Esquema criado com sucesso.")
     except Exception as inner_exception:
         # Trata erros e desfaz alterações em caso de falha
-        print(f"Erro ao criar esquema: {e}")
+        print(f"Erro ao criar esquema: {inner_exception}")
         conn.rollback()
+        return
 
-# Função para carregar e processar o CSV do Censo Escolar
-# Lê os dados do arquivo CSV e insere nas tabelas do banco de dados
-def carregar_csv_censo():
-    global regioes_dict, ufs_dict, municipios_dict, escolas_dict
+    if backend.servidor:
+        try:
+            cursor.execute(ESQUEMA_BUSCA_SQL)
+            conn.commit()
+        except Exception as e:
+            print(f"AVISO: índices de busca por trigramas não criados (pg_trgm indisponível?): {e}")
+            conn.rollback()
+
+# Leitor do CSV do censo: 'pandas' (parser C do pandas) ou 'pyarrow' (blocos lidos em paralelo)
+# Sem valor definido, o DuckDB usa o seu read_csv nativo e o PostgreSQL usa o pandas
+LEITOR_CSV = os.environ.get('EDUCACAO_LEITOR_CSV')
+
+# Marcadores de nulo padrão do pd.read_csv (na_values), inclusive o campo vazio
+VALORES_NULOS_PANDAS = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
+
+# Lê o CSV do censo com o leitor CSV do pyarrow, em várias threads e com as colunas de texto
+# codificadas como dicionário durante a leitura. O resultado tem os mesmos dtypes e valores
+# do pd.read_csv (validar_leitor_csv confere isso)
+def _ler_csv_pyarrow(caminho):
+    import pandas as pd
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    opcoes = dict(
+        read_options=pa_csv.ReadOptions(encoding='latin1', use_threads=True),
+        parse_options=pa_csv.ParseOptions(delimiter=';')
+    )
+    # Mesmos marcadores de nulo do pandas, inclusive o campo vazio em colunas de texto
+    conversao = dict(null_values=VALORES_NULOS_PANDAS, strings_can_be_null=True, auto_dict_encode=True)
+
+    # Duas conversões do Arrow não batem com o pandas: ele reconhece datas (o pandas as mantém como
+    # texto) e arredonda decimais corretamente, enquanto o parser padrão do pandas às vezes erra o
+    # último bit. O esquema inferido no primeiro bloco (o mesmo que o read_csv usaria) diz quais são
+    # essas colunas, que são lidas como texto; as decimais são convertidas depois com pd.to_numeric,
+    # que usa o mesmo parser do pd.read_csv
+    leitor = pa_csv.open_csv(caminho, convert_options=pa_csv.ConvertOptions(**conversao), **opcoes)
+    esquema = leitor.schema
+    leitor.close()
+    datas = [campo.name for campo in esquema if pa.types.is_temporal(campo.type)]
+    decimais = [campo.name for campo in esquema if pa.types.is_floating(campo.type)]
+    tabela = pa_csv.read_csv(caminho, convert_options=pa_csv.ConvertOptions(
+        column_types={nome: pa.string() for nome in datas + decimais}, **conversao
+    ), **opcoes)
+
+    colunas = []
+    for campo, coluna in zip(tabela.schema, tabela.columns):
+        if pa.types.is_dictionary(campo.type):
+            coluna = coluna.cast(pa.string())  # texto comum, e não Categorical, como no pandas
+        elif pa.types.is_null(campo.type):
+            coluna = coluna.cast(pa.float64())  # colunas totalmente vazias viram NaN no pandas
+        colunas.append(coluna)
+    df = pa.table(colunas, names=tabela.column_names).to_pandas()
+    for nome in decimais:
+        df[nome] = pd.to_numeric(df[nome])
+    return df
+
+# Lê o CSV do censo com o leitor escolhido
+def _ler_csv(caminho, leitor):
+    import pandas as pd
+    if leitor == 'pyarrow':
+        return _ler_csv_pyarrow(caminho)
+    if leitor != 'pandas':
+        raise ValueError(f"Leitor de CSV desconhecido: {leitor}. Use 'pandas' ou 'pyarrow'.")
+    return pd.read_csv(caminho, sep=';', low_memory=False, encoding='latin1')
+
+# Confere se o leitor alternativo produz exatamente o mesmo DataFrame que o pd.read_csv
+# (mesmas colunas, dtypes e hash de cada linha) e mostra o tempo de cada um
+def validar_leitor_csv(caminho, leitor='pyarrow'):
+    import pandas as pd
+    inicio = time.perf_counter()
+    referencia = _ler_csv(caminho, 'pandas')
+    tempo_referencia = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    candidato = _ler_csv(caminho, leitor)
+    tempo_candidato = time.perf_counter() - inicio
+    print(f"pandas: {tempo_referencia:.2f}s, {leitor}: {tempo_candidato:.2f}s")
+
+    if list(referencia.columns) != list(candidato.columns):
+        print(f"Colunas diferentes entre pandas e {leitor}.")
+        return False
+    tipos = [c for c in referencia.columns if referencia[c].dtype != candidato[c].dtype]
+    if tipos:
+        print(f"Dtypes diferentes em: {', '.join(f'{c} ({referencia[c].dtype} x {candidato[c].dtype})' for c in tipos)}")
+        return False
+    linhas = pd.util.hash_pandas_object(referencia, index=True) != pd.util.hash_pandas_object(candidato, index=True)
+    if linhas.any():
+        print(f"{int(linhas.sum())} linhas diferentes, a primeira no índice {linhas.idxmax()}.")
+        return False
+    print(f"Leitor {leitor} idêntico ao pandas ({len(referencia)} linhas, {len(referencia.columns)} colunas).")
+    return True
+
+# Lê os microdados do censo como DataFrame
+# No DuckDB usa os leitores vetorizados nativos (read_csv/read_parquet), a menos que um leitor de
+# CSV seja escolhido; caso contrário, o leitor de LEITOR_CSV (padrão: pandas)
+def ler_censo(caminho, leitor=None):
+    import pandas as pd
+    leitor = leitor or LEITOR_CSV
+    if leitor is None:
+        df = backend.ler_censo(conn, caminho)
+        if df is not None:
+            return df
+    if caminho.endswith('.parquet'):
+        return pd.read_parquet(caminho)
+    return _ler_csv(caminho, leitor or 'pandas')
+
+# Linhas do CSV lidas por vez na carga amostrada
+AMOSTRA_CHUNKSIZE = 100_000
+
+# Sorteio determinístico em [0, 1) a partir do código da escola (mistura splitmix64)
+# O mesmo código e a mesma semente sempre dão o mesmo valor, independente da ordem das linhas
+def _sorteio_estavel(codigos, semente):
+    import numpy as np
+    with np.errstate(over='ignore'):
+        x = codigos.astype(np.uint64) + np.uint64(semente) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+# Lê o censo em blocos e mantém uma amostra estratificada por SG_UF x IN_EDUCACAO_INDIGENA
+# Em cada estrato ficam as escolas com sorteio < fracao (e ao menos uma, a de menor sorteio)
+# Com manter_indigenas=True, todas as escolas com educação indígena são mantidas
+# Os fatores de expansão de cada estrato (SIGLA_UF, INDIGENA, censo, amostra, fator) ficam em
+# df.attrs['fatores_amostra'] e são gravados em Fator_Amostra pela etapa 'amostra'
+# A leitura em blocos é sempre feita pelo pd.read_csv, também no DuckDB: os outros leitores
+# (pyarrow, read_csv do DuckDB) leem o arquivo inteiro de uma vez, o que a amostra quer evitar
+def ler_censo_amostrado(caminho, fracao, manter_indigenas=False, semente=0):
+    import pandas as pd
+    if not 0 < fracao <= 1:
+        raise ValueError(f"Fração de amostragem inválida: {fracao}. Use um valor em (0, 1].")
+    if caminho.endswith('.parquet'):
+        blocos = [pd.read_parquet(caminho)]
+    else:
+        blocos = pd.read_csv(caminho, sep=';', low_memory=False, encoding='latin1', chunksize=AMOSTRA_CHUNKSIZE)
+
+    amostras = []
+    contagens = {}   # (SG_UF, indígena) -> [escolas no censo, escolas na amostra]
+    reservas = {}    # (SG_UF, indígena) -> (sorteio, linha) da escola de menor sorteio
+    for bloco in blocos:
+        indigena = bloco['IN_EDUCACAO_INDIGENA'].fillna(0).astype(bool)
+        sorteio = pd.Series(_sorteio_estavel(bloco['CO_ENTIDADE'].to_numpy(), semente), index=bloco.index)
+        manter = sorteio < fracao
+        if manter_indigenas:
+            manter |= indigena
+        estratos = pd.DataFrame({'SG_UF': bloco['SG_UF'], 'INDIGENA': indigena, 'MANTER': manter, 'SORTEIO': sorteio})
+        for (uf, ind), grupo in estratos.groupby(['SG_UF', 'INDIGENA']):
+            contagem = contagens.setdefault((uf, bool(ind)), [0, 0])
+            contagem[0] += len(grupo)
+            contagem[1] += int(grupo['MANTER'].sum())
+            menor = grupo['SORTEIO'].idxmin()
+            if (uf, bool(ind)) not in reservas or grupo['SORTEIO'][menor] < reservas[(uf, bool(ind))][0]:
+                reservas[(uf, bool(ind))] = (grupo['SORTEIO'][menor], bloco.loc[[menor]])
+        amostras.append(bloco[manter])
+
+    # Estratos sem nenhuma escola sorteada recebem a de menor sorteio, para que todos sejam representados
+    for estrato, (_, linha) in reservas.items():
+        if contagens[estrato][1] == 0:
+            amostras.append(linha)
+            contagens[estrato][1] = 1
+
+    df = pd.concat(amostras, ignore_index=True)
+    df.attrs['fatores_amostra'] = [
+        (uf, indigena, censo, amostra, censo / amostra)
+        for (uf, indigena), (censo, amostra) in sorted(contagens.items())
+    ]
+    print(f"Amostra com {len(df)} de {sum(c[0] for c in contagens.values())} escolas ({len(contagens)} estratos)")
+    return df
+
+# Erro relativo máximo tolerado nos totais estimados pela amostra (ver validar_amostra)
+LIMITE_ERRO_AMOSTRA = 0.02
+
+# Confere se a amostra estima bem o censo completo: multiplica cada escola da amostra pelo fator do seu
+# estrato e compara os totais de escolas, QT_MAT_BAS e QT_MAT_BAS_INDIGENA com os do arquivo inteiro
+def validar_amostra(caminho, fracao=0.05, manter_indigenas=False, semente=0, limite=LIMITE_ERRO_AMOSTRA):
+    import pandas as pd
+    censo = _ler_csv(caminho, 'pandas')
+    amostra = ler_censo_amostrado(caminho, fracao, manter_indigenas, semente)
+    fatores = pd.DataFrame(amostra.attrs['fatores_amostra'], columns=['SG_UF', 'INDIGENA', 'CENSO', 'AMOSTRA', 'FATOR'])
+    amostra = amostra.assign(INDIGENA=amostra['IN_EDUCACAO_INDIGENA'].fillna(0).astype(bool))
+    peso = amostra.merge(fatores, on=['SG_UF', 'INDIGENA'], how='left')['FATOR'].to_numpy()
+
+    valido = True
+    for medida in ['ESCOLAS', 'QT_MAT_BAS', 'QT_MAT_BAS_INDIGENA']:
+        if medida == 'ESCOLAS':
+            real, estimado = len(censo), peso.sum()
+        else:
+            real = pd.to_numeric(censo[medida], errors='coerce').fillna(0).sum()
+            estimado = (pd.to_numeric(amostra[medida], errors='coerce').fillna(0).to_numpy() * peso).sum()
+        erro = abs(estimado - real) / real if real else 0.0
+        print(f"{medida}: censo {real:,.0f}, estimado pela amostra {estimado:,.0f} (erro {erro:.2%})")
+        if erro > limite:
+            valido = False
+    if valido:
+        print(f"Amostra de {fracao:.0%} dentro do limite de {limite:.0%} em todos os totais.")
+    else:
+        print(f"Amostra de {fracao:.0%} com erro acima do limite de {limite:.0%}.")
+    return valido
+
+# Tratamento inicial do censo: valores nulos e mapeamento dos códigos do INEP
+def _preparar_censo(df):
+    # Tratar valores nulos e ajustar tipos de dados
+    df.fillna({
+        'QT_MAT_BAS': 0, 'QT_MAT_BAS_INDIGENA': 0, 'IN_EDUCACAO_INDIGENA': 0,
+        'TP_DEPENDENCIA': '4', 'TP_LOCALIZACAO': '1', 'TP_SITUACAO_FUNCIONAMENTO': '1',
+        'QT_TUR_INF': 0, 'QT_TUR_FUND': 0, 'QT_TUR_MED': 0, 'QT_TUR_EJA': 0,
+        'IN_INF': 0, 'IN_FUND_AI': 0, 'IN_FUND_AF': 0, 'IN_MED': 0, 'IN_EJA': 0
+    }, inplace=True)
+    df['IN_EDUCACAO_INDIGENA'] = df['IN_EDUCACAO_INDIGENA'].astype(bool)
+
+    # Mapear valores
+    df['TP_DEPENDENCIA'] = df['TP_DEPENDENCIA'].map({1: 'Federal', 2: 'Estadual', 3: 'Municipal', 4: 'Privada'})
+    df['TP_LOCALIZACAO'] = df['TP_LOCALIZACAO'].map({1: 'Urbana', 2: 'Rural'})
+    df['TP_SITUACAO_FUNCIONAMENTO'] = df['TP_SITUACAO_FUNCIONAMENTO'].map({1: 'Ativa', 2: 'Inativa'})
+
+# Verdadeiro se o censo da carga é do ano mais recente já carregado (ou de um ano posterior)
+# Só essas cargas atualizam os atributos e POPULACAO_* (etapa cubo) das dimensões e as turmas das escolas; a carga
+# de um ano anterior só acrescenta as regiões, UFs, municípios e escolas que ainda não estão no banco
+def _carga_mais_recente(df):
+    cursor.execute('SELECT MAX("ANO_REFERENCIA") FROM "Geracao_Carga"')
+    ano_mais_recente = cursor.fetchone()[0]
+    return ano_mais_recente is None or int(df['NU_ANO_CENSO'].max()) >= ano_mais_recente
+
+# Grava as linhas de uma dimensão pela sua chave natural, para que cargas de anos diferentes
+# compartilhem as mesmas linhas (e IDs): insere as que não existem e, com atualizar=True, atualiza as
+# demais colunas das que já existem. As linhas passam por uma tabela temporária, como em _gravar_ano_serie
+# No DuckDB as chaves estrangeiras (ID_*) não são atualizadas (ver backend.upsert)
+# Com `mapa`, executa essa consulta (que pode usar a tabela temporária, `dimensao`) e devolve as linhas
+def _gravar_dimensao(tabela, chave, colunas, dados, atualizar, mapa=None):
+    lista = ', '.join(f'"{coluna}"' for coluna in colunas)
+    cursor.execute(backend.tabela_temporaria('dimensao', f'AS SELECT {lista} FROM "{tabela}" LIMIT 0'))
+    executar_lote(f'INSERT INTO dimensao ({lista}) VALUES ({", ".join(["%s"] * len(colunas))})', dados)
+    for comando in backend.upsert(tabela, 'dimensao', chave, colunas, atualizar):
+        cursor.execute(comando)
+    linhas = None
+    if mapa is not None:
+        cursor.execute(mapa)
+        linhas = cursor.fetchall()
+    cursor.execute('DROP TABLE dimensao')
+    return linhas
+
+# Etapa 1: Regiao
+# POPULACAO_* das regiões, UFs e municípios vem do cubo (ver atualizar_populacao)
+def _etapa_regiao(df):
+    regioes_data = [(regiao,) for regiao in df['NO_REGIAO'].dropna().unique().tolist()]
+    _gravar_dimensao('Regiao', ['NOME_REGIAO'], ['NOME_REGIAO'], regioes_data, _carga_mais_recente(df))
+
+    # Em bancos com linhas repetidas de cargas antigas, vale a de menor ID
+    cursor.execute('SELECT "NOME_REGIAO", "ID_REGIAO" FROM "Regiao" ORDER BY "ID_REGIAO" DESC')
+    regioes_dict.clear()
+    regioes_dict.update(cursor.fetchall())
+
+# Etapa 2: Unidade_Federativa
+def _etapa_unidade_federativa(df):
+    ufs = df[['SG_UF', 'NO_UF', 'NO_REGIAO']].dropna().drop_duplicates()
+    ufs_data = [
+        (row['NO_UF'], row['SG_UF'], regioes_dict.get(row['NO_REGIAO'], None))
+        for _, row in ufs.iterrows() if row['NO_REGIAO'] in regioes_dict
+    ]
+    _gravar_dimensao(
+        'Unidade_Federativa', ['SIGLA_UF'], ['NOME_UF', 'SIGLA_UF', 'ID_REGIAO'], ufs_data, _carga_mais_recente(df)
+    )
+    cursor.execute('SELECT "SIGLA_UF", "ID_UF" FROM "Unidade_Federativa" ORDER BY "ID_UF" DESC')
+    ufs_dict.clear()
+    ufs_dict.update(cursor.fetchall())
+
+# Etapa 3: Municipio (devolve o mapa CO_MUNICIPIO -> ID_MUNICIPIO, que não pode ser reconstruído do banco)
+def _etapa_municipio(df):
+    global municipios_cod_dict
+    cursor.execute(backend.tabela_temporaria('temp_csv', '("NO_MUNICIPIO" VARCHAR(100), "SG_UF" CHAR(2), "CO_MUNICIPIO" INT)'))
+
+    municipios_csv = df[['NO_MUNICIPIO', 'SG_UF', 'CO_MUNICIPIO']].drop_duplicates()
+    executar_lote(
+        'INSERT INTO temp_csv ("NO_MUNICIPIO", "SG_UF", "CO_MUNICIPIO") VALUES (%s, %s, %s)',
+        [(row['NO_MUNICIPIO'], row['SG_UF'], row['CO_MUNICIPIO']) for _, row in municipios_csv.iterrows()]
+    )
+
+
+    # Verifique se a tabela foi criada corretamente
+    cursor.execute('SELECT COUNT(*) FROM temp_csv')
+    print(f"Tabela temporária criada com {cursor.fetchone()[0]} registros")
+
+    municipios_data = [
+        (row['NO_MUNICIPIO'], _normalizar_nome(row['NO_MUNICIPIO']), ufs_dict.get(row['SG_UF'], None))
+        for _, row in municipios_csv.dropna().iterrows() if row['SG_UF'] in ufs_dict
+    ]
+    # O censo não grava CO_MUNICIPIO em Municipio: a chave natural é o nome dentro da UF
+    _gravar_dimensao(
+        'Municipio', ['NOME_MUNICIPIO', 'ID_UF'], ['NOME_MUNICIPIO', 'NOME_NORMALIZADO', 'ID_UF'],
+        municipios_data, _carga_mais_recente(df)
+    )
+
+
+    # Dicionários de mapeamento
+    # Dicionário principal (nome -> ID)
+    cursor.execute('SELECT "NOME_MUNICIPIO", "ID_MUNICIPIO" FROM "Municipio" ORDER BY "ID_MUNICIPIO" DESC')
+    municipios_dict.clear()
+    municipios_dict.update(cursor.fetchall())
+
+    # Dicionário auxiliar (CO_MUNICIPIO -> ID_MUNICIPIO)
+
+    # Primeiro, verifique a estrutura dos resultados
+    # Municípios homônimos de UFs diferentes são separados pela sigla; em linhas repetidas de cargas
+    # antigas vale a de menor ID (a última em de_pares)
+    cursor.execute('''
+        SELECT m."NOME_MUNICIPIO", m."ID_MUNICIPIO", c."CO_MUNICIPIO" 
+        FROM "Municipio" m
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        JOIN temp_csv c ON m."NOME_MUNICIPIO" = c."NO_MUNICIPIO" AND uf."SIGLA_UF" = c."SG_UF"
+        ORDER BY m."ID_MUNICIPIO" DESC
+    ''')
+    resultados = cursor.fetchall()
 
+    # Debug: verifique a estrutura
+    if resultados:
+        print("Exemplo de linha do resultado:", resultados[0])
+        print("Tipo da linha:", type(resultados[0]))
 
-    print("Carregando CSV do Censo Escolar...")
+    # Crie o mapa conforme a estrutura adequada
     try:
-        # Lê o arquivo CSV com os dados do censo escolar
-        df = pd.read_csv('./datasets/microdados_ed_basica_2023.csv', sep=';', low_memory=False, encoding='latin1')
-        if df.empty:
-            raise ValueError("CSV inválido! O arquivo está vazio ou não contém dados válidos.")
-
-        # Tratar valores nulos e ajustar tipos de dados
-        df.fillna({
-            'QT_MAT_BAS': 0, 'QT_MAT_BAS_INDIGENA': 0, 'IN_EDUCACAO_INDIGENA': 0,
-            'TP_DEPENDENCIA': '4', 'TP_LOCALIZACAO': '1', 'TP_SITUACAO_FUNCIONAMENTO': '1',
-            'QT_TUR_INF': 0, 'QT_TUR_FUND': 0, 'QT_TUR_MED': 0, 'QT_TUR_EJA': 0,
-            'IN_INF': 0, 'IN_FUND_AI': 0, 'IN_FUND_AF': 0, 'IN_MED': 0, 'IN_EJA': 0
-        }, inplace=True)
-        df['IN_EDUCACAO_INDIGENA'] = df['IN_EDUCACAO_INDIGENA'].astype(bool)
-
-        # Mapear valores
-        df['TP_DEPENDENCIA'] = df['TP_DEPENDENCIA'].map({1: 'Federal', 2: 'Estadual', 3: 'Municipal', 4: 'Privada'})
-        df['TP_LOCALIZACAO'] = df['TP_LOCALIZACAO'].map({1: 'Urbana', 2: 'Rural'})
-        df['TP_SITUACAO_FUNCIONAMENTO'] = df['TP_SITUACAO_FUNCIONAMENTO'].map({1: 'Ativa', 2: 'Inativa'})
-
-        # Inserir dados em lote
-        def insert_batch(query, data):
-            psycopg2.extras.execute_batch(cursor, query, data)
-
-        cursor.execute('CREATE TEMP TABLE temp_csv ("NO_MUNICIPIO" VARCHAR(100), "CO_MUNICIPIO" INT) ON COMMIT DROP')
-
-        municipios_csv = df[['NO_MUNICIPIO', 'CO_MUNICIPIO']].drop_duplicates()
-        psycopg2.extras.execute_batch(cursor,
-            'INSERT INTO temp_csv ("NO_MUNICIPIO", "CO_MUNICIPIO") VALUES (%s, %s)',
-            [(row['NO_MUNICIPIO'], row['CO_MUNICIPIO']) for _, row in municipios_csv.iterrows()]
+        if resultados and isinstance(resultados[0], (list, tuple)):
+            municipios_cod_dict = MapaIds.de_pares([row[2] for row in resultados], [row[1] for row in resultados])
+        elif resultados and isinstance(resultados[0], dict):
+            municipios_cod_dict = MapaIds.de_pares([row['CO_MUNICIPIO'] for row in resultados], [row['ID_MUNICIPIO'] for row in resultados])
+        else:
+            print("Formato de resultados não reconhecido")
+            municipios_cod_dict = MapaIds()
+    except Exception as e:
+        print(f"Erro ao criar dicionário: {e}")
+        municipios_cod_dict = MapaIds()
+
+    print(f"Dicionário criado com {len(municipios_cod_dict)} entradas")
+    return municipios_cod_dict
+
+# Etapa 4: Escola (devolve o mapa CO_ENTIDADE -> ID_ESCOLA)
+def _etapa_escola(df):
+    global escolas_dict
+    escolas = df[['CO_ENTIDADE', 'NO_ENTIDADE', 'CO_MUNICIPIO', 'TP_DEPENDENCIA', 
+                'TP_LOCALIZACAO', 'TP_SITUACAO_FUNCIONAMENTO', 'IN_EDUCACAO_INDIGENA']].drop_duplicates(subset=['CO_ENTIDADE'])
+
+    # Escolas sem os campos obrigatórios são descartadas antes do INSERT, para que um erro
+    # no banco faça a etapa inteira falhar (e possa ser retomada) em vez de ser engolido
+    obrigatorios = ['NO_ENTIDADE', 'TP_DEPENDENCIA', 'TP_LOCALIZACAO', 'TP_SITUACAO_FUNCIONAMENTO']
+    invalidas = escolas[obrigatorios].isna().any(axis=1)
+    if invalidas.any():
+        print(f"AVISO: {int(invalidas.sum())} escolas ignoradas por campos obrigatórios ausentes")
+        escolas = escolas[~invalidas]
+
+    # Busca em lote do ID_MUNICIPIO de todas as escolas
+    escolas = escolas.assign(ID_MUNICIPIO=municipios_cod_dict.buscar(escolas['CO_MUNICIPIO'].to_numpy()))
+    failed_escolas = escolas[escolas['ID_MUNICIPIO'] == -1]
+    for _, row in failed_escolas.iterrows():
+        print(f"AVISO: Município não encontrado para CO_MUNICIPIO: {row['CO_MUNICIPIO']} (Escola: {row['NO_ENTIDADE']})")
+    escolas = escolas[escolas['ID_MUNICIPIO'] != -1]
+    escolas_data = list(zip(
+        escolas['NO_ENTIDADE'],
+        escolas['NO_ENTIDADE'].map(_normalizar_nome),
+        escolas['ID_MUNICIPIO'].astype(int).tolist(),
+        escolas['TP_DEPENDENCIA'],
+        escolas['TP_LOCALIZACAO'],
+        escolas['TP_SITUACAO_FUNCIONAMENTO'],
+        escolas['IN_EDUCACAO_INDIGENA'].astype(bool).tolist(),
+        escolas['CO_ENTIDADE'].astype(int).tolist()
+    ))
+
+    print(f"Total de escolas a gravar: {len(escolas_data)}")
+    print(f"Escolas ignoradas devido a município inválido: {len(failed_escolas)}")
+
+    if escolas_data:
+        print(f"Preparando para gravar {len(escolas_data)} escolas no banco de dados.")
+        # A escola é identificada pelo CO_ENTIDADE, estável entre censos; em linhas repetidas de
+        # cargas antigas vale a de menor ID
+        ids_escola = _gravar_dimensao(
+            'Escola', ['CO_ENTIDADE'],
+            ['NOME_ESCOLA', 'NOME_NORMALIZADO', 'ID_MUNICIPIO', 'TIPO_DEPENDENCIA', 'TIPO_LOCALIZACAO', 'SITUACAO_FUNCIONAMENTO', 'INDIGENA', 'CO_ENTIDADE'],
+            escolas_data, _carga_mais_recente(df),
+            mapa='''
+                SELECT e."CO_ENTIDADE", MIN(e."ID_ESCOLA") FROM "Escola" e
+                WHERE e."CO_ENTIDADE" IN (SELECT "CO_ENTIDADE" FROM dimensao)
+                GROUP BY e."CO_ENTIDADE"
+            '''
         )
-
-
-        # Verifique se a tabela foi criada corretamente
-        cursor.execute('SELECT COUNT(*) FROM temp_csv')
-        print(f"Tabela temporária criada com {cursor.fetchone()[0]} registros")
-
-        # 1. Regiao
-        regioes = df.groupby('NO_REGIAO').agg({'QT_MAT_BAS': 'sum', 'QT_MAT_BAS_INDIGENA': 'sum'}).reset_index()
-        regioes_data = [
-            (row['NO_REGIAO'], int(row['QT_MAT_BAS']), int(row['QT_MAT_BAS_INDIGENA']))
-            for _, row in regioes.iterrows()
-        ]
-        insert_batch(
-            'INSERT INTO "Regiao" ("NOME_REGIAO", "POPULACAO_TOTAL", "POPULACAO_INDIGENA") VALUES (%s, %s, %s) RETURNING "ID_REGIAO"',
-            regioes_data
+        escolas_dict = MapaIds.de_pares([co for co, _ in ids_escola], [id_escola for _, id_escola in ids_escola])
+        print(f"Dicionário de escolas atualizado com {len(escolas_dict)} entradas.")
+    else:
+        escolas_dict = MapaIds()
+        print("Nenhuma escola para inserir - verifique os logs acima.")
+    return escolas_dict
+
+# Etapa 5: Turma
+# Turma não tem ano: as turmas de cada escola são as da carga mais recente (ver _carga_mais_recente),
+# que substitui as que a escola já tinha
+def _etapa_turma(df):
+    import pandas as pd
+    niveis_ensino = ['Infantil', 'Fundamental', 'Médio', 'EJA']
+    turmas_columns = {
+        'Infantil': 'QT_TUR_INF',
+        'Fundamental': 'QT_TUR_FUND',
+        'Médio': 'QT_TUR_MED',
+        'EJA': 'QT_TUR_EJA'
+    }
+    turmas_data = []
+    print(f"Total de escolas no dicionário: {len(escolas_dict)}")
+    if not escolas_dict:
+        print("AVISO: Dicionário de escolas vazio - não é possível inserir turmas")
+    elif not _carga_mais_recente(df):
+        print("AVISO: Censo anterior ao mais recente já carregado - Turma não foi alterada.")
+    else:
+        # Primeira linha de cada escola, com o ID_ESCOLA buscado em lote no mapa
+        # Só as colunas usadas são copiadas, e não o DataFrame inteiro do censo
+        colunas = ['CO_ENTIDADE', 'IN_EDUCACAO_INDIGENA'] + [col for col in turmas_columns.values() if col in df.columns]
+        escolas = df[colunas].drop_duplicates(subset=['CO_ENTIDADE'])
+        escolas = escolas.assign(ID_ESCOLA=escolas_dict.buscar(escolas['CO_ENTIDADE'].to_numpy()))
+        escolas = escolas[escolas['ID_ESCOLA'] != -1]
+        cursor.execute(backend.tabela_temporaria('turma_escolas', '("ID_ESCOLA" INT)'))
+        executar_lote('INSERT INTO turma_escolas ("ID_ESCOLA") VALUES (%s)', [(id_escola,) for id_escola in escolas['ID_ESCOLA'].astype(int).tolist()])
+        cursor.execute('DELETE FROM "Turma" WHERE "ID_ESCOLA" IN (SELECT "ID_ESCOLA" FROM turma_escolas)')
+        cursor.execute('DROP TABLE turma_escolas')
+        for nivel in niveis_ensino:
+            col_name = turmas_columns.get(nivel)
+            if col_name not in df.columns:
+                print(f"ERRO: Coluna {col_name} não encontrada no CSV. Pulando {nivel}")
+                continue
+            qt_turmas = pd.to_numeric(escolas[col_name], errors='coerce').fillna(0).astype(int)
+            qt_turmas_indigenas = qt_turmas.where(escolas['IN_EDUCACAO_INDIGENA'].astype(bool), 0)
+            com_turmas = qt_turmas > 0
+            turmas_data.extend(zip(
+                escolas.loc[com_turmas, 'ID_ESCOLA'].astype(int).tolist(),
+                [nivel] * int(com_turmas.sum()),
+                qt_turmas[com_turmas].tolist(),
+                qt_turmas_indigenas[com_turmas].tolist()
+            ))
+        if turmas_data:
+            print(f"Inserindo {len(turmas_data)} registros em Turma")
+            executar_lote(
+                'INSERT INTO "Turma" ("ID_ESCOLA", "NIVEL_ENSINO", "QT_TURMAS", "QT_TURMAS_INDIGENAS") VALUES (%s, %s, %s, %s)',
+                turmas_data
+            )
+            cursor.execute('SELECT COUNT(*) FROM "Turma"')
+            print(f"Total de registros inseridos em Turma: {cursor.fetchone()[0]}")
+        else:
+            print("AVISO: Nenhum dado de turmas para inserir. Verifique se QT_TUR_* contém valores maiores que 0.")
+
+# Colunas de matrícula (total, indígena) de cada nível de ensino no CSV do censo
+COLUNAS_MATRICULA = {
+    'Infantil': ('QT_MAT_INF', 'QT_MAT_INF_INDIGENA'),
+    'Fundamental': ('QT_MAT_FUND', 'QT_MAT_FUND_INDIGENA'),
+    'Médio': ('QT_MAT_MED', 'QT_MAT_MED_INDIGENA'),
+    'EJA': ('QT_MAT_EJA', 'QT_MAT_EJA_INDIGENA')
+}
+
+# Matrículas do censo em formato longo: uma linha por escola/ano/nível com CO_ENTIDADE, NU_ANO_CENSO,
+# NIVEL_ENSINO, QT_MATRICULAS_TOTAL e QT_MATRICULAS_INDIGENAS (inteiros, 0 quando ausentes)
+# Cada nível de ensino tem suas próprias colunas de matrícula no censo, então
+# geramos uma linha por escola/nível com os totais daquele nível (melt vetorizado)
+# em vez de repetir QT_MAT_BAS em todos os níveis ativos da escola.
+def _matriculas_por_nivel(df):
+    import pandas as pd
+    for col_total, col_indigena in COLUNAS_MATRICULA.values():
+        for col_name in (col_total, col_indigena):
+            if col_name not in df.columns:
+                print(f"AVISO: Coluna {col_name} não encontrada no CSV. Considerando 0 matrículas.")
+                df[col_name] = 0
+
+    colunas_total = {col_total: nivel for nivel, (col_total, _) in COLUNAS_MATRICULA.items()}
+    colunas_indigena = {col_indigena: nivel for nivel, (_, col_indigena) in COLUNAS_MATRICULA.items()}
+    matriculas = df[['CO_ENTIDADE', 'NU_ANO_CENSO'] + list(colunas_total) + list(colunas_indigena)]
+    matriculas = matriculas.drop_duplicates(subset=['CO_ENTIDADE', 'NU_ANO_CENSO'])
+
+    mat_total = matriculas.melt(
+        id_vars=['CO_ENTIDADE', 'NU_ANO_CENSO'], value_vars=list(colunas_total),
+        var_name='NIVEL_ENSINO', value_name='QT_MATRICULAS_TOTAL'
+    )
+    mat_total['NIVEL_ENSINO'] = mat_total['NIVEL_ENSINO'].map(colunas_total)
+    mat_indigena = matriculas.melt(
+        id_vars=['CO_ENTIDADE', 'NU_ANO_CENSO'], value_vars=list(colunas_indigena),
+        var_name='NIVEL_ENSINO', value_name='QT_MATRICULAS_INDIGENAS'
+    )
+    mat_indigena['NIVEL_ENSINO'] = mat_indigena['NIVEL_ENSINO'].map(colunas_indigena)
+    matriculas_long = mat_total.merge(mat_indigena, on=['CO_ENTIDADE', 'NU_ANO_CENSO', 'NIVEL_ENSINO'])
+    del matriculas, mat_total, mat_indigena  # libera os intermediários antes de converter
+
+    matriculas_long[['QT_MATRICULAS_TOTAL', 'QT_MATRICULAS_INDIGENAS']] = (
+        matriculas_long[['QT_MATRICULAS_TOTAL', 'QT_MATRICULAS_INDIGENAS']]
+        .apply(pd.to_numeric, errors='coerce').fillna(0).astype(int)
+    )
+    return matriculas_long
+
+# Etapa 6: Matricula
+# Substitui as matrículas dos anos do censo carregado, como o cubo e a série fazem ao recarregar um ano
+def _etapa_matricula(df):
+    print(f"Total de escolas no dicionário: {len(escolas_dict)}")
+    if not escolas_dict:
+        print("AVISO: Dicionário de escolas vazio - não é possível inserir matrículas")
+    else:
+        matriculas_long = _matriculas_por_nivel(df)
+        matriculas_long['ID_ESCOLA'] = escolas_dict.buscar(matriculas_long['CO_ENTIDADE'].to_numpy())
+
+        sem_escola = matriculas_long['ID_ESCOLA'] == -1
+        if sem_escola.any():
+            print(f"AVISO: {matriculas_long.loc[sem_escola, 'CO_ENTIDADE'].nunique()} escolas não encontradas em escolas_dict")
+        matriculas_long = matriculas_long[~sem_escola & (matriculas_long['QT_MATRICULAS_TOTAL'] > 0)]
+        for ano in df['NU_ANO_CENSO'].dropna().unique():
+            cursor.execute('DELETE FROM "Matricula" WHERE "ANO_REFERENCIA" = %s', (int(ano),))
+
+        matriculas_data = list(zip(
+            matriculas_long['ID_ESCOLA'].astype(int).tolist(),
+            matriculas_long['NIVEL_ENSINO'].tolist(),
+            matriculas_long['QT_MATRICULAS_TOTAL'].tolist(),
+            matriculas_long['QT_MATRICULAS_INDIGENAS'].tolist(),
+            matriculas_long['NU_ANO_CENSO'].astype(int).tolist()
+        ))
+        del matriculas_long
+        if matriculas_data:
+            print(f"Inserindo {len(matriculas_data)} registros em Matricula")
+            executar_lote(
+                'INSERT INTO "Matricula" ("ID_ESCOLA", "NIVEL_ENSINO", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS", "ANO_REFERENCIA") VALUES (%s, %s, %s, %s, %s)',
+                matriculas_data
+            )
+            cursor.execute('SELECT COUNT(*) FROM "Matricula"')
+            print(f"Total de registros inseridos em Matricula: {cursor.fetchone()[0]}")
+        else:
+            print("AVISO: Nenhum dado de matrículas para inserir. Verifique se as colunas QT_MAT_* por nível contêm valores maiores que 0.")
+
+# Etapa 7: Territorio_Indigena (só os territórios que ainda não estão no banco)
+def _etapa_territorio(df):
+    cursor.execute('SELECT "ID_UF", "NOME_TERRITORIO" FROM "Territorio_Indigena"')
+    existentes = set(cursor.fetchall())
+    territorios = df[df['TP_LOCALIZACAO_DIFERENCIADA'] == 1][['SG_UF', 'NO_MUNICIPIO']].drop_duplicates()
+    for _, row in territorios.iterrows():
+        if row['SG_UF'] in ufs_dict:
+            id_uf = ufs_dict[row['SG_UF']]
+            nome_territorio = f"Território Indígena {row['NO_MUNICIPIO']}"
+            if (id_uf, nome_territorio) in existentes:
+                continue
+            cursor.execute(
+                'INSERT INTO "Territorio_Indigena" ("ID_UF", "NOME_TERRITORIO", "ETNIA_DOMINANTE", "AREA", "POP_TOTAL") VALUES (%s, %s, %s, %s, %s)',
+                (id_uf, nome_territorio, None, None, None)
+            )
+
+# Etapa 8: Geracao_Carga
+def _etapa_geracao(df):
+    for ano in df['NU_ANO_CENSO'].dropna().unique():
+        cursor.execute('INSERT INTO "Geracao_Carga" ("ANO_REFERENCIA") VALUES (%s)', (int(ano),))
+
+# Etapa 7b: Fator_Amostra (vazia quando a carga usa o censo completo)
+def _etapa_amostra(df):
+    cursor.execute('DELETE FROM "Fator_Amostra"')
+    fatores = df.attrs.get('fatores_amostra')
+    if fatores:
+        executar_lote(
+            'INSERT INTO "Fator_Amostra" ("SIGLA_UF", "INDIGENA", "QT_ESCOLAS_CENSO", "QT_ESCOLAS_AMOSTRA", "FATOR") VALUES (%s, %s, %s, %s, %s)',
+            fatores
         )
 
-        cursor.execute('SELECT "NOME_REGIAO", "ID_REGIAO" FROM "Regiao"')
-        regioes_dict = {nome: id_regiao for nome, id_regiao in cursor.fetchall()}
+# Dimensões do cubo na ordem do GROUPING(): o bit 5 é a região e o bit 0 a localização
+DIMENSOES_CUBO = ['NOME_REGIAO', 'SIGLA_UF', 'ID_MUNICIPIO', 'NIVEL_ENSINO', 'TIPO_DEPENDENCIA', 'TIPO_LOCALIZACAO']
+
+# GRUPO das linhas do cubo em que só as dimensões informadas não estão agregadas: o GROUPING() de
+# CUBO_SQL, com um bit por dimensão agregada, a primeira de DIMENSOES_CUBO no bit mais alto
+def _grupo_cubo(*dimensoes):
+    return sum(1 << (len(DIMENSOES_CUBO) - 1 - i) for i, dim in enumerate(DIMENSOES_CUBO) if dim not in dimensoes)
+
+# Totais por região, UF e município (todos os níveis, dependências e localizações)
+GRUPO_REGIAO = _grupo_cubo('NOME_REGIAO')
+GRUPO_UF = _grupo_cubo('NOME_REGIAO', 'SIGLA_UF')
+GRUPO_MUNICIPIO = _grupo_cubo('NOME_REGIAO', 'SIGLA_UF', 'ID_MUNICIPIO')
+
+# Agregação do cubo sobre Matricula; {filtro} restringe as linhas agregadas
+# A geografia é agregada em hierarquia (ROLLUP) e as demais dimensões em todas as combinações (CUBE)
+CUBO_SQL = '''
+        SELECT GROUPING(r."NOME_REGIAO", uf."SIGLA_UF", m."ID_MUNICIPIO", mat."NIVEL_ENSINO", e."TIPO_DEPENDENCIA", e."TIPO_LOCALIZACAO"),
+               mat."ANO_REFERENCIA", r."NOME_REGIAO", uf."SIGLA_UF", m."ID_MUNICIPIO",
+               mat."NIVEL_ENSINO", e."TIPO_DEPENDENCIA", e."TIPO_LOCALIZACAO",
+               COUNT(DISTINCT e."ID_ESCOLA"),
+               COUNT(DISTINCT CASE WHEN e."INDIGENA" THEN e."ID_ESCOLA" END),
+               SUM(mat."QT_MATRICULAS_TOTAL"),
+               COALESCE(SUM(mat."QT_MATRICULAS_INDIGENAS"), 0)
+        FROM "Matricula" mat
+        JOIN "Escola" e ON mat."ID_ESCOLA" = e."ID_ESCOLA"
+        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        JOIN "Regiao" r ON uf."ID_REGIAO" = r."ID_REGIAO"
+        {filtro}
+        GROUP BY mat."ANO_REFERENCIA",
+                 ROLLUP(r."NOME_REGIAO", uf."SIGLA_UF", m."ID_MUNICIPIO"),
+                 CUBE(mat."NIVEL_ENSINO", e."TIPO_DEPENDENCIA", e."TIPO_LOCALIZACAO")
+    '''
 
-        # 2. Unidade_Federativa
-        ufs = df.groupby(['SG_UF', 'NO_UF', 'NO_REGIAO']).agg({'QT_MAT_BAS': 'sum', 'QT_MAT_BAS_INDIGENA': 'sum'}).reset_index()
-        ufs_data = [
-            (row['NO_UF'], row['SG_UF'], regioes_dict.get(row['NO_REGIAO'], None), int(row['QT_MAT_BAS']), int(row['QT_MAT_BAS_INDIGENA']))
-            for _, row in ufs.iterrows() if row['NO_REGIAO'] in regioes_dict
-        ]
-        insert_batch(
-            'INSERT INTO "Unidade_Federativa" ("NOME_UF", "SIGLA_UF", "ID_REGIAO", "POPULACAO_TOTAL", "POPULACAO_INDIGENA") VALUES (%s, %s, %s, %s, %s) RETURNING "ID_UF"',
-            ufs_data
+# Recalcula o Cubo_Matricula dos anos informados (ou de todos) em uma única passada sobre Matricula
+def atualizar_cubo(anos=None):
+    filtro_cubo = filtro_matricula = ''
+    if anos is not None:
+        lista_anos = ", ".join(str(int(ano)) for ano in anos)
+        filtro_cubo = f'WHERE "ANO_REFERENCIA" IN ({lista_anos})'
+        filtro_matricula = f'WHERE mat."ANO_REFERENCIA" IN ({lista_anos})'
+    cursor.execute(f'DELETE FROM "Cubo_Matricula" {filtro_cubo}')
+    cursor.execute('INSERT INTO "Cubo_Matricula" ' + CUBO_SQL.format(filtro=filtro_matricula))
+
+# Tabelas com POPULACAO_* e a coluna que as liga às linhas de totais do cubo
+POPULACAO_CUBO = [
+    ('Regiao', 'NOME_REGIAO', GRUPO_REGIAO),
+    ('Unidade_Federativa', 'SIGLA_UF', GRUPO_UF),
+    ('Municipio', 'ID_MUNICIPIO', GRUPO_MUNICIPIO)
+]
+
+# Preenche POPULACAO_TOTAL e POPULACAO_INDIGENA de regiões, UFs e municípios com as matrículas do ano
+# nas linhas de totais do cubo, sem nova passada sobre Matricula; quem não tem matrícula no ano fica com 0
+# É a única definição desses campos, usada pela carga (etapa cubo) e por aplicar_delta
+def atualizar_populacao(ano):
+    for tabela, coluna, grupo in POPULACAO_CUBO:
+        def total(campo):
+            return (f'COALESCE((SELECT c."{campo}" FROM "Cubo_Matricula" c WHERE c."ANO_REFERENCIA" = %(ano)s '
+                    f'AND c."GRUPO" = %(grupo)s AND c."{coluna}" = "{tabela}"."{coluna}"), 0)')
+        cursor.execute(
+            f'UPDATE "{tabela}" SET "POPULACAO_TOTAL" = {total("QT_MATRICULAS_TOTAL")}, '
+            f'"POPULACAO_INDIGENA" = {total("QT_MATRICULAS_INDIGENAS")}',
+            {'ano': ano, 'grupo': grupo}
         )
-        cursor.execute('SELECT "SIGLA_UF", "ID_UF" FROM "Unidade_Federativa"')
-        ufs_dict = {sigla: id_uf for sigla, id_uf in cursor.fetchall()}
 
-        # 3. Municipio
-        municipios = df.groupby(['CO_MUNICIPIO', 'NO_MUNICIPIO', 'SG_UF']).agg({'QT_MAT_BAS': 'sum', 'QT_MAT_BAS_INDIGENA': 'sum'}).reset_index()
-        
-        municipios_data = [
-            (row['NO_MUNICIPIO'], ufs_dict.get(row['SG_UF'], None), int(row['QT_MAT_BAS']), int(row['QT_MAT_BAS_INDIGENA']))
-            for _, row in municipios.iterrows() if row['SG_UF'] in ufs_dict
-        ]
-        psycopg2.extras.execute_batch(cursor,
-            'INSERT INTO "Municipio" ("NOME_MUNICIPIO", "ID_UF", "POPULACAO_TOTAL", "POPULACAO_INDIGENA") VALUES (%s, %s, %s, %s)',
-            municipios_data
+# Etapa 6b: Cubo_Matricula e, na carga do ano mais recente, POPULACAO_* das dimensões
+def _etapa_cubo(df):
+    anos = df['NU_ANO_CENSO'].dropna().unique()
+    atualizar_cubo(anos)
+    if _carga_mais_recente(df):
+        atualizar_populacao(int(max(anos)))
+    cursor.execute('SELECT COUNT(*) FROM "Cubo_Matricula"')
+    print(f"Cubo de matrículas com {cursor.fetchone()[0]} agregados")
+
+# Primeiro ano guardado na série histórica: o elemento 1 dos arrays de Serie_Matricula é este ano
+ANO_INICIAL_SERIE = 2007
+
+# Etapa 6c: Serie_Matricula
+# Grava as matrículas do ano carregado na posição desse ano nos arrays de cada escola/nível, mantendo
+# os demais anos, de modo que cargas de anos diferentes (em qualquer ordem) montam a série histórica.
+# Toda escola do censo tem uma linha por nível, com 0 nos anos em que estava no censo sem matrícula
+# no nível, para distinguir de NULL (fora do censo); ao recarregar um ano, as escolas que não estão
+# mais no censo daquele ano voltam a NULL nele
+# Cargas amostradas não alteram a série: as escolas fora da amostra pareceriam fechadas
+def _etapa_serie(df):
+    if df.attrs.get('fatores_amostra'):
+        print("AVISO: Carga amostrada - Serie_Matricula não foi alterada.")
+        return
+    matriculas_long = _matriculas_por_nivel(df)
+    anos = sorted(int(ano) for ano in matriculas_long['NU_ANO_CENSO'].dropna().unique())
+    if any(ano < ANO_INICIAL_SERIE for ano in anos):
+        print(f"AVISO: Anos anteriores a {ANO_INICIAL_SERIE} não entram em Serie_Matricula.")
+    # Sem o mapa da carga (ex.: etapa escola vazia), a série mantém o ID_ESCOLA anterior
+    ids_escola = (escolas_dict or MapaIds()).buscar(matriculas_long['CO_ENTIDADE'].to_numpy())
+
+    for ano in anos:
+        if ano < ANO_INICIAL_SERIE:
+            continue
+        do_ano = (matriculas_long['NU_ANO_CENSO'] == ano).to_numpy()
+        _gravar_ano_serie(ano, list(zip(
+            matriculas_long['CO_ENTIDADE'][do_ano].astype(int).tolist(),
+            matriculas_long['NIVEL_ENSINO'][do_ano].tolist(),
+            [None if id_escola == -1 else id_escola for id_escola in ids_escola[do_ano].tolist()],
+            matriculas_long['QT_MATRICULAS_TOTAL'][do_ano].tolist(),
+            matriculas_long['QT_MATRICULAS_INDIGENAS'][do_ano].tolist()
+        )))
+    cursor.execute('SELECT COUNT(*) FROM "Serie_Matricula"')
+    print(f"Série histórica de matrículas com {cursor.fetchone()[0]} escolas/níveis")
+
+# Grava um ano da série a partir das linhas (CO_ENTIDADE, NIVEL_ENSINO, ID_ESCOLA, total, indígenas)
+# desse ano, com SQL sobre uma tabela temporária: só a posição do ano é alterada, nas escolas/níveis
+# do ano e nas que tinham valor nele e saíram do censo, então o custo não cresce com a série inteira
+# O ID_ESCOLA só é trocado quando o ano gravado é o mais recente da linha, para que uma carga de um
+# ano anterior não faça a série apontar para a escola daquele ano
+def _gravar_ano_serie(ano, linhas):
+    posicao = ano - ANO_INICIAL_SERIE + 1
+    chave = ('"Serie_Matricula"."CO_ENTIDADE" = a."CO_ENTIDADE" '
+             'AND "Serie_Matricula"."NIVEL_ENSINO" = a."NIVEL_ENSINO"')
+    cursor.execute(backend.tabela_temporaria('serie_ano', '''(
+        "CO_ENTIDADE" BIGINT, "NIVEL_ENSINO" VARCHAR(20), "ID_ESCOLA" INT, "TOTAL" INT, "INDIGENAS" INT
+    )'''))
+    executar_lote(
+        'INSERT INTO serie_ano ("CO_ENTIDADE", "NIVEL_ENSINO", "ID_ESCOLA", "TOTAL", "INDIGENAS") VALUES (%s, %s, %s, %s, %s)',
+        linhas
+    )
+    cursor.execute(f'''
+        UPDATE "Serie_Matricula"
+        SET {backend.atribuir_serie('QT_MATRICULAS_TOTAL', posicao, 'a."TOTAL"')},
+            {backend.atribuir_serie('QT_MATRICULAS_INDIGENAS', posicao, 'a."INDIGENAS"')},
+            "ID_ESCOLA" = CASE WHEN {backend.serie_posterior(posicao)} THEN "Serie_Matricula"."ID_ESCOLA"
+                               ELSE COALESCE(a."ID_ESCOLA", "Serie_Matricula"."ID_ESCOLA") END
+        FROM serie_ano a
+        WHERE {chave}
+    ''')
+    cursor.execute(f'''
+        INSERT INTO "Serie_Matricula" ("CO_ENTIDADE", "NIVEL_ENSINO", "ID_ESCOLA", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS")
+        SELECT a."CO_ENTIDADE", a."NIVEL_ENSINO", a."ID_ESCOLA", {backend.nova_serie(posicao, 'a."TOTAL"')}, {backend.nova_serie(posicao, 'a."INDIGENAS"')}
+        FROM serie_ano a
+        WHERE NOT EXISTS (SELECT 1 FROM "Serie_Matricula" WHERE {chave})
+    ''')
+    # Escolas/níveis com valor neste ano que não estão mais no censo dele; as que ficam sem nenhum ano saem
+    fora_do_censo = f'NOT EXISTS (SELECT 1 FROM serie_ano a WHERE {chave})'
+    cursor.execute(f'''
+        UPDATE "Serie_Matricula"
+        SET {backend.atribuir_serie('QT_MATRICULAS_TOTAL', posicao, 'NULL')}, {backend.atribuir_serie('QT_MATRICULAS_INDIGENAS', posicao, 'NULL')}
+        WHERE "QT_MATRICULAS_TOTAL"[{posicao}] IS NOT NULL AND {fora_do_censo}
+    ''')
+    cursor.execute(f'DELETE FROM "Serie_Matricula" WHERE {backend.serie_vazia("QT_MATRICULAS_TOTAL")} AND {fora_do_censo}')
+    cursor.execute('DROP TABLE serie_ano')
+
+# Consulta um recorte do cubo por chave: dimensões informadas são filtradas, as omitidas são "todas"
+# Na geografia vale o nível mais específico informado (município > UF > região > Brasil)
+# Ex.: consultar_cubo(2023, uf='AM', nivel_ensino='Fundamental')
+def consultar_cubo(ano, regiao=None, uf=None, municipio=None, nivel_ensino=None, dependencia=None, localizacao=None):
+    conexao = abrir_conexao_leitura()
+    if municipio is not None:
+        geografia = {'NOME_REGIAO': regiao, 'SIGLA_UF': uf, 'ID_MUNICIPIO': municipio}
+        agregadas = set()
+    elif uf is not None:
+        geografia = {'NOME_REGIAO': regiao, 'SIGLA_UF': uf}
+        agregadas = {'ID_MUNICIPIO'}
+    elif regiao is not None:
+        geografia = {'NOME_REGIAO': regiao}
+        agregadas = {'SIGLA_UF', 'ID_MUNICIPIO'}
+    else:
+        geografia = {}
+        agregadas = {'NOME_REGIAO', 'SIGLA_UF', 'ID_MUNICIPIO'}
+    filtros = dict(geografia, NIVEL_ENSINO=nivel_ensino, TIPO_DEPENDENCIA=dependencia, TIPO_LOCALIZACAO=localizacao)
+    agregadas |= {dim for dim in ('NIVEL_ENSINO', 'TIPO_DEPENDENCIA', 'TIPO_LOCALIZACAO') if filtros[dim] is None}
+    grupo = _grupo_cubo(*(dim for dim in DIMENSOES_CUBO if dim not in agregadas))
+
+    condicoes = ['"ANO_REFERENCIA" = %s', '"GRUPO" = %s']
+    params = [ano, grupo]
+    for dim, valor in filtros.items():
+        if valor is not None:
+            condicoes.append(f'"{dim}" = %s')
+            params.append(valor)
+    cursor_cubo = conexao.cursor()
+    cursor_cubo.execute(
+        f'''SELECT "QT_ESCOLAS", "QT_ESCOLAS_INDIGENAS", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS"
+            FROM "Cubo_Matricula" WHERE {' AND '.join(condicoes)}''',
+        tuple(params)
+    )
+    linha = cursor_cubo.fetchone()
+    cursor_cubo.close()
+    _encerrar_leitura(conexao)
+    if linha is None:
+        return None
+    return dict(zip(['QT_ESCOLAS', 'QT_ESCOLAS_INDIGENAS', 'QT_MATRICULAS_TOTAL', 'QT_MATRICULAS_INDIGENAS'], linha))
+
+# Etapas da carga do censo, na ordem de dependência
+# Cada etapa é confirmada (commit) junto com o seu registro em Estado_Carga
+ETAPAS_CSV = [
+    ('regiao', _etapa_regiao),
+    ('unidade_federativa', _etapa_unidade_federativa),
+    ('municipio', _etapa_municipio),
+    ('escola', _etapa_escola),
+    ('turma', _etapa_turma),
+    ('matricula', _etapa_matricula),
+    ('cubo', _etapa_cubo),
+    ('serie', _etapa_serie),
+    ('territorio', _etapa_territorio),
+    ('amostra', _etapa_amostra),
+    ('geracao', _etapa_geracao)
+]
+
+# Reconstrói os dicionários de IDs a partir do banco e os mapas por código a partir dos .npy
+# registrados em Estado_Carga. Devolve o conjunto de etapas já concluídas
+# Recusa retomar (ValueError) quando as etapas concluídas são de outro arquivo ou ano do censo, cujos
+# mapas CO_ENTIDADE/CO_MUNICIPIO não valem para este
+def _restaurar_estado_carga(arquivo, ano):
+    global municipios_cod_dict, escolas_dict
+    cursor.execute('SELECT "ETAPA", "ARQUIVO", "ANO_REFERENCIA" FROM "Estado_Carga"')
+    for etapa, arquivo_etapa, ano_etapa in cursor.fetchall():
+        if (arquivo_etapa, ano_etapa) != (arquivo, ano):
+            raise ValueError(
+                f"A etapa {etapa} foi concluída com {arquivo_etapa or 'arquivo não registrado'} ({ano_etapa or 'ano não registrado'}), "
+                f"e não com {arquivo} ({ano}). Execute a carga sem --resume."
+            )
+
+    cursor.execute('SELECT "NOME_REGIAO", "ID_REGIAO" FROM "Regiao" ORDER BY "ID_REGIAO" DESC')
+    regioes_dict.clear()
+    regioes_dict.update(cursor.fetchall())
+    cursor.execute('SELECT "SIGLA_UF", "ID_UF" FROM "Unidade_Federativa" ORDER BY "ID_UF" DESC')
+    ufs_dict.clear()
+    ufs_dict.update(cursor.fetchall())
+    cursor.execute('SELECT "NOME_MUNICIPIO", "ID_MUNICIPIO" FROM "Municipio" ORDER BY "ID_MUNICIPIO" DESC')
+    municipios_dict.clear()
+    municipios_dict.update(cursor.fetchall())
+
+    cursor.execute('SELECT "ETAPA", "MAPA_IDS" FROM "Estado_Carga"')
+    concluidas = set()
+    for etapa, mapa_ids in cursor.fetchall():
+        concluidas.add(etapa)
+        if etapa == 'municipio':
+            municipios_cod_dict = MapaIds.carregar(mapa_ids)
+        elif etapa == 'escola':
+            escolas_dict = MapaIds.carregar(mapa_ids)
+    return concluidas
+
+# Maiores alocações listadas por etapa no perfil de memória
+PERFIL_TOP_ALOCACOES = 5
+
+# Perfil de memória da carga do censo
+# Em cada fronteira de etapa registra o tamanho do DataFrame do censo (memory_usage(deep=True)),
+# a memória alocada pelo Python (tracemalloc), o pico durante a etapa e as linhas deste arquivo
+# cujas alocações vivas mais cresceram na etapa
+class PerfilMemoria:
+    def __init__(self, profundidade=10):
+        import tracemalloc
+        # Bibliotecas importadas antes de ligar o tracemalloc, para que as importações não entrem no perfil
+        import numpy
+        import pandas
+        abrir_conexao()
+        tracemalloc.start(profundidade)
+        self.etapas = []
+        self._por_linha = {}
+
+    # Soma as alocações vivas pela linha mais recente deste arquivo na pilha de cada uma
+    # (ou pela linha mais recente da pilha, se a alocação não passou por aqui)
+    @staticmethod
+    def _alocacoes_por_linha(snapshot):
+        arquivo = os.path.basename(__file__)
+        por_linha = {}
+        for estatistica in snapshot.statistics('traceback'):
+            quadros = list(reversed(estatistica.traceback))
+            quadro = next((q for q in quadros if os.path.basename(q.filename) == arquivo), quadros[0])
+            chave = f"{os.path.basename(quadro.filename)}:{quadro.lineno}"
+            por_linha[chave] = por_linha.get(chave, 0) + estatistica.size
+        return por_linha
+
+    def registrar(self, etapa, df):
+        import tracemalloc
+        atual, pico = tracemalloc.get_traced_memory()
+        tamanho_df = int(df.memory_usage(deep=True).sum())
+        por_linha = self._alocacoes_por_linha(tracemalloc.take_snapshot())
+        crescimento = sorted(
+            ((tamanho - self._por_linha.get(linha, 0), linha) for linha, tamanho in por_linha.items()),
+            reverse=True
         )
+        self._por_linha = por_linha
+        self.etapas.append({
+            'etapa': etapa, 'dataframe': tamanho_df, 'atual': atual, 'pico': pico,
+            'alocacoes': [(linha, tamanho) for tamanho, linha in crescimento[:PERFIL_TOP_ALOCACOES] if tamanho > 0]
+        })
+        tracemalloc.reset_peak()
+
+    def finalizar(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return self.etapas
+        tracemalloc.stop()
+        mb = 1024 * 1024
+        print("\nPerfil de memória da carga (MB):")
+        print(f"{'Etapa':<20}{'DataFrame':>12}{'Alocado':>12}{'Pico':>12}")
+        for registro in self.etapas:
+            print(f"{registro['etapa']:<20}{registro['dataframe'] / mb:>12.1f}{registro['atual'] / mb:>12.1f}{registro['pico'] / mb:>12.1f}")
+            for linha, tamanho in registro['alocacoes']:
+                print(f"    {linha}: +{tamanho / mb:.1f}")
+        return self.etapas
 
+# Função para carregar e processar o CSV do Censo Escolar
+# Lê os dados do arquivo CSV e insere nas tabelas do banco de dados
+# A carga é dividida em etapas (ETAPAS_CSV) com checkpoint em Estado_Carga; com retomar=True,
+# as etapas já concluídas são puladas e só a etapa que falhou (e as seguintes) é executada
+# Em caso de erro, a etapa é desfeita e a exceção segue para quem chamou
+# Com amostra=<fração>, carrega só uma amostra estratificada determinística (ver ler_censo_amostrado);
+# para retomar uma carga amostrada, repita a mesma fração, manter_indigenas e semente
+# Com perfil_memoria=True, mede a memória a cada etapa (PerfilMemoria) e devolve os registros
+# Os mapas de IDs são gravados em mapas_dir (padrão: MAPAS_DIR)
+def carregar_csv_censo(caminho='./datasets/microdados_ed_basica_2023.csv', retomar=False,
+                       amostra=None, manter_indigenas=False, semente=0, leitor=None, perfil_memoria=False,
+                       mapas_dir=None):
+    if amostra is not None and leitor is not None:
+        raise ValueError("A carga amostrada lê o CSV em blocos com o pandas; não informe o leitor junto com a amostra.")
+    perfil = PerfilMemoria() if perfil_memoria else None
+    try:
+        _carregar_csv_censo(caminho, retomar, amostra, manter_indigenas, semente, leitor, perfil, mapas_dir or MAPAS_DIR)
+    finally:
+        if perfil is not None:
+            perfil.finalizar()
+    return perfil.etapas if perfil is not None else None
 
-        # Dicionários de mapeamento
-        # Dicionário principal (nome -> ID)
-        cursor.execute('SELECT "NOME_MUNICIPIO", "ID_MUNICIPIO" FROM "Municipio"')
-        municipios_dict = {nome: id_municipio for nome, id_municipio in cursor.fetchall()}
-
-        # Dicionário auxiliar (CO_MUNICIPIO -> ID_MUNICIPIO)
-
-        # Primeiro, verifique a estrutura dos resultados
-        cursor.execute('''
-            SELECT m."NOME_MUNICIPIO", m."ID_MUNICIPIO", c."CO_MUNICIPIO" 
-            FROM "Municipio" m
-            JOIN temp_csv c ON m."NOME_MUNICIPIO" = c."NO_MUNICIPIO"
-        ''')
-        resultados = cursor.fetchall()
-
-        # Debug: verifique a estrutura
-        if resultados:
-            print("Exemplo de linha do resultado:", resultados[0])
-            print("Tipo da linha:", type(resultados[0]))
-
-        # Crie o dicionário conforme a estrutura adequada
-        try:
-            if resultados and isinstance(resultados[0], (list, tuple)):
-                municipios_cod_dict = {row[2]: row[1] for row in resultados}
-            elif resultados and isinstance(resultados[0], dict):
-                municipios_cod_dict = {row['CO_MUNICIPIO']: row['ID_MUNICIPIO'] for row in resultados}
-            else:
-                print("Formato de resultados não reconhecido")
-                municipios_cod_dict = {}
-        except Exception as e:
-            print(f"Erro ao criar dicionário: {e}")
-            municipios_cod_dict = {}
-
-        print(f"Dicionário criado com {len(municipios_cod_dict)} entradas")
-
-        # 4. Escola
-        escolas = df[['CO_ENTIDADE', 'NO_ENTIDADE', 'CO_MUNICIPIO', 'TP_DEPENDENCIA', 
-                    'TP_LOCALIZACAO', 'TP_SITUACAO_FUNCIONAMENTO', 'IN_EDUCACAO_INDIGENA']].drop_duplicates()
-
-        escolas_data = []
-        failed_escolas = []
-        for _, row in escolas.iterrows():
-            id_municipio = municipios_cod_dict.get(row['CO_MUNICIPIO'])
-            if id_municipio is None:
-                print(f"AVISO: Município não encontrado para CO_MUNICIPIO: {row['CO_MUNICIPIO']} (Escola: {row['NO_ENTIDADE']})")
-                failed_escolas.append(row['CO_ENTIDADE'])
-                continue
-            escolas_data.append((
-                row['NO_ENTIDADE'], 
-                id_municipio,
-                row['TP_DEPENDENCIA'],
-                row['TP_LOCALIZACAO'],
-                row['TP_SITUACAO_FUNCIONAMENTO'],
-                row['IN_EDUCACAO_INDIGENA'],
-                row['CO_ENTIDADE']  # Include CO_ENTIDADE for mapping
-            ))
-
-        print(f"Total de escolas a inserir: {len(escolas_data)}")
-        print(f"Escolas ignoradas devido a município inválido: {len(failed_escolas)}")
+def _carregar_csv_censo(caminho, retomar, amostra, manter_indigenas, semente, leitor, perfil, mapas_dir):
+    abrir_conexao()
 
-        if escolas_data:
-            print(f"Preparando para inserir {len(escolas_data)} escolas no banco de dados.")
-            escolas_dict.clear()  # Clear existing mappings
-            insert_query = '''
-                INSERT INTO "Escola" ("NOME_ESCOLA", "ID_MUNICIPIO", "TIPO_DEPENDENCIA", "TIPO_LOCALIZACAO", "SITUACAO_FUNCIONAMENTO", "INDIGENA")
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING "ID_ESCOLA"
-            '''
-            for escola in escolas_data:
-                try:
-                    cursor.execute(insert_query, escola[:-1])  # Exclude CO_ENTIDADE from insert
-                    id_escola = cursor.fetchone()[0]
-                    co_entidade = escola[-1]  # CO_ENTIDADE is the last element
-                    escolas_dict[co_entidade] = id_escola
-                except psycopg2.Error as e:
-                    print(f"ERRO: Falha ao inserir escola {escola[0]} (CO_ENTIDADE: {co_entidade}): {e}")
-                    conn.rollback()  # Rollback the failed insert
-                    conn.commit()  # Reset transaction state
-                    continue
-            conn.commit()
-            print(f"Dicionário de escolas atualizado com {len(escolas_dict)} entradas.")
-        else:
-            print("Nenhuma escola para inserir - verifique os logs acima.")
-
-        # 5. Turma
-        niveis_ensino = ['Infantil', 'Fundamental', 'Médio', 'EJA']
-        turmas_columns = {
-            'Infantil': 'QT_TUR_INF',
-            'Fundamental': 'QT_TUR_FUND',
-            'Médio': 'QT_TUR_MED',
-            'EJA': 'QT_TUR_EJA'
-        }
-        turmas_data = []
-        print(f"Total de escolas no dicionário: {len(escolas_dict)}")
-        if not escolas_dict:
-            print("AVISO: Dicionário de escolas vazio - não é possível inserir turmas")
+    print("Carregando CSV do Censo Escolar...")
+    try:
+        # Lê o arquivo CSV (ou Parquet) com os dados do censo escolar
+        if amostra is not None:
+            df = ler_censo_amostrado(caminho, amostra, manter_indigenas, semente)
         else:
-            for co_entidade, id_escola in escolas_dict.items():
-                escola_data = df[df['CO_ENTIDADE'] == co_entidade]
-                if escola_data.empty:
-                    print(f"AVISO: Nenhum dado encontrado para CO_ENTIDADE {co_entidade}")
-                    continue
-                escola_row = escola_data.iloc[0]
-                for nivel in niveis_ensino:
-                    col_name = turmas_columns.get(nivel)
-                    if col_name not in df.columns:
-                        print(f"ERRO: Coluna {col_name} não encontrada no CSV. Pulando {nivel} para escola {co_entidade}")
-                        continue
-                    qt_turmas = escola_row[col_name]
-                    try:
-                        qt_turmas = int(float(qt_turmas)) if pd.notna(qt_turmas) else 0
-                    except (ValueError, TypeError) as e:
-                        print(f"AVISO: Valor inválido para {col_name} na escola {co_entidade}: {qt_turmas}. Erro: {e}")
-                        qt_turmas = 0
-                    qt_turmas_indigenas = qt_turmas if escola_row['IN_EDUCACAO_INDIGENA'] else 0
-                    if qt_turmas > 0:
-                        turmas_data.append((id_escola, nivel, qt_turmas, qt_turmas_indigenas))
-            if turmas_data:
-                print(f"Inserindo {len(turmas_data)} registros em Turma")
-                psycopg2.extras.execute_batch(
-                    cursor,
-                    'INSERT INTO "Turma" ("ID_ESCOLA", "NIVEL_ENSINO", "QT_TURMAS", "QT_TURMAS_INDIGENAS") VALUES (%s, %s, %s, %s)',
-                    turmas_data
-                )
-                conn.commit()
-                cursor.execute('SELECT COUNT(*) FROM "Turma"')
-                print(f"Total de registros inseridos em Turma: {cursor.fetchone()[0]}")
-            else:
-                print("AVISO: Nenhum dado de turmas para inserir. Verifique se QT_TUR_* contém valores maiores que 0.")
-            
-        # 6. Matricula
-        matriculas = df[['CO_ENTIDADE', 'QT_MAT_BAS', 'QT_MAT_BAS_INDIGENA', 'NU_ANO_CENSO', 'IN_INF', 'IN_FUND_AI', 'IN_FUND_AF', 'IN_MED', 'IN_EJA']].drop_duplicates()
-        matriculas_data = []
-        print(f"Total de escolas no dicionário: {len(escolas_dict)}")
-        if not escolas_dict:
-            print("AVISO: Dicionário de escolas vazio - não é possível inserir matrículas")
+            df = ler_censo(caminho, leitor)
+        if df.empty:
+            raise ValueError("CSV inválido! O arquivo está vazio ou não contém dados válidos.")
+        _preparar_censo(df)
+        if perfil is not None:
+            perfil.registrar('leitura', df)
+
+        arquivo = os.path.abspath(caminho)
+        ano = int(df['NU_ANO_CENSO'].max())
+        if retomar:
+            concluidas = _restaurar_estado_carga(arquivo, ano)
+            print(f"Retomando carga. Etapas já concluídas: {sorted(concluidas)}")
         else:
-            for _, row in matriculas.iterrows():
-                co_entidade = row['CO_ENTIDADE']
-                id_escola = escolas_dict.get(co_entidade)
-                if id_escola is None:
-                    print(f"AVISO: Escola com CO_ENTIDADE {co_entidade} não encontrada em escolas_dict")
-                    continue
-                niveis = [
-                    nivel for nivel, flag in zip(
-                        ['Infantil', 'Fundamental', 'Médio', 'EJA'],
-                        [row['IN_INF'], row['IN_FUND_AI'] or row['IN_FUND_AF'], row['IN_MED'], row['IN_EJA']]
-                    ) if flag == 1
-                ]
-                qt_mat_total = int(float(row['QT_MAT_BAS'])) if pd.notna(row['QT_MAT_BAS']) else 0
-                qt_mat_indigena = int(float(row['QT_MAT_BAS_INDIGENA'])) if pd.notna(row['QT_MAT_BAS_INDIGENA']) else 0
-                matriculas_data.extend(
-                    (id_escola, nivel, qt_mat_total, qt_mat_indigena, int(row['NU_ANO_CENSO']))
-                    for nivel in niveis
-                )
-            if matriculas_data:
-                print(f"Inserindo {len(matriculas_data)} registros em Matricula")
-                psycopg2.extras.execute_batch(
-                    cursor,
-                    'INSERT INTO "Matricula" ("ID_ESCOLA", "NIVEL_ENSINO", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS", "ANO_REFERENCIA") VALUES (%s, %s, %s, %s, %s)',
-                    matriculas_data
-                )
-                conn.commit()
-                cursor.execute('SELECT COUNT(*) FROM "Matricula"')
-                print(f"Total de registros inseridos em Matricula: {cursor.fetchone()[0]}")
-            else:
-                print("AVISO: Nenhum dado de matrículas para inserir. Verifique se QT_MAT_BAS > 0 e se IN_* flags estão ativos.")
-
-        # 7. Territorio Indígena
-        territorios = df[df['TP_LOCALIZACAO_DIFERENCIADA'] == 1][['SG_UF', 'NO_MUNICIPIO']].drop_duplicates()
-        for _, row in territorios.iterrows():
-            if row['SG_UF'] in ufs_dict:
-                id_uf = ufs_dict[row['SG_UF']]
-                nome_territorio = f"Território Indígena {row['NO_MUNICIPIO']}"
-                cursor.execute(
-                    'INSERT INTO "Territorio_Indigena" ("ID_UF", "NOME_TERRITORIO", "ETNIA_DOMINANTE", "AREA", "POP_TOTAL") VALUES (%s, %s, %s, %s, %s)',
-                    (id_uf, nome_territorio, None, None, None)
-                )
-
-        conn.commit()
-        print("CSV do Censo Escolar carregado com sucesso.")
+            cursor.execute('DELETE FROM "Estado_Carga"')
+            conn.commit()
+            concluidas = set()
     except Exception as e:
         print(f"Erro ao carregar CSV: {e}")
-        conn.rollback()   
+        conn.rollback()
+        raise
+
+    for nome, etapa in ETAPAS_CSV:
+        if nome in concluidas:
+            print(f"Etapa {nome} já concluída, pulando.")
+            continue
+        try:
+            mapa = etapa(df)
+            mapa_ids = None
+            if mapa is not None:
+                # Caminho absoluto, para que --resume funcione a partir de outro diretório
+                mapa_ids = os.path.abspath(os.path.join(mapas_dir, f'{nome}.npy'))
+                mapa.salvar(mapa_ids)
+            cursor.execute(
+                'INSERT INTO "Estado_Carga" ("ETAPA", "MAPA_IDS", "ARQUIVO", "ANO_REFERENCIA") VALUES (%s, %s, %s, %s)',
+                (nome, mapa_ids, arquivo, ano)
+            )
+            conn.commit()
+            if nome == 'geracao':
+                _registrar_geracao_principal()
+            print(f"Etapa {nome} concluída.")
+            if perfil is not None:
+                perfil.registrar(nome, df)
+        except Exception as e:
+            print(f"Erro ao carregar CSV na etapa {nome}: {e}")
+            conn.rollback()
+            print("Execute novamente com --resume para retomar a partir desta etapa.")
+            raise
+
+    print("CSV do Censo Escolar carregado com sucesso.")
 
 
 # Função para carregar e processar múltiplos arquivos XLSX
 # Lê os dados de arquivos XLSX e insere nas tabelas do banco de dados
 def carregar_xlsx():
+    import pandas as pd
+    abrir_conexao()
     try:
         # Recarregar os dicionários com os dados atualizados do banco
         cursor.execute('SELECT "NOME_REGIAO", "ID_REGIAO" FROM "Regiao"')
@@ -427,6 +1775,15 @@ def carregar_xlsx():
         cursor.execute('SELECT "NOME_ESCOLA", "ID_ESCOLA" FROM "Escola"')
         escolas_dict = {nome: id_escola for nome, id_escola in cursor.fetchall()}
 
+        # Municípios de cada UF, buscados uma única vez em vez de uma consulta por linha do XLSX
+        cursor.execute('SELECT "ID_UF", "ID_MUNICIPIO" FROM "Municipio"')
+        municipios_por_uf = {}
+        for id_uf, id_municipio in cursor.fetchall():
+            municipios_por_uf.setdefault(id_uf, []).append(id_municipio)
+
+        # INSERTs acumulados e enviados de uma vez, em pipeline, por _descarregar_insercoes
+        pendentes = []
+
         # Caminho para a pasta de datasets
         datasets_folder = './datasets'
 
@@ -496,11 +1853,7 @@ def carregar_xlsx():
                         print(f"UF não encontrada no banco: {sigla_uf}")
                         continue
                         
-                    cursor.execute(
-                        'SELECT "ID_MUNICIPIO" FROM "Municipio" WHERE "ID_UF" = %s',
-                        (ufs_dict[sigla_uf],)
-                    )
-                    municipios_uf = [r[0] for r in cursor.fetchall()]
+                    municipios_uf = municipios_por_uf.get(ufs_dict[sigla_uf], [])
                     
                     if not municipios_uf:
                         print(f"Nenhum município encontrado para UF: {sigla_uf}")
@@ -523,10 +1876,10 @@ def carregar_xlsx():
                                 continue
                                 
                             for id_municipio in municipios_uf:
-                                cursor.execute(
+                                pendentes.append((
                                     'INSERT INTO "Frequencia_Escolar" ("ID_MUNICIPIO", "FAIXA_ETARIA", "TAXA_FREQUENCIA") VALUES (%s, %s, %s)',
                                     (id_municipio, faixa, taxa)
-                                )
+                                ))
                                 total_insercoes += 1
                                 
                         except (ValueError, TypeError) as e:
@@ -563,11 +1916,7 @@ def carregar_xlsx():
                         print(f"UF não encontrada no banco: {sigla_uf}")
                         continue
                         
-                    cursor.execute(
-                        'SELECT "ID_MUNICIPIO" FROM "Municipio" WHERE "ID_UF" = %s',
-                        (ufs_dict[sigla_uf],)
-                    )
-                    municipios_uf = [r[0] for r in cursor.fetchall()]
+                    municipios_uf = municipios_por_uf.get(ufs_dict[sigla_uf], [])
                     
                     if not municipios_uf:
                         print(f"Nenhum município encontrado para UF: {sigla_uf}")
@@ -590,10 +1939,10 @@ def carregar_xlsx():
                                 continue
                                 
                             for id_municipio in municipios_uf:
-                                cursor.execute(
+                                pendentes.append((
                                     'INSERT INTO "Anos_Estudo" ("ID_MUNICIPIO", "FAIXA_ETARIA", "MEDIA_ANOS_ESTUDO") VALUES (%s, %s, %s)',
                                     (id_municipio, faixa, media)
-                                )
+                                ))
                                 total_insercoes += 1
                                 
                         except (ValueError, TypeError) as e:
@@ -603,298 +1952,126 @@ def carregar_xlsx():
                 print(f"Total de inserções realizadas em Anos_Estudo: {total_insercoes}")
 
             elif 'nivel_instrucao.xlsx' in arquivo:
-                try:
-                    # Ler o arquivo pulando metadados (5 primeiras linhas são cabeçalhos)
-                    df = pd.read_excel(arquivo, header=None, skiprows=5)
-                    
-                    if df.empty:
-                        print("Arquivo está vazio após pular linhas iniciais.")
-                        continue
-                    
-                    # Níveis de instrução (baseado nos cabeçalhos)
-                    niveis_instrucao = [
-                        'Sem instrução e fundamental incompleto',
-                        'Fundamental completo e médio incompleto',
-                        'Médio completo e superior incompleto',
-                        'Superior completo'
-                    ]
-                    
-                    # Faixas etárias (baseado nos cabeçalhos)
-                    faixas_etarias = [
-                        'Total',
-                        '18 a 24 anos',
-                        '18 a 19 anos',
-                        '20 a 24 anos',
-                        '25 anos ou mais',
-                        '25 a 64 anos',
-                        '25 a 29 anos',
-                        '30 a 34 anos',
-                        '35 a 39 anos',
-                        '40 a 44 anos',
-                        '45 a 49 anos',
-                        '50 a 54 anos',
-                        '55 a 59 anos',
-                        '60 a 64 anos',
-                        '65 anos ou mais',
-                        '65 a 69 anos',
-                        '70 a 74 anos',
-                        '75 a 79 anos',
-                        '80 anos ou mais'
-                    ]
-                    
-                    # Primeiro, vamos criar um mapeamento de município para ID_MUNICIPIO
-                    cursor.execute('SELECT "NOME_MUNICIPIO", "ID_MUNICIPIO" FROM "Municipio"')
-                    municipios_dict = {row[0].upper(): row[1] for row in cursor.fetchall()}
-                    
-                    total_insercoes = 0
-                    
-                    # Processar cada linha (cada município/UF)
-                    for _, row in df.iterrows():
-                        # Verificar se a primeira célula contém texto (nome do município/UF)
-                        if pd.isna(row[0]) or not isinstance(row[0], str):
-                            continue
-                            
-                        nome_local = row[0].strip()
-                        
-                        if nome_local == 'Brasil':
-                            continue  # Ignorar o total nacional
-                            
-                        # Verificar se é um município (está no nosso dicionário)
-                        nome_municipio = nome_local.upper()
-                        if nome_municipio not in municipios_dict:
-                            continue  # Pular UFs e outros que não são municípios específicos
-                            
-                        id_municipio = municipios_dict[nome_municipio]
-                        
-                        # Para cada nível de instrução (as colunas estão agrupadas por nível)
-                        for nivel_idx, nivel in enumerate(niveis_instrucao):
-                            # Calcular o deslocamento das colunas para este nível
-                            # Assumindo que cada nível tem um bloco de colunas para cada faixa etária
-                            col_offset = 1 + (len(faixas_etarias) * nivel_idx)
-                            
-                            # Para cada faixa etária
-                            for faixa_idx, faixa in enumerate(faixas_etarias):
-                                col_num = col_offset + faixa_idx
-                                if col_num >= len(row):
-                                    continue  # Evitar índices fora do range
-                                    
-                                # Obter valor da célula
-                                valor = row[col_num]
-                                
-                                # Verificar se o valor é numérico
-                                if pd.isna(valor):
-                                    continue
-                                    
-                                try:
-                                    qt_pessoas = int(float(valor))
-
-                                    nivel_abreviado = {
-                                    'Sem instrução e fundamental incompleto': 'Sem instrução',
-                                    'Fundamental completo e médio incompleto': 'Fundamental completo',
-                                    'Médio completo e superior incompleto': 'Médio completo',
-                                    'Superior completo': 'Superior completo'  # Já cabe em 30 chars
-                                    }
-                                        
-                                    nivel_para_inserir = nivel_abreviado[nivel]
-                                    
-                                    # Inserir no banco
-                                    cursor.execute(
-                                        'INSERT INTO "Nivel_Instrucao" ("ID_MUNICIPIO", "FAIXA_ETARIA", "NIVEL", "QT_PESSOAS") VALUES (%s, %s, %s, %s)',
-                                        (id_municipio, faixa, nivel_para_inserir, qt_pessoas)
-                                    )
-                                    total_insercoes += 1
-                                    
-                                except (ValueError, TypeError) as e:
-                                    print(f"Erro ao processar valor para {nome_local}, nível {nivel}, faixa {faixa}: {e}")
-                                    continue
-                    
-                    conn.commit()
-                    print(f"Total de inserções em Nivel_Instrucao: {total_insercoes}")
-                    
-                except Exception as e:
-                    conn.rollback()
-                    print(f"Erro ao processar nível de instrução: {e}")
-                    
-            else:
-                # Processar outros arquivos XLSX (lógica genérica)
-                df = pd.read_excel(arquivo)
-                df = df.fillna({
-                    'TAXA_FREQUENCIA': 0,
-                    'QT_PESSOAS': 0,
-                    'MEDIA_ANOS_ESTUDO': 0,
-                    'AREA': None,
-                    'POP_TOTAL': None,
-                    'ETNIA_DOMINANTE': None,
-                    'FAIXA_ETARIA': 'Desconhecida',
-                    'NIVEL_INSTRUCAO': 'Desconhecido',
-                    'NOME_TERRITORIO': None,
-                    'CO_MUNICIPIO': None,
-                    'CO_UF': None
-                })
-
-                if all(col in df.columns for col in ['CO_MUNICIPIO', 'FAIXA_ETARIA', 'TAXA_FREQUENCIA']):
-                    for _, row in df.iterrows():
-                        if row['CO_MUNICIPIO'] and row['CO_MUNICIPIO'] in municipios_dict:
-                            cursor.execute(
-                                'INSERT INTO "Frequencia_Escolar" ("ID_MUNICIPIO", "FAIXA_ETARIA", "TAXA_FREQUENCIA") VALUES (%s, %s, %s)',
-                                (municipios_dict[row['CO_MUNICIPIO']], row['FAIXA_ETARIA'], row['TAXA_FREQUENCIA'])
-                            )
-
-                if all(col in df.columns for col in ['CO_MUNICIPIO', 'FAIXA_ETARIA', 'NIVEL_INSTRUCAO', 'QT_PESSOAS']):
-                    for _, row in df.iterrows():
-                        if row['CO_MUNICIPIO'] and row['CO_MUNICIPIO'] in municipios_dict:
-                            cursor.execute(
-                                'INSERT INTO "Nivel_Instrucao" ("ID_MUNICIPIO", "FAIXA_ETARIA", "NIVEL", "QT_PESSOAS") VALUES (%s, %s, %s, %s)',
-                                (municipios_dict[row['CO_MUNICIPIO']], row['FAIXA_ETARIA'], row['NIVEL_INSTRUCAO'], row['QT_PESSOAS'])
-                            )
-
-                if all(col in df.columns for col in ['CO_MUNICIPIO', 'FAIXA_ETARIA', 'MEDIA_ANOS_ESTUDO']):
-                    for _, row in df.iterrows():
-                        if row['CO_MUNICIPIO'] and row['CO_MUNICIPIO'] in municipios_dict:
-                            cursor.execute(
-                                'INSERT INTO "Anos_Estudo" ("ID_MUNICIPIO", "FAIXA_ETARIA", "MEDIA_ANOS_ESTUDO") VALUES (%s, %s, %s)',
-                                (municipios_dict[row['CO_MUNICIPIO']], row['FAIXA_ETARIA'], row['MEDIA_ANOS_ESTUDO'])
-                            )
-
-                if all(col in df.columns for col in ['CO_UF', 'NOME_TERRITORIO']):
-                    for _, row in df.iterrows():
-                        if row['CO_UF'] and row['CO_UF'] in ufs_dict and row['NOME_TERRITORIO']:
-                            cursor.execute(
-                                'INSERT INTO "Territorio_Indigena" ("ID_UF", "NOME_TERRITORIO", "ETNIA_DOMINANTE", "AREA", "POP_TOTAL") VALUES (%s, %s, %s, %s, %s)',
-                                (
-                                    ufs_dict[row['CO_UF']],
-                                    row['NOME_TERRITORIO'],
-                                    row.get('ETNIA_DOMINANTE', None),
-                                    row.get('AREA', None),
-                                    row.get('POP_TOTAL', None)
-                                )
-                            )
-
-        conn.commit()
-        print("Todos os arquivos XLSX foram carregados com sucesso.")
-    except Exception as e:
-        print(f"Erro ao carregar XLSX: {e}")
-        conn.rollback()
-        
-        # Populate ufs_dict with data from the database
-        cursor.execute('SELECT "SIGLA_UF", "ID_UF" FROM "Unidade_Federativa"')
-        for sigla_uf, id_uf in cursor.fetchall():
-            ufs_dict[sigla_uf] = id_uf
-
-        for arquivo in arquivos_xlsx:
-            print(f"Processando arquivo: {arquivo}")
-            
-            if 'frequencia_escolar.xlsx' in arquivo:
-                # Processar frequencia_escolar.xlsx com estrutura específica
-                # Ler o arquivo pulando as primeiras linhas que não contêm dados
+                # Ler o arquivo pulando metadados (5 primeiras linhas são cabeçalhos)
                 df = pd.read_excel(arquivo, header=None, skiprows=5)
                 
-                # Verificar se o DataFrame não está vazio
                 if df.empty:
                     print("Arquivo está vazio após pular linhas iniciais.")
                     continue
                 
-                # Definir manualmente os nomes das colunas baseado na estrutura
-                colunas = ['UF'] + [f'col_{i}' for i in range(1, len(df.columns))]
-                df.columns = colunas
-                
-                # Filtrar apenas linhas com UFs válidas
-                ufs_brasil = [
-                    'Brasil', 'Rondônia', 'Acre', 'Amazonas', 'Roraima', 'Pará', 'Amapá', 'Tocantins',
-                    'Maranhão', 'Piauí', 'Ceará', 'Rio Grande do Norte', 'Paraíba', 'Pernambuco',
-                    'Alagoas', 'Sergipe', 'Bahia', 'Minas Gerais', 'Espírito Santo', 'Rio de Janeiro',
-                    'São Paulo', 'Paraná', 'Santa Catarina', 'Rio Grande do Sul', 'Mato Grosso do Sul',
-                    'Mato Grosso', 'Goiás', 'Distrito Federal'
+                # Níveis de instrução (baseado nos cabeçalhos)
+                niveis_instrucao = [
+                    'Sem instrução e fundamental incompleto',
+                    'Fundamental completo e médio incompleto',
+                    'Médio completo e superior incompleto',
+                    'Superior completo'
                 ]
                 
-                df = df[df['UF'].isin(ufs_brasil)].copy()
-                
-                # Mapear nomes de UFs para siglas
-                uf_to_sigla = {
-                    'Rondônia': 'RO', 'Acre': 'AC', 'Amazonas': 'AM', 'Roraima': 'RR',
-                    'Pará': 'PA', 'Amapá': 'AP', 'Tocantins': 'TO', 'Maranhão': 'MA',
-                    'Piauí': 'PI', 'Ceará': 'CE', 'Rio Grande do Norte': 'RN',
-                    'Paraíba': 'PB', 'Pernambuco': 'PE', 'Alagoas': 'AL', 'Sergipe': 'SE',
-                    'Bahia': 'BA', 'Minas Gerais': 'MG', 'Espírito Santo': 'ES',
-                    'Rio de Janeiro': 'RJ', 'São Paulo': 'SP', 'Paraná': 'PR',
-                    'Santa Catarina': 'SC', 'Rio Grande do Sul': 'RS',
-                    'Mato Grosso do Sul': 'MS', 'Mato Grosso': 'MT', 'Goiás': 'GO',
-                    'Distrito Federal': 'DF'
-                }
+                # Faixas etárias (baseado nos cabeçalhos)
+                faixas_etarias = [
+                    'Total',
+                    '18 a 24 anos',
+                    '18 a 19 anos',
+                    '20 a 24 anos',
+                    '25 anos ou mais',
+                    '25 a 64 anos',
+                    '25 a 29 anos',
+                    '30 a 34 anos',
+                    '35 a 39 anos',
+                    '40 a 44 anos',
+                    '45 a 49 anos',
+                    '50 a 54 anos',
+                    '55 a 59 anos',
+                    '60 a 64 anos',
+                    '65 anos ou mais',
+                    '65 a 69 anos',
+                    '70 a 74 anos',
+                    '75 a 79 anos',
+                    '80 anos ou mais'
+                ]
                 
-                # Definir manualmente as faixas etárias e suas colunas correspondentes
-                faixas_etarias = {
-                    '0 a 3 anos': 1,    # col_1
-                    '4 a 5 anos': 2,    # col_2
-                    '6 a 14 anos': 3,  # col_3
-                    '15 a 17 anos': 4,  # col_4
-                    '18 a 24 anos': 5,  # col_5
-                    '25 anos ou mais': 6 # col_6
-                }
+                # Primeiro, vamos criar um mapeamento de (nome normalizado, o mesmo da busca, e sigla da UF)
+                # para ID_MUNICIPIO, já que há municípios homônimos em UFs diferentes; em linhas
+                # repetidas de cargas antigas vale a de menor ID
+                cursor.execute('''
+                    SELECT m."NOME_NORMALIZADO", uf."SIGLA_UF", m."ID_MUNICIPIO"
+                    FROM "Municipio" m
+                    JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+                    WHERE m."NOME_NORMALIZADO" IS NOT NULL
+                    ORDER BY m."ID_MUNICIPIO" DESC
+                ''')
+                municipios_dict = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
                 
-                # Contador para acompanhar o progresso
                 total_insercoes = 0
                 
+                # Processar cada linha (cada município/UF)
                 for _, row in df.iterrows():
-                    uf_nome = row['UF']
-                    if uf_nome == 'Brasil':
-                        continue  # Ignorar o total nacional
-                        
-                    if uf_nome not in uf_to_sigla:
-                        print(f"UF não mapeada: {uf_nome}")
+                    # Verificar se a primeira célula contém texto (nome do município/UF)
+                    if pd.isna(row[0]) or not isinstance(row[0], str):
                         continue
                         
-                    sigla_uf = uf_to_sigla[uf_nome]
-                    if sigla_uf not in ufs_dict:
-                        print(f"UF não encontrada no banco: {sigla_uf}")
-                        continue
-                        
-                    # Obter todos os municípios da UF
-                    cursor.execute(
-                        'SELECT "ID_MUNICIPIO" FROM "Municipio" WHERE "ID_UF" = %s',
-                        (ufs_dict[sigla_uf],)
-                    )
-                    municipios_uf = [r[0] for r in cursor.fetchall()]
+                    nome_local = row[0].strip()
                     
-                    if not municipios_uf:
-                        print(f"Nenhum município encontrado para UF: {sigla_uf}")
-                        continue
+                    if nome_local == 'Brasil':
+                        continue  # Ignorar o total nacional
+                        
+                    # Verificar se é um município: o SIDRA escreve "Nome (UF)"; as UFs vêm sem sigla
+                    municipio_uf = re.fullmatch(r'(.+?)\s*\(([A-Z]{2})\)', nome_local)
+                    if municipio_uf is None:
+                        continue  # Pular UFs e outros que não são municípios específicos
+                    chave_municipio = (_normalizar_nome(municipio_uf.group(1)), municipio_uf.group(2))
+                    if chave_municipio not in municipios_dict:
+                        continue  # Município fora do banco
+                        
+                    id_municipio = municipios_dict[chave_municipio]
                     
-                    # Inserir dados para cada faixa etária e município
-                    for faixa, col_idx in faixas_etarias.items():
-                        col_name = f'col_{col_idx}'
-                        if col_name not in row:
-                            print(f"Coluna {col_name} não encontrada para UF {uf_nome}")
-                            continue
+                    # Para cada nível de instrução (as colunas estão agrupadas por nível)
+                    for nivel_idx, nivel in enumerate(niveis_instrucao):
+                        # Calcular o deslocamento das colunas para este nível
+                        # Assumindo que cada nível tem um bloco de colunas para cada faixa etária
+                        col_offset = 1 + (len(faixas_etarias) * nivel_idx)
+                        
+                        # Para cada faixa etária
+                        for faixa_idx, faixa in enumerate(faixas_etarias):
+                            col_num = col_offset + faixa_idx
+                            if col_num >= len(row):
+                                continue  # Evitar índices fora do range
+                                
+                            # Obter valor da célula
+                            valor = row[col_num]
                             
-                        try:
-                            # Converter para float, tratando possíveis strings como 'X' ou '-'
-                            taxa_str = str(row[col_name]).replace(',', '.').strip()
-                            if taxa_str in ['-', '', 'X', '..', '...']:
+                            # Verificar se o valor é numérico
+                            if pd.isna(valor):
                                 continue
                                 
-                            taxa = float(taxa_str)
-                            if not (0 <= taxa <= 100):
-                                print(f"Taxa inválida para {uf_nome}, faixa {faixa}: {taxa}")
-                                continue
+                            try:
+                                qt_pessoas = int(float(valor))
+
+                                nivel_abreviado = {
+                                'Sem instrução e fundamental incompleto': 'Sem instrução',
+                                'Fundamental completo e médio incompleto': 'Fundamental completo',
+                                'Médio completo e superior incompleto': 'Médio completo',
+                                'Superior completo': 'Superior completo'  # Já cabe em 30 chars
+                                }
+                                    
+                                nivel_para_inserir = nivel_abreviado[nivel]
                                 
-                            for id_municipio in municipios_uf:
-                                cursor.execute(
-                                    'INSERT INTO "Frequencia_Escolar" ("ID_MUNICIPIO", "FAIXA_ETARIA", "TAXA_FREQUENCIA") VALUES (%s, %s, %s)',
-                                    (id_municipio, faixa, taxa)
-                                )
+                                # Inserir no banco
+                                pendentes.append((
+                                    'INSERT INTO "Nivel_Instrucao" ("ID_MUNICIPIO", "FAIXA_ETARIA", "NIVEL", "QT_PESSOAS") VALUES (%s, %s, %s, %s)',
+                                    (id_municipio, faixa, nivel_para_inserir, qt_pessoas)
+                                ))
                                 total_insercoes += 1
                                 
-                        except (ValueError, TypeError) as e:
-                            print(f"Erro ao processar taxa para {uf_nome}, faixa {faixa}: {e}")
-                            continue
+                            except (ValueError, TypeError) as e:
+                                print(f"Erro ao processar valor para {nome_local}, nível {nivel}, faixa {faixa}: {e}")
+                                continue
                 
-                print(f"Total de inserções realizadas: {total_insercoes}")
+                print(f"Total de inserções em Nivel_Instrucao: {total_insercoes}")
 
             else:
                 # Processar outros arquivos XLSX (lógica genérica)
-                # Insere dados em tabelas específicas com base nas colunas disponíveis
-                # Tratar valores nulos
+                df = pd.read_excel(arquivo)
                 df = df.fillna({
                     'TAXA_FREQUENCIA': 0,
                     'QT_PESSOAS': 0,
@@ -909,38 +2086,34 @@ def carregar_xlsx():
                     'CO_UF': None
                 })
 
-                # Carregar Frequencia_Escolar
                 if all(col in df.columns for col in ['CO_MUNICIPIO', 'FAIXA_ETARIA', 'TAXA_FREQUENCIA']):
                     for _, row in df.iterrows():
                         if row['CO_MUNICIPIO'] and row['CO_MUNICIPIO'] in municipios_dict:
-                            cursor.execute(
+                            pendentes.append((
                                 'INSERT INTO "Frequencia_Escolar" ("ID_MUNICIPIO", "FAIXA_ETARIA", "TAXA_FREQUENCIA") VALUES (%s, %s, %s)',
                                 (municipios_dict[row['CO_MUNICIPIO']], row['FAIXA_ETARIA'], row['TAXA_FREQUENCIA'])
-                            )
+                            ))
 
-                # Carregar Nivel_Instrucao
                 if all(col in df.columns for col in ['CO_MUNICIPIO', 'FAIXA_ETARIA', 'NIVEL_INSTRUCAO', 'QT_PESSOAS']):
                     for _, row in df.iterrows():
                         if row['CO_MUNICIPIO'] and row['CO_MUNICIPIO'] in municipios_dict:
-                            cursor.execute(
+                            pendentes.append((
                                 'INSERT INTO "Nivel_Instrucao" ("ID_MUNICIPIO", "FAIXA_ETARIA", "NIVEL", "QT_PESSOAS") VALUES (%s, %s, %s, %s)',
                                 (municipios_dict[row['CO_MUNICIPIO']], row['FAIXA_ETARIA'], row['NIVEL_INSTRUCAO'], row['QT_PESSOAS'])
-                            )
+                            ))
 
-                # Carregar Anos_Estudo
                 if all(col in df.columns for col in ['CO_MUNICIPIO', 'FAIXA_ETARIA', 'MEDIA_ANOS_ESTUDO']):
                     for _, row in df.iterrows():
                         if row['CO_MUNICIPIO'] and row['CO_MUNICIPIO'] in municipios_dict:
-                            cursor.execute(
+                            pendentes.append((
                                 'INSERT INTO "Anos_Estudo" ("ID_MUNICIPIO", "FAIXA_ETARIA", "MEDIA_ANOS_ESTUDO") VALUES (%s, %s, %s)',
                                 (municipios_dict[row['CO_MUNICIPIO']], row['FAIXA_ETARIA'], row['MEDIA_ANOS_ESTUDO'])
-                            )
+                            ))
 
-                # Carregar Territorio_Indigena
                 if all(col in df.columns for col in ['CO_UF', 'NOME_TERRITORIO']):
                     for _, row in df.iterrows():
                         if row['CO_UF'] and row['CO_UF'] in ufs_dict and row['NOME_TERRITORIO']:
-                            cursor.execute(
+                            pendentes.append((
                                 'INSERT INTO "Territorio_Indigena" ("ID_UF", "NOME_TERRITORIO", "ETNIA_DOMINANTE", "AREA", "POP_TOTAL") VALUES (%s, %s, %s, %s, %s)',
                                 (
                                     ufs_dict[row['CO_UF']],
@@ -949,103 +2122,321 @@ def carregar_xlsx():
                                     row.get('AREA', None),
                                     row.get('POP_TOTAL', None)
                                 )
-                            )
+                            ))
 
-        conn.commit()
+        # Único ponto de escrita: as linhas de todos os arquivos são enviadas e confirmadas juntas
+        with _descarregar_insercoes(pendentes):
+            conn.commit()
         print("Todos os arquivos XLSX foram carregados com sucesso.")
-    except Exception as inner_exception:
-        # Trata erros e desfaz alterações em caso de falha
-        print(f"Erro ao carregar XLSX: {inner_exception}")
+    except Exception as e:
+        print(f"Erro ao carregar XLSX: {e}")
+        conn.rollback()
+        raise
+
+# Colunas de Escola que um arquivo de delta pode alterar
+COLUNAS_DELTA_ESCOLA = ['NOME_ESCOLA', 'ID_MUNICIPIO', 'TIPO_DEPENDENCIA', 'TIPO_LOCALIZACAO', 'SITUACAO_FUNCIONAMENTO', 'INDIGENA']
+
+# Contribuição das escolas do delta para o cubo (mesma agregação de atualizar_cubo)
+# Como toda escola pertence a um único município, as medidas do cubo (inclusive as contagens de
+# escolas) são somas por escola, e o efeito do delta é (contribuição depois) - (contribuição antes)
+DELTA_SQL = {
+    'cubo': '''
+        INSERT INTO delta_cubo
+    ''' + CUBO_SQL.format(filtro='WHERE e."ID_ESCOLA" IN (SELECT "ID_ESCOLA" FROM delta_escolas)')
+}
+
+# Corrige um ano da série histórica de uma escola/nível (ver _etapa_serie) a partir de uma correção de
+# matrícula do delta. O ID_ESCOLA do delta pode ser de qualquer carga: a escola é localizada pelo
+# CO_ENTIDADE gravado em Escola e, nas escolas gravadas antes dessa coluna existir, pelo ID_ESCOLA do
+# ano mais recente guardado na série. Escolas que não se localizam assim, ou fora da série, geram um aviso
+def _corrigir_serie(id_escola, nivel_ensino, ano, total, indigenas):
+    if ano < ANO_INICIAL_SERIE:
+        return
+    cursor.execute('SELECT "CO_ENTIDADE" FROM "Escola" WHERE "ID_ESCOLA" = %s', (id_escola,))
+    co = cursor.fetchone()[0]
+    if co is None:
+        cursor.execute('SELECT "CO_ENTIDADE" FROM "Serie_Matricula" WHERE "ID_ESCOLA" = %s LIMIT 1', (id_escola,))
+        linha = cursor.fetchone()
+        co = linha[0] if linha is not None else None
+    if co is not None:
+        cursor.execute('SELECT "NIVEL_ENSINO", "ID_ESCOLA" FROM "Serie_Matricula" WHERE "CO_ENTIDADE" = %s', (co,))
+        niveis = dict(cursor.fetchall())
+    if co is None or not niveis:
+        print(f"AVISO: escola {id_escola} não encontrada em Serie_Matricula; a correção de {ano} não foi aplicada à série.")
+        return
+    posicao = ano - ANO_INICIAL_SERIE + 1
+    if nivel_ensino in niveis:
+        cursor.execute(
+            f'''UPDATE "Serie_Matricula" SET {backend.atribuir_serie('QT_MATRICULAS_TOTAL', posicao, '%s')},
+                    {backend.atribuir_serie('QT_MATRICULAS_INDIGENAS', posicao, '%s')}
+                WHERE "CO_ENTIDADE" = %s AND "NIVEL_ENSINO" = %s''',
+            (total, indigenas, co, nivel_ensino)
+        )
+    elif total > 0:
+        cursor.execute(
+            f'''INSERT INTO "Serie_Matricula" ("CO_ENTIDADE", "NIVEL_ENSINO", "ID_ESCOLA", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS")
+                VALUES (%s, %s, %s, {backend.nova_serie(posicao, '%s')}, {backend.nova_serie(posicao, '%s')})''',
+            (co, nivel_ensino, next(iter(niveis.values())), total, indigenas)
+        )
+
+# Aplica um arquivo de correções (JSON) em uma única transação e atualiza o cubo por delta, sem
+# recalculá-lo a partir do zero; POPULACAO_* é relida das linhas de totais do cubo corrigido
+# (atualizar_populacao). Em caso de erro, desfaz a transação e repassa a exceção. Formato do arquivo:
+#   {"escolas": [{"ID_ESCOLA": 12, "INDIGENA": true}, ...],
+#    "matriculas": [{"ID_ESCOLA": 12, "NIVEL_ENSINO": "Fundamental", "ANO_REFERENCIA": 2023,
+#                    "QT_MATRICULAS_TOTAL": 310, "QT_MATRICULAS_INDIGENAS": 42}, ...]}
+# Em "escolas", só as colunas informadas (de COLUNAS_DELTA_ESCOLA) são alteradas; em "matriculas",
+# a linha da escola/nível/ano é substituída, e QT_MATRICULAS_TOTAL = 0 a remove; a Serie_Matricula
+# recebe a mesma correção no ano informado
+def aplicar_delta(caminho):
+    abrir_conexao()
+    try:
+        with open(caminho, encoding='utf-8') as arquivo:
+            delta = json.load(arquivo)
+        escolas = delta.get('escolas', [])
+        matriculas = delta.get('matriculas', [])
+        for escola in escolas:
+            invalidas = set(escola) - set(COLUNAS_DELTA_ESCOLA) - {'ID_ESCOLA'}
+            if invalidas:
+                raise ValueError(f"Colunas de Escola não alteráveis pelo delta: {sorted(invalidas)}")
+            # Turma e Matricula apontam para a escola (ver atualiza_chave_estrangeira)
+            if not backend.atualiza_chave_estrangeira and 'ID_MUNICIPIO' in escola:
+                raise ValueError("No DuckDB, o delta não pode mudar o ID_MUNICIPIO de uma escola.")
+
+        ids_escola = sorted({int(linha['ID_ESCOLA']) for linha in escolas + matriculas})
+        if not ids_escola:
+            print("Delta vazio, nada a aplicar.")
+            return
+        cursor.execute('SELECT COUNT(*) FROM "Escola" WHERE "ID_ESCOLA" IN (' + ', '.join(['%s'] * len(ids_escola)) + ')', tuple(ids_escola))
+        if cursor.fetchone()[0] != len(ids_escola):
+            raise ValueError("O delta referencia escolas que não existem no banco.")
+
+        cursor.execute(backend.tabela_temporaria('delta_escolas', '("ID_ESCOLA" INT)'))
+        executar_lote('INSERT INTO delta_escolas ("ID_ESCOLA") VALUES (%s)', [(id_escola,) for id_escola in ids_escola])
+        cursor.execute(backend.tabela_temporaria('delta_cubo', '''(
+            "GRUPO" SMALLINT, "ANO_REFERENCIA" INT, "NOME_REGIAO" VARCHAR(50), "SIGLA_UF" CHAR(2),
+            "ID_MUNICIPIO" INT, "NIVEL_ENSINO" VARCHAR(20), "TIPO_DEPENDENCIA" VARCHAR(20), "TIPO_LOCALIZACAO" VARCHAR(20),
+            "QT_ESCOLAS" BIGINT, "QT_ESCOLAS_INDIGENAS" BIGINT, "QT_MATRICULAS_TOTAL" BIGINT, "QT_MATRICULAS_INDIGENAS" BIGINT
+        )'''))
+
+        # Contribuição antes das correções, com sinal trocado
+        cursor.execute(DELTA_SQL['cubo'])
+        cursor.execute('''
+            UPDATE delta_cubo SET "QT_ESCOLAS" = -"QT_ESCOLAS", "QT_ESCOLAS_INDIGENAS" = -"QT_ESCOLAS_INDIGENAS",
+                "QT_MATRICULAS_TOTAL" = -"QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS" = -"QT_MATRICULAS_INDIGENAS"
+        ''')
+
+        # Correções
+        for escola in escolas:
+            colunas = [coluna for coluna in COLUNAS_DELTA_ESCOLA if coluna in escola]
+            valores = [escola[coluna] for coluna in colunas]
+            if 'NOME_ESCOLA' in escola:
+                colunas.append('NOME_NORMALIZADO')
+                valores.append(_normalizar_nome(escola['NOME_ESCOLA']))
+            if colunas:
+                atribuicoes = ', '.join(f'"{coluna}" = %s' for coluna in colunas)
+                cursor.execute(
+                    f'UPDATE "Escola" SET {atribuicoes} WHERE "ID_ESCOLA" = %s',
+                    tuple(valores) + (int(escola['ID_ESCOLA']),)
+                )
+        for matricula in matriculas:
+            chave = (int(matricula['ID_ESCOLA']), matricula['NIVEL_ENSINO'], int(matricula['ANO_REFERENCIA']))
+            cursor.execute(
+                'DELETE FROM "Matricula" WHERE "ID_ESCOLA" = %s AND "NIVEL_ENSINO" = %s AND "ANO_REFERENCIA" = %s',
+                chave
+            )
+            if int(matricula['QT_MATRICULAS_TOTAL']) > 0:
+                cursor.execute(
+                    'INSERT INTO "Matricula" ("ID_ESCOLA", "NIVEL_ENSINO", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS", "ANO_REFERENCIA") VALUES (%s, %s, %s, %s, %s)',
+                    (chave[0], chave[1], int(matricula['QT_MATRICULAS_TOTAL']), int(matricula.get('QT_MATRICULAS_INDIGENAS', 0)), chave[2])
+                )
+            _corrigir_serie(chave[0], chave[1], chave[2], int(matricula['QT_MATRICULAS_TOTAL']), int(matricula.get('QT_MATRICULAS_INDIGENAS', 0)))
+
+        # Contribuição depois das correções
+        cursor.execute(DELTA_SQL['cubo'])
+
+        # Cubo: soma o delta às células existentes, cria as que passaram a ter escolas e
+        # remove as que ficaram sem nenhuma (como um recálculo completo faria)
+        agregado = '''
+            SELECT "GRUPO", "ANO_REFERENCIA", "NOME_REGIAO", "SIGLA_UF", "ID_MUNICIPIO", "NIVEL_ENSINO", "TIPO_DEPENDENCIA", "TIPO_LOCALIZACAO",
+                   SUM("QT_ESCOLAS") AS "QT_ESCOLAS", SUM("QT_ESCOLAS_INDIGENAS") AS "QT_ESCOLAS_INDIGENAS",
+                   SUM("QT_MATRICULAS_TOTAL") AS "QT_MATRICULAS_TOTAL", SUM("QT_MATRICULAS_INDIGENAS") AS "QT_MATRICULAS_INDIGENAS"
+            FROM delta_cubo
+            GROUP BY "GRUPO", "ANO_REFERENCIA", "NOME_REGIAO", "SIGLA_UF", "ID_MUNICIPIO", "NIVEL_ENSINO", "TIPO_DEPENDENCIA", "TIPO_LOCALIZACAO"
+        '''
+        mesma_celula = ' AND '.join(
+            ['c."GRUPO" = d."GRUPO"', 'c."ANO_REFERENCIA" = d."ANO_REFERENCIA"']
+            + [f'c."{dim}" IS NOT DISTINCT FROM d."{dim}"' for dim in DIMENSOES_CUBO]
+        )
+        cursor.execute(f'''
+            UPDATE "Cubo_Matricula" c SET
+                "QT_ESCOLAS" = c."QT_ESCOLAS" + d."QT_ESCOLAS",
+                "QT_ESCOLAS_INDIGENAS" = c."QT_ESCOLAS_INDIGENAS" + d."QT_ESCOLAS_INDIGENAS",
+                "QT_MATRICULAS_TOTAL" = c."QT_MATRICULAS_TOTAL" + d."QT_MATRICULAS_TOTAL",
+                "QT_MATRICULAS_INDIGENAS" = c."QT_MATRICULAS_INDIGENAS" + d."QT_MATRICULAS_INDIGENAS"
+            FROM ({agregado}) d
+            WHERE {mesma_celula}
+        ''')
+        cursor.execute(f'''
+            INSERT INTO "Cubo_Matricula"
+            SELECT d.* FROM ({agregado}) d
+            WHERE d."QT_ESCOLAS" > 0 AND NOT EXISTS (SELECT 1 FROM "Cubo_Matricula" c WHERE {mesma_celula})
+        ''')
+        cursor.execute('DELETE FROM "Cubo_Matricula" WHERE "QT_ESCOLAS" = 0')
+
+        # POPULACAO_* vem do censo da última carga: só é relida se o delta tocou esse ano
+        cursor.execute('SELECT DISTINCT "ANO_REFERENCIA" FROM delta_cubo')
+        anos = [ano for (ano,) in cursor.fetchall()]
+        cursor.execute('SELECT MAX("ANO_REFERENCIA") FROM "Geracao_Carga"')
+        ano_populacao = cursor.fetchone()[0]
+        if ano_populacao in anos:
+            atualizar_populacao(ano_populacao)
+
+        # Nova geração para os anos tocados, para que a exportação incremental os reexporte
+        for ano in anos:
+            cursor.execute('INSERT INTO "Geracao_Carga" ("ANO_REFERENCIA") VALUES (%s)', (ano,))
+
+        conn.commit()
+        _registrar_geracao_principal()
+        print(f"Delta aplicado: {len(escolas)} escolas e {len(matriculas)} matrículas corrigidas.")
+    except Exception as e:
+        print(f"Erro ao aplicar delta: {e}")
         conn.rollback()
+        raise
+
+# Consultas analíticas
+# Mantidas em um dicionário de módulo para serem reutilizadas pela exportação e por outras rotinas
+CONSULTAS_ANALITICAS = {
+    'consulta1': '''
+    SELECT r."NOME_REGIAO", f."FAIXA_ETARIA", AVG(f."TAXA_FREQUENCIA") as media_taxa_frequencia
+    FROM "Frequencia_Escolar" f
+    JOIN "Municipio" m ON f."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+    JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    JOIN "Regiao" r ON uf."ID_REGIAO" = r."ID_REGIAO"
+    GROUP BY r."NOME_REGIAO", f."FAIXA_ETARIA"
+    ORDER BY r."NOME_REGIAO", f."FAIXA_ETARIA";
+    ''',
+    # Consultas 2 e 3 leem as linhas de totais por UF e por município do Cubo_Matricula
+    'consulta2': f'''
+    SELECT uf."NOME_UF", uf."SIGLA_UF",
+           c."QT_MATRICULAS_INDIGENAS" * 100.0 / NULLIF(c."QT_MATRICULAS_TOTAL", 0) as proporcao_indigena
+    FROM "Cubo_Matricula" c
+    JOIN "Unidade_Federativa" uf ON c."SIGLA_UF" = uf."SIGLA_UF"
+    WHERE c."ANO_REFERENCIA" = 2023 AND c."GRUPO" = {GRUPO_UF} AND c."QT_MATRICULAS_TOTAL" > 0
+    ORDER BY proporcao_indigena DESC;
+    ''',
+    'consulta3': f'''
+    SELECT m."NOME_MUNICIPIO", c."SIGLA_UF", 
+           ROUND(SUM(c."QT_MATRICULAS_INDIGENAS") * 100.0 / NULLIF(SUM(c."QT_MATRICULAS_TOTAL"), 0), 2) as proporcao_indigena
+    FROM "Cubo_Matricula" c
+    JOIN "Municipio" m ON c."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+    WHERE c."ANO_REFERENCIA" = 2023 AND c."GRUPO" = {GRUPO_MUNICIPIO}
+    GROUP BY m."NOME_MUNICIPIO", c."SIGLA_UF"
+    HAVING SUM(c."QT_MATRICULAS_TOTAL") > 0
+    ORDER BY proporcao_indigena DESC
+    LIMIT 10;
+    ''',
+    'consulta4': '''
+    SELECT r."NOME_REGIAO", COUNT(*) as total_escolas
+    FROM "Escola" e
+    JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+    JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    JOIN "Regiao" r ON uf."ID_REGIAO" = r."ID_REGIAO"
+    WHERE e."INDIGENA" = TRUE AND e."SITUACAO_FUNCIONAMENTO" = 'Ativa'
+    GROUP BY r."NOME_REGIAO"
+    ORDER BY total_escolas DESC;
+    ''',
+    'consulta5': '''
+    SELECT m."NOME_MUNICIPIO", uf."SIGLA_UF", m."POPULACAO_INDIGENA", AVG(f."TAXA_FREQUENCIA") as media_frequencia
+    FROM "Municipio" m
+    JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    JOIN "Frequencia_Escolar" f ON m."ID_MUNICIPIO" = f."ID_MUNICIPIO"
+    WHERE m."POPULACAO_INDIGENA" > 1000 AND f."FAIXA_ETARIA" = '6 a 14 anos'
+    GROUP BY m."NOME_MUNICIPIO", uf."SIGLA_UF", m."POPULACAO_INDIGENA"
+    HAVING AVG(f."TAXA_FREQUENCIA") < 50
+    ORDER BY media_frequencia ASC
+    LIMIT 5;
+    '''
+}
+
+# Variantes parametrizadas das consultas, que podem devolver todos os municípios ou todas as escolas
+CONSULTAS_PARAMETRIZADAS = {
+    'proporcao_indigena_municipios': f'''
+    SELECT m."NOME_MUNICIPIO", c."SIGLA_UF",
+           ROUND(SUM(c."QT_MATRICULAS_INDIGENAS") * 100.0 / NULLIF(SUM(c."QT_MATRICULAS_TOTAL"), 0), 2) as proporcao_indigena
+    FROM "Cubo_Matricula" c
+    JOIN "Municipio" m ON c."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+    WHERE c."ANO_REFERENCIA" = %(ano)s AND c."GRUPO" = {GRUPO_MUNICIPIO}
+    GROUP BY m."NOME_MUNICIPIO", c."SIGLA_UF"
+    HAVING SUM(c."QT_MATRICULAS_TOTAL") > 0
+    ORDER BY proporcao_indigena DESC
+    ''',
+    'escolas_indigenas': '''
+    SELECT e."ID_ESCOLA", e."NOME_ESCOLA", m."NOME_MUNICIPIO", uf."SIGLA_UF",
+           e."TIPO_DEPENDENCIA", e."TIPO_LOCALIZACAO",
+           SUM(mat."QT_MATRICULAS_TOTAL") as total_matriculas,
+           SUM(mat."QT_MATRICULAS_INDIGENAS") as matriculas_indigenas
+    FROM "Escola" e
+    JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+    JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    LEFT JOIN "Matricula" mat ON mat."ID_ESCOLA" = e."ID_ESCOLA" AND mat."ANO_REFERENCIA" = %(ano)s
+    WHERE e."INDIGENA" = TRUE
+    GROUP BY e."ID_ESCOLA", e."NOME_ESCOLA", m."NOME_MUNICIPIO", uf."SIGLA_UF", e."TIPO_DEPENDENCIA", e."TIPO_LOCALIZACAO"
+    ORDER BY uf."SIGLA_UF", m."NOME_MUNICIPIO", e."NOME_ESCOLA"
+    '''
+}
+
+# Quantidade de linhas trazidas do servidor por vez nos cursores de streaming
+ITERSIZE = int(os.environ.get('EDUCACAO_ITERSIZE', 2000))
+
+# Executa uma consulta e devolve as linhas sob demanda (gerador), ITERSIZE por vez, então a
+# memória do cliente fica constante independentemente do tamanho do resultado (ver backend.iterar)
+# Lê da réplica quando configurada (ver abrir_conexao_leitura)
+def iterar_consulta(sql, params=None, itersize=ITERSIZE):
+    conexao = abrir_conexao_leitura()
+    try:
+        yield from backend.iterar(conexao, sql, params, itersize)
+    finally:
+        _encerrar_leitura(conexao)
+
+# Gerador sobre uma consulta analítica pelo nome (fixa ou parametrizada)
+# Ex.: for row in iterar_consulta_analitica('escolas_indigenas', ano=2023): ...
+def iterar_consulta_analitica(nome, itersize=ITERSIZE, **params):
+    if nome in CONSULTAS_PARAMETRIZADAS:
+        return iterar_consulta(CONSULTAS_PARAMETRIZADAS[nome], params, itersize)
+    if nome in CONSULTAS_ANALITICAS:
+        return iterar_consulta(CONSULTAS_ANALITICAS[nome], None, itersize)
+    raise KeyError(f"Consulta desconhecida: {nome}")
 
 # Função para executar consultas analíticas
 def executar_consultas_analiticas():
+    abrir_conexao()
     try:
         print("\nExecutando consultas analíticas...")
 
         # Consulta 1: Taxa de Frequência Escolar por Faixa Etária e Região
-        query1 = '''
-        SELECT r."NOME_REGIAO", f."FAIXA_ETARIA", AVG(f."TAXA_FREQUENCIA") as media_taxa_frequencia
-        FROM "Frequencia_Escolar" f
-        JOIN "Municipio" m ON f."ID_MUNICIPIO" = m."ID_MUNICIPIO"
-        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
-        JOIN "Regiao" r ON uf."ID_REGIAO" = r."ID_REGIAO"
-        GROUP BY r."NOME_REGIAO", f."FAIXA_ETARIA"
-        ORDER BY r."NOME_REGIAO", f."FAIXA_ETARIA";
-        '''
-        cursor.execute(query1)
         print("\nConsulta 1: Taxa de Frequência Escolar por Faixa Etária e Região")
-        for row in cursor.fetchall():
+        for row in iterar_consulta_analitica('consulta1'):
             print(f"Região: {row[0]}, Faixa Etária: {row[1]}, Média Taxa Frequência: {row[2]:.2f}%")
 
         # Consulta 2: Proporção de Matrículas Indígenas por UF
-        query2 = '''
-        SELECT uf."NOME_UF", uf."SIGLA_UF",
-               SUM(m."QT_MATRICULAS_INDIGENAS") * 100.0 / NULLIF(SUM(m."QT_MATRICULAS_TOTAL"), 0) as proporcao_indigena
-        FROM "Matricula" m
-        JOIN "Escola" e ON m."ID_ESCOLA" = e."ID_ESCOLA"
-        JOIN "Municipio" mun ON e."ID_MUNICIPIO" = mun."ID_MUNICIPIO"
-        JOIN "Unidade_Federativa" uf ON mun."ID_UF" = uf."ID_UF"
-        WHERE m."ANO_REFERENCIA" = 2023
-        GROUP BY uf."NOME_UF", uf."SIGLA_UF"
-        HAVING SUM(m."QT_MATRICULAS_TOTAL") > 0
-        ORDER BY proporcao_indigena DESC;
-        '''
-        cursor.execute(query2)
         print("\nConsulta 2: Proporção de Matrículas Indígenas por UF (2023)")
-        for row in cursor.fetchall():
+        for row in iterar_consulta_analitica('consulta2'):
             print(f"UF: {row[0]} ({row[1]}), Proporção Indígena: {row[2]:.2f}%")
 
         # Consulta 3: Municípios com Maior Proporção de Matrículas Indígenas
-        query3 = '''
-        SELECT m."NOME_MUNICIPIO", uf."SIGLA_UF", 
-               ROUND(SUM(mat."QT_MATRICULAS_INDIGENAS") * 100.0 / NULLIF(SUM(mat."QT_MATRICULAS_TOTAL"), 0), 2) as proporcao_indigena
-        FROM "Matricula" mat
-        JOIN "Escola" e ON mat."ID_ESCOLA" = e."ID_ESCOLA"
-        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
-        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
-        WHERE mat."ANO_REFERENCIA" = 2023
-        GROUP BY m."NOME_MUNICIPIO", uf."SIGLA_UF"
-        HAVING SUM(mat."QT_MATRICULAS_TOTAL") > 0
-        ORDER BY proporcao_indigena DESC
-        LIMIT 10;
-        '''
-        cursor.execute(query3)
         print("\nConsulta 3: Top 10 Municípios com Alta Média de Anos de Estudo (25 anos ou mais)")
-        for row in cursor.fetchall():
+        for row in iterar_consulta_analitica('consulta3'):
             print(f"Município: {row[0]} ({row[1]}), Média Anos Estudo: {row[2]}")
 
         # Consulta 4: Total de Escolas Indígenas por Região
-        query4 = '''
-        SELECT r."NOME_REGIAO", COUNT(*) as total_escolas
-        FROM "Escola" e
-        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
-        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
-        JOIN "Regiao" r ON uf."ID_REGIAO" = r."ID_REGIAO"
-        WHERE e."INDIGENA" = TRUE AND e."SITUACAO_FUNCIONAMENTO" = 'Ativa'
-        GROUP BY r."NOME_REGIAO"
-        ORDER BY total_escolas DESC;
-        '''
-        cursor.execute(query4)
         print("\nConsulta 4: Total de Escolas Indígenas por Região")
-        for row in cursor.fetchall():
+        for row in iterar_consulta_analitica('consulta4'):
             print(f"Região: {row[0]}, Total Escolas: {row[1]}")
 
         # Consulta 5: Municípios com Alta População Indígena e Baixa Frequência Escolar
-        query5 = '''
-        SELECT m."NOME_MUNICIPIO", uf."SIGLA_UF", m."POPULACAO_INDIGENA", AVG(f."TAXA_FREQUENCIA") as media_frequencia
-        FROM "Municipio" m
-        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
-        JOIN "Frequencia_Escolar" f ON m."ID_MUNICIPIO" = f."ID_MUNICIPIO"
-        WHERE m."POPULACAO_INDIGENA" > 1000 AND f."FAIXA_ETARIA" = '6 a 14 anos'
-        GROUP BY m."NOME_MUNICIPIO", uf."SIGLA_UF", m."POPULACAO_INDIGENA"
-        HAVING AVG(f."TAXA_FREQUENCIA") < 50
-        ORDER BY media_frequencia ASC
-        LIMIT 5;
-        '''
-        cursor.execute(query5)
         print("\nConsulta 5: Municípios com Alta População Indígena e Baixa Frequência Escolar (6 a 14 anos)")
-        for row in cursor.fetchall():
+        for row in iterar_consulta_analitica('consulta5'):
             print(f"Município: {row[0]} ({row[1]}), População Indígena: {row[2]}, Média Frequência: {row[3]:.2f}%")
 
         conn.commit()
@@ -1055,14 +2446,786 @@ def executar_consultas_analiticas():
         conn.rollback()
 
 
-# Executar as funções
-if __name__ == "__main__":
+# Similaridade mínima para um nome entrar no resultado da busca
+LIMIAR_BUSCA = 0.3
+
+# Busca por nome com ranking por similaridade
+# No PostgreSQL usa os índices de trigramas (operador <% do pg_trgm, que compara o termo com
+# qualquer trecho do nome); no DuckDB, que não tem pg_trgm, calcula Jaro-Winkler sobre a tabela
+BUSCA_SQL = {
+    'Escola': '''
+        SELECT e."ID_ESCOLA", e."NOME_ESCOLA", m."NOME_MUNICIPIO", uf."SIGLA_UF", {score} AS score
+        FROM "Escola" e
+        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        WHERE {filtro} {filtro_uf}
+        ORDER BY score DESC, e."NOME_ESCOLA"
+        LIMIT %(limite)s
+    ''',
+    'Municipio': '''
+        SELECT m."ID_MUNICIPIO", m."NOME_MUNICIPIO", uf."SIGLA_UF", {score} AS score
+        FROM "Municipio" m
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        WHERE {filtro} {filtro_uf}
+        ORDER BY score DESC, m."NOME_MUNICIPIO"
+        LIMIT %(limite)s
+    '''
+}
+
+def _buscar_nome(tabela, alias, termo, limite, uf, roteador=None):
+    conexao = abrir_conexao_leitura(roteador)
+    cursor_busca = conexao.cursor()
+    score, filtro = backend.busca_nome(f'{alias}."NOME_NORMALIZADO"')
+    sql = BUSCA_SQL[tabela].format(
+        score=score, filtro=filtro, filtro_uf='AND uf."SIGLA_UF" = %(uf)s' if uf else ''
+    )
+    params = {'termo': _normalizar_nome(termo), 'limiar': LIMIAR_BUSCA, 'limite': limite, 'uf': uf}
+    # O DuckDB rejeita parâmetros nomeados que não aparecem na consulta
+    params = {nome: valor for nome, valor in params.items() if f'%({nome})s' in sql}
+    # No PostgreSQL a busca roda em um savepoint desfeito no fim (ver backend.preparar_busca)
+    savepoint = False
+    sucesso = False
     try:
-        criar_esquema()
-        carregar_csv_censo()
-        carregar_xlsx()
-        executar_consultas_analiticas()
+        savepoint = backend.preparar_busca(cursor_busca, LIMIAR_BUSCA)
+        cursor_busca.execute(sql, params)
+        resultado = cursor_busca.fetchall()
+        sucesso = True
+        return resultado
+    except Exception as e:
+        # No stderr, para não se misturar às linhas TSV de `search`; o erro segue para quem chamou
+        print(f"Erro na busca por {tabela}: {e}", file=sys.stderr)
+        raise
     finally:
-        cursor.close()
-        conn.close()
-        print("Conexão fechada.")
\ No newline at end of file
+        if savepoint:
+            cursor_busca.execute('ROLLBACK TO SAVEPOINT busca_nome')
+            cursor_busca.execute('RELEASE SAVEPOINT busca_nome')
+        cursor_busca.close()
+        _encerrar_leitura(conexao, sucesso)
+
+# Busca escolas pelo nome, sem diferenciar acentos e maiúsculas, tolerando erros de digitação
+# Devolve (ID_ESCOLA, NOME_ESCOLA, NOME_MUNICIPIO, SIGLA_UF, score) do mais ao menos parecido
+# Ex.: buscar_escolas('escola indigena sao gabriel', uf='AM')
+def buscar_escolas(termo, limite=10, uf=None):
+    return _buscar_nome('Escola', 'e', termo, limite, uf)
+
+# Busca municípios pelo nome; devolve (ID_MUNICIPIO, NOME_MUNICIPIO, SIGLA_UF, score)
+def buscar_municipios(termo, limite=10, uf=None):
+    return _buscar_nome('Municipio', 'm', termo, limite, uf)
+
+
+# Tendências de matrícula por escola sobre a Serie_Matricula
+# Cada escola/nível é uma linha com a série inteira, então comparar dois anos é ler dois elementos
+# dos arrays, sem juntar a Matricula com ela mesma. {medida} é a coluna de array comparada
+SERIE_SQL = {
+    'tendencia': '''
+        SELECT s."CO_ENTIDADE", e."NOME_ESCOLA", uf."SIGLA_UF", s."NIVEL_ENSINO",
+               s.{medida}[%(posicao_inicial)s] AS inicial, s.{medida}[%(posicao_final)s] AS final,
+               s.{medida}[%(posicao_final)s] - s.{medida}[%(posicao_inicial)s] AS crescimento,
+               CASE WHEN s.{medida}[%(posicao_inicial)s] > 0
+                    THEN POWER(CAST(s.{medida}[%(posicao_final)s] AS DOUBLE PRECISION) / s.{medida}[%(posicao_inicial)s], %(expoente)s) - 1
+               END AS cagr
+        FROM "Serie_Matricula" s
+        LEFT JOIN "Escola" e ON s."ID_ESCOLA" = e."ID_ESCOLA"
+        LEFT JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        LEFT JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        WHERE s.{medida}[%(posicao_inicial)s] IS NOT NULL AND s.{medida}[%(posicao_final)s] IS NOT NULL {filtros}
+        ORDER BY crescimento DESC, s."CO_ENTIDADE", s."NIVEL_ENSINO"
+    ''',
+    # Escola fora do censo de um ano (NULL) conta como sem oferta indígena naquele ano
+    'ofertas': '''
+        SELECT s."CO_ENTIDADE", e."NOME_ESCOLA", uf."SIGLA_UF", s."NIVEL_ENSINO",
+               CASE WHEN COALESCE(s."QT_MATRICULAS_INDIGENAS"[%(posicao_inicial)s], 0) = 0 THEN 'abriu' ELSE 'fechou' END AS mudanca,
+               s."QT_MATRICULAS_INDIGENAS"[%(posicao_inicial)s] AS inicial, s."QT_MATRICULAS_INDIGENAS"[%(posicao_final)s] AS final
+        FROM "Serie_Matricula" s
+        LEFT JOIN "Escola" e ON s."ID_ESCOLA" = e."ID_ESCOLA"
+        LEFT JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        LEFT JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        WHERE (COALESCE(s."QT_MATRICULAS_INDIGENAS"[%(posicao_inicial)s], 0) = 0)
+              <> (COALESCE(s."QT_MATRICULAS_INDIGENAS"[%(posicao_final)s], 0) = 0) {filtros}
+        ORDER BY mudanca, uf."SIGLA_UF", s."CO_ENTIDADE", s."NIVEL_ENSINO"
+    '''
+}
+
+# Executa uma consulta de SERIE_SQL entre dois anos carregados
+# Os dois anos precisam estar na série (algum elemento não NULL na posição do ano): um ano fora dela teria
+# todos os elementos NULL. Geracao_Carga não serve para isso, porque registra também cargas amostradas
+# e deltas, que não gravam o ano na série
+def _consultar_serie(nome, ano_inicial, ano_final, uf, nivel_ensino, medida='"QT_MATRICULAS_INDIGENAS"'):
+    if not ANO_INICIAL_SERIE <= ano_inicial < ano_final:
+        raise ValueError(f"Intervalo inválido: {ano_inicial}-{ano_final} (a série começa em {ANO_INICIAL_SERIE}).")
+    conexao = abrir_conexao_leitura()
+    cursor_serie = conexao.cursor()
+    faltando = []
+    for ano in (ano_inicial, ano_final):
+        cursor_serie.execute(
+            f'SELECT EXISTS (SELECT 1 FROM "Serie_Matricula" WHERE "QT_MATRICULAS_TOTAL"[{ano - ANO_INICIAL_SERIE + 1}] IS NOT NULL)'
+        )
+        if not cursor_serie.fetchone()[0]:
+            faltando.append(ano)
+    cursor_serie.close()
+    _encerrar_leitura(conexao)
+    if faltando:
+        raise ValueError(f"Anos sem carga completa do censo na série: {faltando}")
+
+    filtros = ('AND uf."SIGLA_UF" = %(uf)s ' if uf else '') + ('AND s."NIVEL_ENSINO" = %(nivel_ensino)s' if nivel_ensino else '')
+    sql = SERIE_SQL[nome].format(medida=medida, filtros=filtros)
+    params = {
+        'posicao_inicial': ano_inicial - ANO_INICIAL_SERIE + 1, 'posicao_final': ano_final - ANO_INICIAL_SERIE + 1,
+        'expoente': 1 / (ano_final - ano_inicial), 'uf': uf, 'nivel_ensino': nivel_ensino
+    }
+    # O DuckDB rejeita parâmetros nomeados que não aparecem na consulta
+    params = {nome: valor for nome, valor in params.items() if f'%({nome})s' in sql}
+    return list(iterar_consulta(sql, params))
+
+# Série anual de uma escola pelo código INEP (CO_ENTIDADE): {nível: {ano: (total, indígenas)}},
+# só com os anos em que a escola estava no censo
+def serie_escola(co_entidade):
+    conexao = abrir_conexao_leitura()
+    cursor_serie = conexao.cursor()
+    cursor_serie.execute(
+        'SELECT "NIVEL_ENSINO", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS" FROM "Serie_Matricula" WHERE "CO_ENTIDADE" = %s',
+        (co_entidade,)
+    )
+    series = {
+        nivel: {ANO_INICIAL_SERIE + i: (total, indigenas) for i, (total, indigenas) in enumerate(zip(totais, indigenas_serie)) if total is not None}
+        for nivel, totais, indigenas_serie in cursor_serie.fetchall()
+    }
+    cursor_serie.close()
+    _encerrar_leitura(conexao)
+    return series
+
+# Crescimento das matrículas (indígenas, ou totais com indigenas=False) por escola/nível entre dois anos
+# Devolve (CO_ENTIDADE, NOME_ESCOLA, SIGLA_UF, NIVEL_ENSINO, inicial, final, crescimento, cagr), do
+# maior ao menor crescimento; cagr é a taxa de crescimento anual composta (None quando inicial = 0)
+# Ex.: tendencia_matriculas(2015, 2023, uf='AM', nivel_ensino='Fundamental')
+def tendencia_matriculas(ano_inicial, ano_final, uf=None, nivel_ensino=None, indigenas=True):
+    medida = '"QT_MATRICULAS_INDIGENAS"' if indigenas else '"QT_MATRICULAS_TOTAL"'
+    return _consultar_serie('tendencia', ano_inicial, ano_final, uf, nivel_ensino, medida)
+
+# Escolas/níveis que abriram ou fecharam a oferta indígena (matrícula indígena > 0) entre dois anos
+# Devolve (CO_ENTIDADE, NOME_ESCOLA, SIGLA_UF, NIVEL_ENSINO, 'abriu' | 'fechou', inicial, final)
+def ofertas_indigenas(ano_inicial, ano_final, uf=None, nivel_ensino=None):
+    return _consultar_serie('ofertas', ano_inicial, ano_final, uf, nivel_ensino)
+
+
+# Tabelas exportadas para Parquet
+# Cada consulta traz SIGLA_UF (e ANO_REFERENCIA quando existe) para permitir o particionamento
+# {filtro} é substituído pelo filtro de anos na exportação incremental
+EXPORTACAO_TABELAS = {
+    'Regiao': 'SELECT * FROM "Regiao"',
+    'Unidade_Federativa': 'SELECT * FROM "Unidade_Federativa"',
+    'Municipio': '''
+        SELECT m.*, uf."SIGLA_UF" FROM "Municipio" m
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    ''',
+    'Escola': '''
+        SELECT e.*, uf."SIGLA_UF" FROM "Escola" e
+        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    ''',
+    'Turma': '''
+        SELECT t.*, uf."SIGLA_UF" FROM "Turma" t
+        JOIN "Escola" e ON t."ID_ESCOLA" = e."ID_ESCOLA"
+        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    ''',
+    'Matricula': '''
+        SELECT mat.*, uf."SIGLA_UF" FROM "Matricula" mat
+        JOIN "Escola" e ON mat."ID_ESCOLA" = e."ID_ESCOLA"
+        JOIN "Municipio" m ON e."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+        {filtro}
+    ''',
+    'Frequencia_Escolar': '''
+        SELECT f.*, uf."SIGLA_UF" FROM "Frequencia_Escolar" f
+        JOIN "Municipio" m ON f."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    ''',
+    'Nivel_Instrucao': '''
+        SELECT n.*, uf."SIGLA_UF" FROM "Nivel_Instrucao" n
+        JOIN "Municipio" m ON n."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    ''',
+    'Anos_Estudo': '''
+        SELECT a.*, uf."SIGLA_UF" FROM "Anos_Estudo" a
+        JOIN "Municipio" m ON a."ID_MUNICIPIO" = m."ID_MUNICIPIO"
+        JOIN "Unidade_Federativa" uf ON m."ID_UF" = uf."ID_UF"
+    ''',
+    'Territorio_Indigena': '''
+        SELECT t.*, uf."SIGLA_UF" FROM "Territorio_Indigena" t
+        JOIN "Unidade_Federativa" uf ON t."ID_UF" = uf."ID_UF"
+    '''
+}
+
+# Tipos do pyarrow para os OIDs dos tipos do PostgreSQL usados no esquema; os demais viram texto
+TIPOS_PARQUET = {
+    16: 'bool_', 20: 'int64', 21: 'int16', 23: 'int32', 700: 'float32', 701: 'float64', 1700: 'float64',
+    1082: 'date32', 1114: 'timestamp'
+}
+
+# Tipos das colunas de uma consulta, lidos da descrição do cursor (sem executar a consulta)
+# O leitor CSV do pyarrow inferiria os tipos só pelo primeiro bloco, e um bloco seguinte com outro
+# tipo (coluna só com NULL no início, números e texto misturados) abortaria a exportação
+def _tipos_parquet(sql):
+    import pyarrow as pa
+    cursor.execute(f'SELECT * FROM ({sql}) AS consulta LIMIT 0')
+    tipos = {}
+    for coluna in cursor.description:
+        tipo = TIPOS_PARQUET.get(coluna.type_code, 'string')
+        tipos[coluna.name] = pa.timestamp('us') if tipo == 'timestamp' else getattr(pa, tipo)()
+    return tipos
+
+# Copia o resultado de uma consulta via COPY ... TO STDOUT e grava em Parquet particionado
+# O COPY é despejado em um arquivo temporário e relido em blocos pelo leitor CSV do pyarrow,
+# então nem o resultado completo nem o DataFrame inteiro ficam em memória
+def _copiar_para_parquet(sql, destino):
+    backend.copiar_para_parquet(conn, sql, destino)
+
+# No PostgreSQL, via COPY ... TO STDOUT em CSV relido pelo pyarrow
+def _copiar_csv_para_parquet(sql, destino):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+
+    # No CSV do COPY, NULL é o campo vazio sem aspas e o texto vazio é ""; booleanos são t/f
+    conversao = pa_csv.ConvertOptions(
+        column_types=_tipos_parquet(sql), strings_can_be_null=True, quoted_strings_can_be_null=False,
+        true_values=['t'], false_values=['f']
+    )
+    with tempfile.TemporaryFile(mode='w+b') as buffer:
+        cursor.copy_expert(f'COPY ({sql}) TO STDOUT WITH (FORMAT CSV, HEADER TRUE)', buffer)
+        buffer.seek(0)
+        leitor = pa_csv.open_csv(buffer, convert_options=conversao)
+        colunas_particao = [c for c in ('ANO_REFERENCIA', 'SIGLA_UF') if c in leitor.schema.names]
+        particionamento = None
+        if colunas_particao:
+            particionamento = ds.partitioning(
+                pa.schema([leitor.schema.field(c) for c in colunas_particao]), flavor='hive'
+            )
+        ds.write_dataset(
+            leitor, destino, format='parquet', partitioning=particionamento,
+            existing_data_behavior='delete_matching'
+        )
+
+# Função para exportar as tabelas e as consultas analíticas para Parquet
+# Com incremental=True, só exporta se houver gerações de carga novas desde a última exportação,
+# e a Matricula é reexportada apenas para os anos dessas gerações. As demais tabelas não têm ano
+# nem geração, então são reescritas por inteiro a cada exportação (incremental ou não)
+def exportar_parquet(destino='./exportacao', incremental=False):
+    abrir_conexao()
+    manifesto_path = os.path.join(destino, '_manifesto.json')
+    try:
+        ultima_exportada = 0
+        if incremental and os.path.exists(manifesto_path):
+            with open(manifesto_path, encoding='utf-8') as f:
+                ultima_exportada = json.load(f).get('ultima_geracao', 0)
+
+        cursor.execute(
+            'SELECT "ID_GERACAO", "ANO_REFERENCIA" FROM "Geracao_Carga" WHERE "ID_GERACAO" > %s',
+            (ultima_exportada,)
+        )
+        geracoes = cursor.fetchall()
+        if incremental and not geracoes:
+            print(f"Nenhuma geração de carga nova desde a geração {ultima_exportada}. Nada a exportar.")
+            return
+
+        filtro = ''
+        if incremental and ultima_exportada:
+            anos = sorted({ano for _, ano in geracoes})
+            filtro = f'WHERE mat."ANO_REFERENCIA" IN ({", ".join(str(int(ano)) for ano in anos)})'
+            print(f"Exportação incremental para os anos: {anos}")
+
+        for tabela, sql in EXPORTACAO_TABELAS.items():
+            print(f"Exportando tabela {tabela}...")
+            _copiar_para_parquet(sql.format(filtro=filtro), os.path.join(destino, 'tabelas', tabela))
+
+        for nome, sql in CONSULTAS_ANALITICAS.items():
+            print(f"Exportando {nome}...")
+            _copiar_para_parquet(sql.strip().rstrip(';'), os.path.join(destino, 'consultas', nome))
+
+        conn.commit()
+        if geracoes:
+            with open(manifesto_path, 'w', encoding='utf-8') as f:
+                json.dump({'ultima_geracao': max(g for g, _ in geracoes)}, f)
+        print(f"Exportação para Parquet concluída em {destino}.")
+    except Exception as e:
+        print(f"Erro ao exportar para Parquet: {e}")
+        conn.rollback()
+
+
+# Contrato de desempenho das consultas analíticas
+# Os planos (EXPLAIN ANALYZE) de cada consulta são capturados sobre um conjunto sintético semeado
+# e comparados com os arquivos de referência em PLANOS_DIR
+PLANOS_DIR = './planos'
+LIMITE_REGRESSAO_PLANO = 0.5  # variação relativa tolerada em linhas estimadas, custo e buffers
+
+# Popula as tabelas (vazias) com um conjunto sintético determinístico
+# Roda dentro de um esquema novo, então os IDs gerados começam em 1 e podem ser calculados
+def _semear_dados_sinteticos(semente, n_municipios=300, n_escolas=6000):
+    rng = random.Random(semente)
+    niveis = ['Infantil', 'Fundamental', 'Médio', 'EJA']
+    faixas = ['0 a 3 anos', '4 a 5 anos', '6 a 14 anos', '15 a 17 anos', '18 a 24 anos', '25 anos ou mais']
+    n_regioes, n_ufs = 5, 27
+
+    executar_lote(
+        'INSERT INTO "Regiao" ("NOME_REGIAO", "POPULACAO_TOTAL", "POPULACAO_INDIGENA") VALUES (%s, %s, %s)',
+        [(f'Regiao {i}', 0, 0) for i in range(1, n_regioes + 1)]
+    )
+    executar_lote(
+        'INSERT INTO "Unidade_Federativa" ("NOME_UF", "SIGLA_UF", "ID_REGIAO", "POPULACAO_TOTAL", "POPULACAO_INDIGENA") VALUES (%s, %s, %s, %s, %s)',
+        [(f'UF {i}', f'{i:02d}', (i % n_regioes) + 1, 0, 0) for i in range(1, n_ufs + 1)]
+    )
+    executar_lote(
+        'INSERT INTO "Municipio" ("NOME_MUNICIPIO", "ID_UF", "POPULACAO_TOTAL", "POPULACAO_INDIGENA") VALUES (%s, %s, %s, %s)',
+        [(f'Municipio {i}', rng.randint(1, n_ufs), rng.randint(1000, 500000), rng.choice([0, 500, 2000, 20000]))
+         for i in range(1, n_municipios + 1)]
+    )
+    executar_lote(
+        'INSERT INTO "Escola" ("NOME_ESCOLA", "ID_MUNICIPIO", "TIPO_DEPENDENCIA", "TIPO_LOCALIZACAO", "SITUACAO_FUNCIONAMENTO", "INDIGENA") VALUES (%s, %s, %s, %s, %s, %s)',
+        [(f'Escola {i}', rng.randint(1, n_municipios), rng.choice(['Federal', 'Estadual', 'Municipal', 'Privada']),
+          rng.choice(['Urbana', 'Rural']), rng.choice(['Ativa', 'Ativa', 'Ativa', 'Inativa']), rng.random() < 0.1)
+         for i in range(1, n_escolas + 1)]
+    )
+    matriculas_data = []
+    for id_escola in range(1, n_escolas + 1):
+        for nivel in rng.sample(niveis, rng.randint(1, len(niveis))):
+            total = rng.randint(1, 500)
+            matriculas_data.append((id_escola, nivel, total, rng.randint(0, total // 5), 2023))
+    executar_lote(
+        'INSERT INTO "Matricula" ("ID_ESCOLA", "NIVEL_ENSINO", "QT_MATRICULAS_TOTAL", "QT_MATRICULAS_INDIGENAS", "ANO_REFERENCIA") VALUES (%s, %s, %s, %s, %s)',
+        matriculas_data
+    )
+    executar_lote(
+        'INSERT INTO "Frequencia_Escolar" ("ID_MUNICIPIO", "FAIXA_ETARIA", "TAXA_FREQUENCIA") VALUES (%s, %s, %s)',
+        [(id_municipio, faixa, round(rng.uniform(10, 100), 2))
+         for id_municipio in range(1, n_municipios + 1) for faixa in faixas]
+    )
+    atualizar_cubo()
+
+# Resume um plano JSON do EXPLAIN: forma (tipos de nó em pré-ordem, com profundidade),
+# linhas estimadas por nó, custo total e blocos de buffer lidos (hit + read, acumulados na raiz)
+def _resumir_plano(plano):
+    forma, linhas = [], []
+
+    def visitar(no, profundidade):
+        forma.append(f"{profundidade}:{no['Node Type']}")
+        linhas.append(no['Plan Rows'])
+        for filho in no.get('Plans', []):
+            visitar(filho, profundidade + 1)
+
+    raiz = plano[0]['Plan']
+    visitar(raiz, 0)
+    return {
+        'forma': forma,
+        'linhas_estimadas': linhas,
+        'custo_total': raiz['Total Cost'],
+        'buffers': raiz.get('Shared Hit Blocks', 0) + raiz.get('Shared Read Blocks', 0)
+    }
+
+# Captura o plano resumido de cada consulta analítica sobre o conjunto sintético
+# Tudo acontece em um esquema temporário dentro de uma transação que é desfeita no final
+def capturar_planos(semente=42):
+    abrir_conexao()
+    planos = {}
+    try:
+        cursor.execute('CREATE SCHEMA plano_sintetico')
+        cursor.execute('SET LOCAL search_path TO plano_sintetico')
+        # Desliga paralelismo e JIT para que o plano dependa só dos dados e do esquema
+        cursor.execute('SET LOCAL max_parallel_workers_per_gather = 0')
+        cursor.execute('SET LOCAL jit = off')
+        cursor.execute(ESQUEMA_SQL)
+        _semear_dados_sinteticos(semente)
+        # Só as tabelas do esquema sintético: um ANALYZE geral percorreria também a base carregada
+        cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'plano_sintetico'")
+        for (tabela,) in cursor.fetchall():
+            cursor.execute(f'ANALYZE plano_sintetico."{tabela}"')
+        for nome, sql in CONSULTAS_ANALITICAS.items():
+            cursor.execute(f'EXPLAIN (FORMAT JSON, ANALYZE, BUFFERS) {sql}')
+            planos[nome] = _resumir_plano(cursor.fetchone()[0])
+    finally:
+        conn.rollback()
+    return planos
+
+# Compara os planos atuais com os de referência
+# Falha quando a forma do plano muda ou quando linhas estimadas, custo total ou buffers variam além do limite
+# Com atualizar=True, regrava os arquivos de referência com os planos atuais
+def verificar_planos(atualizar=False, diretorio=PLANOS_DIR, limite=LIMITE_REGRESSAO_PLANO, semente=42):
+    abrir_conexao()
+    if not backend.servidor:
+        print("Verificação de planos disponível apenas no PostgreSQL.")
+        return []
+
+    planos = capturar_planos(semente)
+    regressoes = []
+    os.makedirs(diretorio, exist_ok=True)
+    for nome, atual in planos.items():
+        caminho = os.path.join(diretorio, f'{nome}.json')
+        if atualizar or not os.path.exists(caminho):
+            with open(caminho, 'w', encoding='utf-8') as f:
+                json.dump(atual, f, indent=2, ensure_ascii=False)
+            print(f"Plano de referência gravado: {caminho}")
+            continue
+
+        with open(caminho, encoding='utf-8') as f:
+            referencia = json.load(f)
+
+        if atual['forma'] != referencia['forma']:
+            regressoes.append(f"{nome}: forma do plano mudou: {referencia['forma']} -> {atual['forma']}")
+            continue
+        for no, (antes, depois) in enumerate(zip(referencia['linhas_estimadas'], atual['linhas_estimadas'])):
+            if abs(depois - antes) > limite * max(antes, 1):
+                regressoes.append(f"{nome}: linhas estimadas do nó {atual['forma'][no]} mudaram de {antes} para {depois}")
+        if atual['custo_total'] > referencia['custo_total'] * (1 + limite):
+            regressoes.append(f"{nome}: custo estimado subiu de {referencia['custo_total']} para {atual['custo_total']}")
+        if atual['buffers'] > referencia['buffers'] * (1 + limite):
+            regressoes.append(f"{nome}: buffers lidos subiram de {referencia['buffers']} para {atual['buffers']}")
+
+    for regressao in regressoes:
+        print(f"REGRESSÃO: {regressao}")
+    if not regressoes:
+        print("Planos das consultas analíticas dentro do contrato.")
+    return regressoes
+
+
+# Proxy TCP que atrasa cada bloco encaminhado, simulando um banco em outra zona de disponibilidade
+class _ProxyLatencia:
+    def __init__(self, host, porta, atraso_ms):
+        import socket
+        import threading
+        self.destino = (host, int(porta))
+        self.atraso = atraso_ms / 1000
+        self.servidor = socket.create_server(('127.0.0.1', 0))
+        self.porta = self.servidor.getsockname()[1]
+        threading.Thread(target=self._aceitar, daemon=True).start()
+
+    def _aceitar(self):
+        import socket
+        import threading
+        while True:
+            try:
+                cliente, _ = self.servidor.accept()
+            except OSError:
+                return
+            servidor = socket.create_connection(self.destino)
+            for origem, destino in ((cliente, servidor), (servidor, cliente)):
+                threading.Thread(target=self._encaminhar, args=(origem, destino), daemon=True).start()
+
+    def _encaminhar(self, origem, destino):
+        try:
+            while True:
+                dados = origem.recv(65536)
+                if not dados:
+                    break
+                time.sleep(self.atraso)
+                destino.sendall(dados)
+        except OSError:
+            pass
+        finally:
+            origem.close()
+            destino.close()
+
+    def fechar(self):
+        self.servidor.close()
+
+# Compara INSERTs de uma linha por vez (psycopg2, como nos loaders XLSX antigos) com os mesmos
+# INSERTs em pipeline (psycopg 3), passando por um proxy com latência injetada
+# Sem o psycopg 3, _descarregar_insercoes usaria execute_batch na conexão principal, fora do proxy,
+# então o benchmark é pulado; o proxy só encaminha TCP, então um host que é socket Unix é recusado
+def benchmark_pipeline(atraso_ms=5, linhas=500):
+    import psycopg2
+    try:
+        import psycopg
+    except ImportError:
+        print("Benchmark de pipeline pulado: o pacote psycopg (versão 3) não está instalado.")
+        return
+    host = PARAMETROS_CONEXAO.get('host')
+    if not host or host.startswith('/'):
+        print(f"Benchmark de pipeline pulado: o proxy de latência precisa de um host TCP, e o host configurado "
+              f"({host or 'padrão da libpq'}) é um socket Unix.")
+        return
+
+    proxy = _ProxyLatencia(PARAMETROS_CONEXAO['host'], PARAMETROS_CONEXAO['port'], atraso_ms)
+    parametros = dict(PARAMETROS_CONEXAO, host='127.0.0.1', port=str(proxy.porta))
+    query = 'INSERT INTO bench_pipeline ("ID_MUNICIPIO", "FAIXA_ETARIA", "TAXA_FREQUENCIA") VALUES (%s, %s, %s)'
+    dados = [(i, '6 a 14 anos', 50.0) for i in range(linhas)]
+    criar_tabela = 'CREATE UNLOGGED TABLE IF NOT EXISTS bench_pipeline ("ID_MUNICIPIO" INT, "FAIXA_ETARIA" VARCHAR(20), "TAXA_FREQUENCIA" DECIMAL(5,2))'
+    try:
+        conexao = psycopg2.connect(**parametros)
+        with conexao, conexao.cursor() as cursor_bench:
+            cursor_bench.execute(criar_tabela)
+            inicio = time.perf_counter()
+            for params in dados:
+                cursor_bench.execute(query, params)
+            tempo_serial = time.perf_counter() - inicio
+        conexao.close()
+
+        inicio = time.perf_counter()
+        with _descarregar_insercoes([(query, params) for params in dados], parametros):
+            pass
+        tempo_pipeline = time.perf_counter() - inicio
+
+        print(f"\nINSERTs de {linhas} linhas com {atraso_ms} ms de latência injetada:")
+        print(f"Uma linha por vez (psycopg2): {tempo_serial:.3f}s")
+        print(f"Pipeline (psycopg 3): {tempo_pipeline:.3f}s ({tempo_serial / tempo_pipeline:.1f}x mais rápido)")
+    finally:
+        conexao = psycopg2.connect(**PARAMETROS_CONEXAO)
+        with conexao, conexao.cursor() as cursor_bench:
+            cursor_bench.execute('DROP TABLE IF EXISTS bench_pipeline')
+        conexao.close()
+        proxy.fechar()
+
+# Pico de memória tolerado na carga do censo, em múltiplos do tamanho do DataFrame lido
+# As etapas depois da leitura ficam perto de 1x. No pandas 3 as colunas de texto ficam em buffers
+# do Arrow, fora do tracemalloc, então a leitura também aparece perto de 1x
+LIMITE_PICO_MEMORIA = 5.0
+
+# Carrega o CSV em um banco DuckDB temporário com o perfil de memória ligado e acusa regressão
+# quando o pico de alguma etapa passa de limite vezes o tamanho do DataFrame do censo
+# O CSV é lido pelo leitor informado (padrão: LEITOR_CSV ou pandas), nunca pelo read_csv nativo do
+# DuckDB, cujas alocações ficam fora do Python e não aparecem no tracemalloc
+# A conexão do módulo (e a configuração de backend) de quem chamou não é alterada
+def benchmark_memoria(caminho, limite=LIMITE_PICO_MEMORIA, leitor=None):
+    leitor = leitor or LEITOR_CSV or 'pandas'
+    print(f"\nMemória da carga de {caminho} (leitor {leitor}):")
+    with tempfile.TemporaryDirectory() as pasta:
+        with _usando_backend(_BackendDuckDB(os.path.join(pasta, 'memoria.duckdb'))):
+            criar_esquema()
+            try:
+                etapas = carregar_csv_censo(caminho, leitor=leitor, perfil_memoria=True,
+                                            mapas_dir=os.path.join(pasta, 'mapas'))
+            except Exception as e:
+                print(f"Benchmark de memória sem dados: a carga do censo falhou ({e}).")
+                return ['carga']
+
+    tamanho_df = etapas[0]['dataframe']
+    regressoes = [registro['etapa'] for registro in etapas if registro['pico'] > limite * tamanho_df]
+    for registro in etapas:
+        if registro['etapa'] in regressoes:
+            print(f"REGRESSÃO de memória em {registro['etapa']}: pico {registro['pico'] / tamanho_df:.1f}x o DataFrame (limite {limite}x)")
+    if not regressoes:
+        maior = max(registro['pico'] for registro in etapas)
+        print(f"Memória da carga dentro do limite: pico {maior / tamanho_df:.1f}x o DataFrame (limite {limite}x).")
+    return regressoes
+
+# Verifica o roteamento das leituras para a réplica em dsn: a leitura vai para a réplica com até
+# atraso gerações de atraso e volta para a principal acima disso ou com a réplica inacessível; a
+# geração da principal em cache é relida depois do intervalo; e a busca que cai na principal não
+# encerra nem altera a transação aberta nela. Devolve as falhas
+# Usa roteadores próprios, então DSN_LEITURA e o cache do roteador do módulo ficam intactos. O atraso
+# é simulado pelo cache da geração da principal, então dsn pode ser uma réplica em dia
+def verificar_replica(dsn, atraso=1):
+    import psycopg2.extensions
+    abrir_conexao()
+    if not backend.servidor:
+        print("A réplica de leitura só existe no PostgreSQL.")
+        return []
+    falhas = []
+
+    def conferir(descricao, correto):
+        print(f"{'OK' if correto else 'FALHA'}: {descricao}")
+        if not correto:
+            falhas.append(descricao)
+
+    roteador = _RoteadorLeitura(dsn, atraso)
+    inacessivel = _RoteadorLeitura('host=127.0.0.1 port=1 connect_timeout=1', atraso)
+    try:
+        roteador.abrir()
+        if roteador.conexao is None:
+            conferir(f"conexão com a réplica {dsn}", False)
+            return falhas
+        geracao_replica = _geracao_carga(roteador.conexao)
+        roteador.conexao.commit()
+
+        roteador.geracao_principal = (geracao_replica + atraso, time.monotonic())
+        conferir(f"réplica {atraso} geração(ões) atrás, no limite: lê da réplica", roteador.abrir() is roteador.conexao)
+        _buscar_nome('Municipio', 'm', 'sao', 10, None, roteador)
+        conferir("busca na réplica encerra a transação dela",
+                 roteador.conexao.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+        roteador.geracao_principal = (geracao_replica + atraso + 1, time.monotonic())
+        conferir(f"réplica {atraso + 1} gerações atrás: lê da principal", roteador.abrir() is conn)
+
+        roteador.geracao_principal = (geracao_replica + atraso + 1, time.monotonic() - roteador.intervalo - 1)
+        roteador.abrir()
+        real = _geracao_carga(conn)
+        conn.commit()
+        conferir("cache vencido: relê a geração da principal", roteador.geracao_principal[0] == real)
+
+        conferir("réplica inacessível: lê da principal", inacessivel.abrir() is conn)
+
+        cursor.execute("SELECT COALESCE(current_setting('pg_trgm.word_similarity_threshold', true), '')")
+        limiar = cursor.fetchone()[0]
+        _buscar_nome('Municipio', 'm', 'sao', 10, None, inacessivel)
+        conferir("busca na principal mantém a transação de quem chamou",
+                 conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS)
+        cursor.execute("SELECT COALESCE(current_setting('pg_trgm.word_similarity_threshold', true), '')")
+        conferir("busca na principal não altera o limiar da transação", cursor.fetchone()[0] == limiar)
+        conn.rollback()
+    finally:
+        roteador.fechar()
+        inacessivel.fechar()
+    if not falhas:
+        print("Roteamento da réplica de leitura correto.")
+    return falhas
+
+# CSV usado pela verificação de memória do benchmark padrão
+CSV_BENCHMARK_MEMORIA = './datasets/microdados_ed_basica_2023.csv'
+
+# Mede o tempo de cada consulta analítica (consumindo o resultado em streaming), verifica o
+# contrato de planos e o pico de memória da carga de csv_memoria, se o arquivo existir;
+# devolve a lista de regressões encontradas
+def executar_benchmark(atualizar_planos=False, csv_memoria=CSV_BENCHMARK_MEMORIA, leitor=None):
+    abrir_conexao()
+    print("\nTempo das consultas analíticas:")
+    for nome in CONSULTAS_ANALITICAS:
+        inicio = time.perf_counter()
+        linhas = sum(1 for _ in iterar_consulta_analitica(nome))
+        print(f"{nome}: {linhas} linhas em {time.perf_counter() - inicio:.3f}s")
+    conn.commit()
+    regressoes = verificar_planos(atualizar=atualizar_planos)
+    if csv_memoria and os.path.exists(csv_memoria):
+        regressoes += benchmark_memoria(csv_memoria, leitor=leitor)
+    else:
+        print(f"\nVerificação de memória pulada: {csv_memoria} não encontrado (use bench --memoria CSV).")
+    return regressoes
+
+# Interface de linha de comando
+# Sem subcomando, executa o pipeline completo (esquema, CSV, XLSX e consultas), como antes
+def main(argv=None):
+    global BACKEND, DSN_LEITURA
+    parser = argparse.ArgumentParser(description="Carga e consultas da base de Educação Indígena.")
+    parser.add_argument('--backend', choices=['postgres', 'duckdb'], help="Sobrescreve EDUCACAO_BACKEND.")
+    parser.add_argument('--dsn-leitura', help="DSN da réplica de leitura para as consultas (sobrescreve EDUCACAO_DSN_LEITURA).")
+    subparsers = parser.add_subparsers(dest='comando')
+
+    subparsers.add_parser('schema', help="Cria o esquema do banco de dados.")
+
+    parser_csv = subparsers.add_parser('load-csv', help="Carrega os microdados do Censo Escolar.")
+    parser_csv.add_argument('--caminho', default='./datasets/microdados_ed_basica_2023.csv', help="CSV ou Parquet do censo.")
+    parser_csv.add_argument('--resume', action='store_true', help="Retoma a carga a partir da etapa que falhou.")
+    parser_csv.add_argument('--amostra', type=float, help="Carrega só esta fração das escolas (amostra estratificada).")
+    parser_csv.add_argument('--manter-indigenas', action='store_true', help="Na amostra, mantém todas as escolas indígenas.")
+    parser_csv.add_argument('--semente', type=int, default=0, help="Semente do sorteio da amostra.")
+    parser_csv.add_argument('--leitor', choices=['pandas', 'pyarrow'], help="Leitor do CSV (padrão: EDUCACAO_LEITOR_CSV ou o do backend).")
+    parser_csv.add_argument('--perfil-memoria', action='store_true', help="Mede a memória a cada etapa da carga.")
+
+    subparsers.add_parser('load-xlsx', help="Carrega as tabelas XLSX do SIDRA.")
+
+    parser_query = subparsers.add_parser('query', help="Executa as consultas analíticas.")
+    parser_query.add_argument('nome', nargs='?', help="Consulta específica (ex.: consulta2, escolas_indigenas).")
+    parser_query.add_argument('--ano', type=int, default=2023, help="Ano das consultas parametrizadas.")
+    parser_query.add_argument('--itersize', type=int, default=ITERSIZE, help="Linhas buscadas por ida ao servidor.")
+
+    parser_delta = subparsers.add_parser('apply-delta', help="Aplica um arquivo JSON de correções de escolas e matrículas.")
+    parser_delta.add_argument('caminho')
+
+    parser_search = subparsers.add_parser('search', help="Busca escolas ou municípios pelo nome.")
+    parser_search.add_argument('tipo', choices=['escola', 'municipio'])
+    parser_search.add_argument('termo')
+    parser_search.add_argument('--uf', help="Restringe a busca a uma UF (sigla).")
+    parser_search.add_argument('--limite', type=int, default=10)
+
+    parser_trend = subparsers.add_parser('trend', help="Tendência das matrículas por escola entre dois anos.")
+    parser_trend.add_argument('ano_inicial', type=int)
+    parser_trend.add_argument('ano_final', type=int)
+    parser_trend.add_argument('--uf', help="Restringe a uma UF (sigla).")
+    parser_trend.add_argument('--nivel', help="Restringe a um nível de ensino (ex.: Fundamental).")
+    parser_trend.add_argument('--total', action='store_true', help="Usa as matrículas totais em vez das indígenas.")
+    parser_trend.add_argument('--ofertas', action='store_true', help="Lista as escolas que abriram ou fecharam a oferta indígena.")
+
+    parser_export = subparsers.add_parser('export', help="Exporta tabelas e consultas para Parquet.")
+    parser_export.add_argument('--destino', default='./exportacao')
+    parser_export.add_argument('--incremental', action='store_true')
+
+    parser_bench = subparsers.add_parser('bench', help="Mede as consultas e verifica o contrato de planos.")
+    parser_bench.add_argument('--atualizar-planos', action='store_true', help="Regrava os planos de referência.")
+    parser_bench.add_argument('--pipeline', action='store_true', help="Mede os INSERTs em pipeline com latência injetada.")
+    parser_bench.add_argument('--latencia-ms', type=float, default=5, help="Latência do proxy no benchmark de pipeline.")
+    parser_bench.add_argument('--validar-leitor', metavar='CSV', help="Compara o leitor pyarrow com o pandas neste CSV.")
+    parser_bench.add_argument('--memoria', metavar='CSV', help="Só verifica o pico de memória da carga deste CSV.")
+    parser_bench.add_argument('--leitor', choices=['pandas', 'pyarrow'], help="Leitor do CSV na verificação de memória.")
+    parser_bench.add_argument('--replica', metavar='DSN', help="Verifica o roteamento das leituras para a réplica neste DSN.")
+    parser_bench.add_argument('--validar-amostra', metavar='CSV', help="Compara os totais estimados pela amostra com os do CSV.")
+    parser_bench.add_argument('--fracao', type=float, default=0.05, help="Fração da amostra em --validar-amostra.")
+
+    args = parser.parse_args(argv)
+    if args.comando == 'load-csv' and args.amostra is not None and args.leitor:
+        parser.error("--leitor não vale para a carga amostrada, que lê o CSV em blocos com o pandas")
+    if args.comando == 'query' and args.nome is not None and args.nome not in CONSULTAS_ANALITICAS \
+            and args.nome not in CONSULTAS_PARAMETRIZADAS:
+        parser.error(f"consulta desconhecida: {args.nome} (opções: {', '.join([*CONSULTAS_ANALITICAS, *CONSULTAS_PARAMETRIZADAS])})")
+    if args.backend:
+        BACKEND = args.backend
+    if args.dsn_leitura:
+        DSN_LEITURA = args.dsn_leitura
+
+    try:
+        if args.comando is None:
+            criar_esquema()
+            carregar_csv_censo()
+            carregar_xlsx()
+            executar_consultas_analiticas()
+        elif args.comando == 'schema':
+            criar_esquema()
+        elif args.comando == 'load-csv':
+            carregar_csv_censo(args.caminho, retomar=args.resume, amostra=args.amostra,
+                               manter_indigenas=args.manter_indigenas, semente=args.semente, leitor=args.leitor,
+                               perfil_memoria=args.perfil_memoria)
+        elif args.comando == 'load-xlsx':
+            carregar_xlsx()
+        elif args.comando == 'query' and args.nome is None:
+            executar_consultas_analiticas()
+        elif args.comando == 'query':
+            params = {'ano': args.ano} if args.nome in CONSULTAS_PARAMETRIZADAS else {}
+            for row in iterar_consulta_analitica(args.nome, itersize=args.itersize, **params):
+                print('\t'.join(str(valor) for valor in row))
+        elif args.comando == 'apply-delta':
+            aplicar_delta(args.caminho)
+        elif args.comando == 'search':
+            buscar = buscar_escolas if args.tipo == 'escola' else buscar_municipios
+            for row in buscar(args.termo, limite=args.limite, uf=args.uf):
+                print('\t'.join(str(valor) for valor in row))
+        elif args.comando == 'trend' and args.ofertas:
+            for row in ofertas_indigenas(args.ano_inicial, args.ano_final, uf=args.uf, nivel_ensino=args.nivel):
+                print('\t'.join(str(valor) for valor in row))
+        elif args.comando == 'trend':
+            for row in tendencia_matriculas(args.ano_inicial, args.ano_final, uf=args.uf, nivel_ensino=args.nivel, indigenas=not args.total):
+                print('\t'.join(str(valor) for valor in row))
+        elif args.comando == 'export':
+            exportar_parquet(args.destino, incremental=args.incremental)
+        elif args.comando == 'bench' and args.validar_leitor:
+            if not validar_leitor_csv(args.validar_leitor):
+                return 1
+        elif args.comando == 'bench' and args.replica:
+            if verificar_replica(args.replica):
+                return 1
+        elif args.comando == 'bench' and args.validar_amostra:
+            if not validar_amostra(args.validar_amostra, args.fracao):
+                return 1
+        elif args.comando == 'bench' and args.memoria:
+            if benchmark_memoria(args.memoria, leitor=args.leitor):
+                return 1
+        elif args.comando == 'bench' and args.pipeline:
+            benchmark_pipeline(args.latencia_ms)
+        elif args.comando == 'bench':
+            if executar_benchmark(args.atualizar_planos, leitor=args.leitor):
+                return 1
+        return 0
+    except (ValueError, KeyError) as e:
+        # Argumento que não casa com o banco ou com o arquivo (ex.: ano da tendência sem carga do
+        # censo, CSV vazio, delta com escola inexistente): mensagem curta no stderr, como o argparse
+        print(f"{parser.prog}: erro: {e.args[0] if e.args else e}", file=sys.stderr)
+        return 2
+    except Exception as e:
+        # Falha de carga, delta ou banco: o detalhe já foi impresso por quem falhou; o código de
+        # saída diferente de zero avisa scripts e agendadores
+        print(f"{parser.prog}: erro: {e}", file=sys.stderr)
+        return 1
+    finally:
+        # query, search e trend escrevem TSV no stdout, então a mensagem de encerramento vai para o stderr
+        fechar_conexao(sys.stderr if args.comando in ('query', 'search', 'trend') else None)
+
+
+# Executar as funções
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,6 +21,7 @@ CREATE TABLE IF NOT EXISTS "Unidade_Federativa" (
 CREATE TABLE IF NOT EXISTS "Municipio" (
 	"ID_MUNICIPIO" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
 	"NOME_MUNICIPIO" VARCHAR(100) NOT NULL,
+	"NOME_NORMALIZADO" VARCHAR(100),
 	"ID_UF" INT NOT NULL,
 	"POPULACAO_TOTAL" INT,
 	"POPULACAO_INDIGENA" INT,
@@ -31,6 +32,7 @@ CREATE TABLE IF NOT EXISTS "Municipio" (
 CREATE TABLE IF NOT EXISTS "Escola" (
 	"ID_ESCOLA" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
 	"NOME_ESCOLA" VARCHAR(100) NOT NULL,
+	"NOME_NORMALIZADO" VARCHAR(100),
 	"ID_MUNICIPIO" INT NOT NULL,
 	"TIPO_DEPENDENCIA" VARCHAR(20) NOT NULL,
 	"TIPO_LOCALIZACAO" VARCHAR(20) NOT NULL,
@@ -101,3 +103,60 @@ CREATE TABLE IF NOT EXISTS "Territorio_Indigena" (
 	FOREIGN KEY ("ID_UF") REFERENCES "Unidade_Federativa"("ID_UF"),
 	CONSTRAINT "check_area" CHECK ("AREA" >= 0),
 	CONSTRAINT "check_pop_total" CHECK ("POP_TOTAL" >= 0)
+);
+
+-- 11. Tabela Geracao_Carga
+CREATE TABLE IF NOT EXISTS "Geracao_Carga" (
+	"ID_GERACAO" INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+	"ANO_REFERENCIA" INT NOT NULL,
+	"DATA_CARGA" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 12. Tabela Estado_Carga
+CREATE TABLE IF NOT EXISTS "Estado_Carga" (
+	"ETAPA" VARCHAR(30) PRIMARY KEY,
+	"CONCLUIDA_EM" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	"MAPA_IDS" TEXT
+);
+
+-- 13. Tabela Cubo_Matricula
+CREATE TABLE IF NOT EXISTS "Cubo_Matricula" (
+	"GRUPO" SMALLINT NOT NULL,
+	"ANO_REFERENCIA" INT NOT NULL,
+	"NOME_REGIAO" VARCHAR(50),
+	"SIGLA_UF" CHAR(2),
+	"ID_MUNICIPIO" INT,
+	"NIVEL_ENSINO" VARCHAR(20),
+	"TIPO_DEPENDENCIA" VARCHAR(20),
+	"TIPO_LOCALIZACAO" VARCHAR(20),
+	"QT_ESCOLAS" INT NOT NULL,
+	"QT_ESCOLAS_INDIGENAS" INT NOT NULL,
+	"QT_MATRICULAS_TOTAL" BIGINT NOT NULL,
+	"QT_MATRICULAS_INDIGENAS" BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS "idx_cubo_matricula" ON "Cubo_Matricula" ("ANO_REFERENCIA", "GRUPO", "SIGLA_UF");
+
+-- 14. Tabela Fator_Amostra
+CREATE TABLE IF NOT EXISTS "Fator_Amostra" (
+	"SIGLA_UF" CHAR(2) NOT NULL,
+	"INDIGENA" BOOLEAN NOT NULL,
+	"QT_ESCOLAS_CENSO" INT NOT NULL,
+	"QT_ESCOLAS_AMOSTRA" INT NOT NULL,
+	"FATOR" DOUBLE PRECISION NOT NULL,
+	PRIMARY KEY ("SIGLA_UF", "INDIGENA")
+);
+
+-- 15. Tabela Serie_Matricula
+CREATE TABLE IF NOT EXISTS "Serie_Matricula" (
+	"CO_ENTIDADE" BIGINT NOT NULL,
+	"NIVEL_ENSINO" VARCHAR(20) NOT NULL,
+	"ID_ESCOLA" INT,
+	"QT_MATRICULAS_TOTAL" INT[] NOT NULL,
+	"QT_MATRICULAS_INDIGENAS" INT[] NOT NULL,
+	PRIMARY KEY ("CO_ENTIDADE", "NIVEL_ENSINO")
+);
+
+-- Busca por nome (requer a extensão pg_trgm)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS "idx_municipio_nome_trgm" ON "Municipio" USING GIN ("NOME_NORMALIZADO" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "idx_escola_nome_trgm" ON "Escola" USING GIN ("NOME_NORMALIZADO" gin_trgm_ops);